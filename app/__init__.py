@@ -4,7 +4,10 @@ from starlette.middleware.sessions import SessionMiddleware
 
 from .config import PROJECT_ROOT, get_settings
 from .security.auth import ensure_default_admin
+from .storage.archiver import start_background_archiver
+from .storage.search_index import start_background_build
 from .utils.logging import configure_logging
+from .utils.tracing import start_background_flusher
 
 
 def create_app() -> FastAPI:
@@ -38,6 +41,15 @@ def create_app() -> FastAPI:
     # Ensure default admin user exists
     ensure_default_admin()
 
+    # Background archival of cold conversations (ARCHIVE_AFTER_DAYS > 0)
+    start_background_archiver()
+
+    # Warm up the in-process full-text search index
+    start_background_build()
+
+    # Batch-write request traces to TRACE_FILE (TRACE_ENABLED=True)
+    start_background_flusher()
+
     # Routers
     from .routes import auth_routes, chat_routes, settings_routes, console_routes
 
@@ -11,6 +11,7 @@ PROJECT_ROOT = Path(__file__).resolve().parent.parent
 
 class Settings(BaseModel):
     web_port: int = 443
+    web_workers: int = 1
     debug_mode: bool = True
     project_save: bool = True
     dashscope_api_key: str | None = None
@@ -18,6 +19,80 @@ class Settings(BaseModel):
     ssl_key_file: str = "certs/server.key"
     default_admin_username: str = "admin"
     default_admin_password: str = "admin123"
+    # 消息存储模式：json（整文件 messages.json）或 jsonl（追加日志 + 会话偏移索引）
+    message_store: str = "json"
+    # 存储后端：json（data/*.json 文件）或 sqlite（WAL 模式数据库）
+    storage_backend: str = "json"
+    sqlite_path: str = "data/judgmentday.db"
+    # 后台批量提交：把多个请求的写入合并为每个间隔一次提交
+    store_group_commit: bool = False
+    store_commit_interval_ms: int = 50
+    store_commit_max_batch: int = 256
+    # 每次提交后 fsync 数据文件（更耐久、更慢）
+    store_fsync: bool = False
+    # 数据文件写入格式：json-pretty / json / orjson / msgpack（读取时自动识别）
+    store_codec: str = "json"
+    # 冷会话归档：闲置超过该天数的会话消息移入 data/archive/ 压缩段（0 表示不自动归档）
+    archive_after_days: float = 0
+    archive_interval_minutes: int = 60
+    # 工具调用（Shell 命令）线程池大小
+    tool_workers: int = 8
+    # 工具结果缓存（用户在设置页开启）：条目有效期（秒）与每个会话的条目上限
+    tool_cache_ttl: float = 300
+    tool_cache_max_entries: int = 64
+    # 持久 Shell 会话（用户在设置页开启）：空闲回收时间（秒）与进程内会话数上限
+    shell_session_idle_timeout: float = 900
+    shell_session_max: int = 16
+    # Shell 输出截取：内存中保留（并交给模型）的开头与末尾字符数，超出部分完整写入 tmp/tool_outputs/；
+    # 以及运行中推送到前端的输出速率上限（字符/秒）
+    tool_output_head_chars: int = 8000
+    tool_output_tail_chars: int = 8000
+    tool_output_stream_rate: int = 32768
+    # Shell 命令资源限制（0 表示不限制）：每个进程的 CPU 秒数、地址空间、用户进程数、单文件大小，以及 nice / ionice 优先级
+    shell_limit_cpu_seconds: int = 300
+    shell_limit_memory_mb: int = 4096
+    shell_limit_nproc: int = 1024
+    shell_limit_file_mb: int = 1024
+    shell_nice: int = 10
+    shell_ionice_class: int = 2
+    shell_ionice_level: int = 7
+    # 全部 Shell 命令共享的 cgroup v2 目录（为空则不使用）及其合计内存、进程数上限与 CPU 权重
+    shell_cgroup: str = "/sys/fs/cgroup/judgmentday-shell"
+    shell_cgroup_memory_mb: int = 4096
+    shell_cgroup_pids: int = 512
+    shell_cgroup_cpu_weight: int = 20
+    # 请求追踪：是否开启、抽样比例、内存缓冲 span 数与写出文件（相对项目根目录，为空则只保留在内存）
+    trace_enabled: bool = False
+    trace_sample_rate: float = 1.0
+    trace_buffer_size: int = 10000
+    trace_file: str = "data/traces.jsonl"
+    # 上下文窗口：发送给模型的历史消息 token 预算（估算值）、原样保留的最近轮数、旧 Shell 输出保留字符数
+    context_token_budget: int = 32000
+    context_keep_turns: int = 4
+    context_elide_chars: int = 2000
+    # 超出预算而被丢弃的旧轮次是否由模型折叠为滚动摘要（会额外调用一次模型）
+    context_summary: bool = False
+    # 模型服务提供方（用户未在设置中选择时的默认值）：dashscope / openai / fake，以及模型名称
+    model_provider: str = "dashscope"
+    model_name: str = "qwen3-max"
+    # OpenAI 兼容接口：服务地址、默认 API Key（用户未填写时使用）、连接池大小与缓存的客户端数
+    openai_base_url: str = "https://dashscope.aliyuncs.com/compatible-mode/v1"
+    openai_api_key: str | None = None
+    openai_max_connections: int = 20
+    openai_max_clients: int = 32
+    # 模拟提供方：首个 token 前的延迟（毫秒）与每秒输出 token 数（0 表示不限速）
+    fake_latency_ms: int = 200
+    fake_tokens_per_sec: float = 50
+    # 模型调用准入控制（按 API Key）：并发上限、每秒调用数与突发量（0 表示不限速）
+    model_max_concurrency: int = 8
+    model_rate_per_sec: float = 5.0
+    model_rate_burst: int = 10
+    # 限流 / 临时错误的最大重试次数与退避基数（毫秒）
+    model_max_retries: int = 3
+    model_retry_base_ms: int = 500
+    # 熔断：连续临时错误次数阈值与熔断时长（秒）
+    model_breaker_threshold: int = 5
+    model_breaker_cooldown_sec: float = 30
 
     @property
     def cert_paths(self) -> tuple[Path, Path]:
@@ -32,6 +107,7 @@ def get_settings() -> Settings:
 
     return Settings(
         web_port=int(os.getenv("WEB_PORT", "443")),
+        web_workers=max(1, int(os.getenv("WEB_WORKERS", "1"))),
         debug_mode=os.getenv("DEBUG_MODE", "True").lower() == "true",
         project_save=os.getenv("PROJECT_SAVE", "True").lower() == "true",
         dashscope_api_key=os.getenv("DASH_SCOPE_API_KEY") or None,
@@ -39,5 +115,57 @@ def get_settings() -> Settings:
         ssl_key_file=os.getenv("SSL_KEY_FILE", "certs/server.key"),
         default_admin_username=os.getenv("DEFAULT_ADMIN_USERNAME", "admin"),
         default_admin_password=os.getenv("DEFAULT_ADMIN_PASSWORD", "admin123"),
+        message_store=os.getenv("MESSAGE_STORE", "json").strip().lower(),
+        storage_backend=os.getenv("STORAGE_BACKEND", "json").strip().lower(),
+        sqlite_path=os.getenv("SQLITE_PATH", "data/judgmentday.db"),
+        store_group_commit=os.getenv("STORE_GROUP_COMMIT", "False").lower() == "true",
+        store_commit_interval_ms=int(os.getenv("STORE_COMMIT_INTERVAL_MS", "50")),
+        store_commit_max_batch=int(os.getenv("STORE_COMMIT_MAX_BATCH", "256")),
+        store_fsync=os.getenv("STORE_FSYNC", "False").lower() == "true",
+        store_codec=os.getenv("STORE_CODEC", "json").strip().lower(),
+        archive_after_days=float(os.getenv("ARCHIVE_AFTER_DAYS", "0")),
+        archive_interval_minutes=max(1, int(os.getenv("ARCHIVE_INTERVAL_MINUTES", "60"))),
+        tool_workers=max(1, int(os.getenv("TOOL_WORKERS", "8"))),
+        tool_cache_ttl=float(os.getenv("TOOL_CACHE_TTL", "300")),
+        tool_cache_max_entries=max(1, int(os.getenv("TOOL_CACHE_MAX_ENTRIES", "64"))),
+        shell_session_idle_timeout=float(os.getenv("SHELL_SESSION_IDLE_TIMEOUT", "900")),
+        shell_session_max=max(1, int(os.getenv("SHELL_SESSION_MAX", "16"))),
+        tool_output_head_chars=max(0, int(os.getenv("TOOL_OUTPUT_HEAD_CHARS", "8000"))),
+        tool_output_tail_chars=max(0, int(os.getenv("TOOL_OUTPUT_TAIL_CHARS", "8000"))),
+        tool_output_stream_rate=max(1024, int(os.getenv("TOOL_OUTPUT_STREAM_RATE", "32768"))),
+        shell_limit_cpu_seconds=max(0, int(os.getenv("SHELL_LIMIT_CPU_SECONDS", "300"))),
+        shell_limit_memory_mb=max(0, int(os.getenv("SHELL_LIMIT_MEMORY_MB", "4096"))),
+        shell_limit_nproc=max(0, int(os.getenv("SHELL_LIMIT_NPROC", "1024"))),
+        shell_limit_file_mb=max(0, int(os.getenv("SHELL_LIMIT_FILE_MB", "1024"))),
+        shell_nice=min(19, max(0, int(os.getenv("SHELL_NICE", "10")))),
+        shell_ionice_class=int(os.getenv("SHELL_IONICE_CLASS", "2")),
+        shell_ionice_level=min(7, max(0, int(os.getenv("SHELL_IONICE_LEVEL", "7")))),
+        shell_cgroup=os.getenv("SHELL_CGROUP", "/sys/fs/cgroup/judgmentday-shell").strip(),
+        shell_cgroup_memory_mb=max(0, int(os.getenv("SHELL_CGROUP_MEMORY_MB", "4096"))),
+        shell_cgroup_pids=max(0, int(os.getenv("SHELL_CGROUP_PIDS", "512"))),
+        shell_cgroup_cpu_weight=min(10000, max(0, int(os.getenv("SHELL_CGROUP_CPU_WEIGHT", "20")))),
+        trace_enabled=os.getenv("TRACE_ENABLED", "False").lower() == "true",
+        trace_sample_rate=min(1.0, max(0.0, float(os.getenv("TRACE_SAMPLE_RATE", "1.0")))),
+        trace_buffer_size=int(os.getenv("TRACE_BUFFER_SIZE", "10000")),
+        trace_file=os.getenv("TRACE_FILE", "data/traces.jsonl").strip(),
+        context_token_budget=int(os.getenv("CONTEXT_TOKEN_BUDGET", "32000")),
+        context_keep_turns=int(os.getenv("CONTEXT_KEEP_TURNS", "4")),
+        context_elide_chars=int(os.getenv("CONTEXT_ELIDE_CHARS", "2000")),
+        context_summary=os.getenv("CONTEXT_SUMMARY", "False").lower() == "true",
+        model_provider=os.getenv("MODEL_PROVIDER", "dashscope").strip().lower(),
+        model_name=os.getenv("MODEL_NAME", "qwen3-max").strip(),
+        openai_base_url=os.getenv("OPENAI_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1").strip(),
+        openai_api_key=os.getenv("OPENAI_API_KEY") or None,
+        openai_max_connections=max(1, int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))),
+        openai_max_clients=max(1, int(os.getenv("OPENAI_MAX_CLIENTS", "32"))),
+        fake_latency_ms=int(os.getenv("FAKE_LATENCY_MS", "200")),
+        fake_tokens_per_sec=float(os.getenv("FAKE_TOKENS_PER_SEC", "50")),
+        model_max_concurrency=max(1, int(os.getenv("MODEL_MAX_CONCURRENCY", "8"))),
+        model_rate_per_sec=float(os.getenv("MODEL_RATE_PER_SEC", "5")),
+        model_rate_burst=max(1, int(os.getenv("MODEL_RATE_BURST", "10"))),
+        model_max_retries=max(0, int(os.getenv("MODEL_MAX_RETRIES", "3"))),
+        model_retry_base_ms=int(os.getenv("MODEL_RETRY_BASE_MS", "500")),
+        model_breaker_threshold=max(1, int(os.getenv("MODEL_BREAKER_THRESHOLD", "5"))),
+        model_breaker_cooldown_sec=float(os.getenv("MODEL_BREAKER_COOLDOWN", "30")),
     )
 
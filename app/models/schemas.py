@@ -40,6 +40,17 @@ class Conversation(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
     message_ids: List[str] = Field(default_factory=list)
+    # 上下文窗口的滚动摘要：{"text", "upto"（已折叠的最后一条消息 id）, "updated_at"}
+    context_summary: Optional[dict] = None
+
+
+class ConversationSummary(BaseModel):
+    """侧栏使用的会话摘要，不含消息列表。"""
+
+    id: str
+    title: str
+    updated_at: datetime
+    message_count: int = 0
 
 
 class AutomationTask(BaseModel):
@@ -50,3 +61,24 @@ class AutomationTask(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     status: str = "pending"
 
+
+
+class UsageRecord(BaseModel):
+    """一次助手回复的用量：token 数（取自模型服务返回的 usage）、模型轮数、工具调用数与耗时拆分（毫秒）。"""
+
+    user_id: str
+    conversation_id: str
+    provider: str = ""
+    model: str = ""
+    # ok / error / interrupted（用户打断）/ disconnected（客户端断开）
+    status: str = "ok"
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+    rounds: int = 0
+    tool_calls: int = 0
+    total_ms: int = 0
+    first_output_ms: int = 0
+    model_ms: int = 0
+    tool_ms: int = 0
+    created_at: datetime = Field(default_factory=datetime.utcnow)
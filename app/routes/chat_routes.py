@@ -2,11 +2,8 @@ from __future__ import annotations
 
 import asyncio
 import json
-import queue
-import threading
 import time
 import uuid
-from pathlib import Path
 from typing import List, Optional
 
 from fastapi import APIRouter, Depends, File, Form, HTTPException, Request, UploadFile, status
@@ -17,11 +14,16 @@ from app.config import PROJECT_ROOT
 from app.models.schemas import ChatMessage
 from app.security.auth import get_current_user
 from app.services import chat_service
+from app.utils import tracing
 
 templates = Jinja2Templates(directory=str(PROJECT_ROOT / "templates"))
 
 router = APIRouter()
 
+# 对话页首屏渲染的消息条数，更早的消息由前端滚动到顶部时分页加载
+HISTORY_PAGE_SIZE = 50
+HISTORY_PAGE_MAX = 200
+
 
 @router.get("/chat", response_class=HTMLResponse)
 async def chat_page(request: Request):
@@ -35,6 +37,7 @@ async def chat_page(request: Request):
                 "request": request,
                 "conversation": None,
                 "messages": [],
+                "has_more_history": False,
                 "conversations": conversations,
                 "current_username": user.username,
             },
@@ -46,7 +49,7 @@ async def chat_page(request: Request):
             conversation = chat_service.create_conversation_if_needed(user)
     else:
         conversation = chat_service.create_conversation_if_needed(user)
-    history = chat_service.list_messages(conversation.id)
+    history, has_more = chat_service.list_messages_page(conversation.id, HISTORY_PAGE_SIZE)
     conversations = chat_service.list_conversations_for_user(user.id)
     return templates.TemplateResponse(
         "chat.html",
@@ -54,6 +57,7 @@ async def chat_page(request: Request):
             "request": request,
             "conversation": conversation,
             "messages": history,
+            "has_more_history": has_more,
             "conversations": conversations,
             "current_username": user.username,
         },
@@ -82,45 +86,29 @@ async def api_chat_stream(
         file_list = [f for f in files.split(",") if f]
 
     async def event_stream():
-        if created_new:
-            yield f"data: [CONV_ID]{conversation.id}\n\n"
-        chunk_queue: queue.Queue = queue.Queue()
-
-        def run_sync_stream():
-            try:
-                for chunk in chat_service.stream_model_reply(
-                    user=user,
-                    conversation=conversation,
-                    user_content=content,
-                    files=file_list,
-                    request_id=request_id,
-                ):
-                    chunk_queue.put(chunk)
-            finally:
-                chunk_queue.put(None)
-
-        threading.Thread(target=run_sync_stream, daemon=True).start()
-        loop = asyncio.get_event_loop()
-        chunk_index = 0
-        while True:
-            chunk = await loop.run_in_executor(None, chunk_queue.get)
-            if chunk is None:
-                break
-            # #region agent log
-            try:
-                _log_path = Path(PROJECT_ROOT) / ".cursor" / "debug-0f4b4c.log"
-                _payload = {"sessionId": "0f4b4c", "hypothesisId": "H4", "location": "chat_routes:event_stream", "message": "route_yield_sse", "data": {"chunk_index": chunk_index, "chunk_len": len(chunk), "ts": time.time()}, "timestamp": int(time.time() * 1000)}
-                with _log_path.open("a") as _f:
-                    _f.write(json.dumps(_payload, ensure_ascii=False) + "\n")
-            except Exception:
-                pass
-            # #endregion
-            chunk_index += 1
-            # 用 JSON 编码 payload，避免 chunk 内换行或 "data:" 被误解析并显示到界面
-            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-            # 让出事件循环，促使 ASGI 层立即发送当前 chunk，避免与下一 chunk 合并导致前端一次性收到多段
-            await asyncio.sleep(0)
-        yield "data: [DONE]\n\n"
+        # 追踪上下文在此建立，chat_service / dashscope_client / 存储层的 span 都归入本次请求
+        trace = tracing.start_trace("chat.turn")
+        try:
+            if created_new:
+                yield f"data: [CONV_ID]{conversation.id}\n\n"
+            chunk_index = 0
+            async for chunk in chat_service.stream_model_reply(
+                user=user,
+                conversation=conversation,
+                user_content=content,
+                files=file_list,
+                request_id=request_id,
+            ):
+                # 用 JSON 编码 payload，避免 chunk 内换行或 "data:" 被误解析并显示到界面
+                payload = f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                with tracing.span("sse.flush", chunk=chunk_index, bytes=len(payload)):
+                    yield payload
+                    # 让出事件循环，促使 ASGI 层立即发送当前 chunk，避免与下一 chunk 合并导致前端一次性收到多段
+                    await asyncio.sleep(0)
+                chunk_index += 1
+            yield "data: [DONE]\n\n"
+        finally:
+            tracing.end_trace(trace)
 
     return StreamingResponse(
         event_stream(),
@@ -139,6 +127,41 @@ async def api_chat_interrupt(request_id: str = Form(...)):
     return {"status": "ok"}
 
 
+@router.get("/api/chat/conversations/{conversation_id}/messages")
+async def api_list_messages(
+    request: Request,
+    conversation_id: str,
+    before: Optional[str] = None,
+    limit: int = HISTORY_PAGE_SIZE,
+):
+    """分页获取会话历史：返回 before（消息 id）之前最新的 limit 条消息，按时间正序。"""
+    user = get_current_user(request)
+    if not chat_service.get_conversation_by_id(conversation_id, user.id):
+        raise HTTPException(status_code=404, detail="会话不存在或无权访问")
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+    messages, has_more = chat_service.list_messages_page(conversation_id, limit, before or None)
+    return {
+        "messages": [m.model_dump(mode="json") for m in messages],
+        "has_more": has_more,
+        "next_before": messages[0].id if messages else None,
+    }
+
+
+@router.get("/api/chat/search")
+async def api_search_history(request: Request, q: str = "", limit: int = 20):
+    """在当前用户的会话历史中全文检索，返回按相关度排序的会话与消息命中。"""
+    user = get_current_user(request)
+    q = q.strip()
+    if not q:
+        return {"query": q, "took_ms": 0, "conversations": [], "messages": []}
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+    started = time.perf_counter()
+    result = await asyncio.get_running_loop().run_in_executor(
+        None, chat_service.search_history, user.id, q, limit
+    )
+    return {"query": q, "took_ms": round((time.perf_counter() - started) * 1000, 2), **result}
+
+
 @router.delete("/api/chat/conversations/{conversation_id}")
 async def api_delete_conversation(request: Request, conversation_id: str):
     user = get_current_user(request)
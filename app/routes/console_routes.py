@@ -1,8 +1,17 @@
 from __future__ import annotations
 
-from fastapi import APIRouter
+import asyncio
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import PlainTextResponse
 
 from app.config import get_settings
+from app.models.schemas import User
+from app.security.auth import get_admin_user
+from app.services import admission, resource_limits, shell_session, tool_cache
+from app.storage import codecs, json_store, search_index, usage_ledger
+from app.utils import metrics, tracing
 
 router = APIRouter(tags=["console"])
 
@@ -14,4 +23,74 @@ async def get_console_logs():
     return {
         "debug_mode": settings.debug_mode,
         "message": "当 DEBUG_MODE=True 时，请查看终端输出获取详细日志。",
+        "tracing": tracing.stats(),
     }
+
+
+@router.get("/api/console/cache")
+async def get_cache_stats():
+    """存储层 users / settings 缓存的命中、未命中与失效次数。"""
+    return json_store.cache_stats()
+
+
+@router.get("/api/console/storage")
+async def get_storage_stats():
+    """存储层运行状态：后台批量写入器、冷会话归档与全文检索索引统计。"""
+    return {
+        "group_commit": json_store.writer_stats(),
+        "archive": json_store.archive_stats(),
+        "search": search_index.index_stats(),
+    }
+
+
+@router.get("/api/console/model")
+async def get_model_stats():
+    """模型调用准入控制统计：各 API Key（以哈希前缀标识）的并发、排队、重试，以及熔断器状态。"""
+    return admission.stats()
+
+
+@router.get("/api/console/tools")
+async def get_tool_stats():
+    """工具调用统计：会话内工具结果缓存的命中、写入与失效次数，持久 Shell 会话与资源限制的状态。"""
+    return {"cache": tool_cache.stats(), "sessions": shell_session.stats(), "limits": resource_limits.stats()}
+
+
+@router.get("/api/console/usage")
+async def get_usage(
+    group_by: str = Query("user", pattern="^(user|conversation|day)$"),
+    user_id: Optional[str] = None,
+    since: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    until: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    limit: int = Query(50, ge=1, le=1000),
+    user: User = Depends(get_admin_user),
+):
+    """
+    用量账本汇总（仅管理员）：按用户 / 会话 / 日期（UTC）统计 token、模型轮数、工具调用与耗时，按 token 总数降序。
+    普通用户通过 /api/settings/usage 查看自己的用量。
+    """
+    items = await asyncio.to_thread(usage_ledger.aggregate, group_by, user_id, since, until, limit)
+    if group_by != "day":
+        usernames = {u["id"]: u.get("username", "") for u in await asyncio.to_thread(json_store.load_users)}
+        for item in items:
+            item["username"] = usernames.get(item.get("user_id") or item["key"], "")
+    return {"group_by": group_by, "items": items}
+
+
+@router.get("/metrics")
+async def get_metrics():
+    """Prometheus 文本格式的运行指标（本进程）：首个输出 / token 耗时、模型轮次、Shell 执行、存储读写、活跃流与打断次数。"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@router.get("/api/console/traces")
+async def get_traces(
+    format: str = Query("jsonl", pattern="^(jsonl|chrome)$"),
+    limit: int = Query(1000, ge=1, le=100000),
+    trace_id: Optional[str] = None,
+    user: User = Depends(get_admin_user),
+):
+    """导出本进程最近的追踪 span（仅管理员）：jsonl（一行一个 span）或 chrome（Chrome trace event 格式）。"""
+    spans = tracing.recent_spans(limit, trace_id)
+    if format == "chrome":
+        return tracing.to_chrome_trace(spans)
+    return PlainTextResponse(b"".join(codecs.json_dumps_line(s) for s in spans), media_type="application/x-ndjson")
@@ -1,13 +1,16 @@
 from __future__ import annotations
 
+import asyncio
 from typing import Optional
 
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from pydantic import BaseModel
 
+from app.config import get_settings
 from app.models.schemas import User
 from app.security.auth import get_current_user
-from app.storage import json_store
+from app.services import model_provider
+from app.storage import json_store, usage_ledger
 
 router = APIRouter(prefix="/api/settings", tags=["settings"])
 
@@ -16,6 +19,9 @@ class SettingsUpdate(BaseModel):
     api_key: Optional[str] = None
     enable_utcp: Optional[bool] = None
     enable_web_search: Optional[bool] = None
+    enable_tool_cache: Optional[bool] = None
+    enable_shell_session: Optional[bool] = None
+    model_provider: Optional[str] = None
 
 
 def _default_true(value: Optional[bool]) -> bool:
@@ -25,25 +31,44 @@ def _default_true(value: Optional[bool]) -> bool:
     return value
 
 
+def _effective_provider(name: Optional[str]) -> str:
+    """
+    页面上显示的提供方：已保存的选择不再可用（如可选依赖被卸载、未开放模拟）时显示实际使用的提供方，
+    与 model_provider.get_provider 的回退一致，避免页面把不可用的值提交回来。
+    """
+    available = model_provider.available_providers()
+    for candidate in (name, get_settings().model_provider):
+        if candidate in available:
+            return candidate
+    return "dashscope"
+
+
 @router.get("/me")
 async def get_my_settings(request: Request, user: User = Depends(get_current_user)):
-    settings_list = json_store.load_settings()
-    for item in settings_list:
-        if item.get("user_id") == user.id:
-            api_key = item.get("api_key")
-            enable_utcp = _default_true(item.get("enable_utcp"))
-            enable_web_search = _default_true(item.get("enable_web_search"))
-            return {
-                "api_key_set": bool(api_key),
-                "api_key_masked": "*" * 8 if api_key else "",
-                "enable_utcp": enable_utcp,
-                "enable_web_search": enable_web_search,
-            }
+    item = json_store.get_user_settings(user.id)
+    if item is not None:
+        api_key = item.get("api_key")
+        enable_utcp = _default_true(item.get("enable_utcp"))
+        enable_web_search = _default_true(item.get("enable_web_search"))
+        return {
+            "api_key_set": bool(api_key),
+            "api_key_masked": "*" * 8 if api_key else "",
+            "enable_utcp": enable_utcp,
+            "enable_web_search": enable_web_search,
+            "enable_tool_cache": item.get("enable_tool_cache") is True,
+            "enable_shell_session": item.get("enable_shell_session") is True,
+            "model_provider": _effective_provider(item.get("model_provider")),
+            "available_providers": model_provider.available_providers(),
+        }
     return {
         "api_key_set": False,
         "api_key_masked": "",
         "enable_utcp": True,
         "enable_web_search": True,
+        "enable_tool_cache": False,
+        "enable_shell_session": False,
+        "model_provider": _effective_provider(None),
+        "available_providers": model_provider.available_providers(),
     }
 
 
@@ -52,31 +77,37 @@ async def update_my_settings(
     payload: SettingsUpdate, user: User = Depends(get_current_user)
 ):
     api_key = (payload.api_key or "").strip()
-    settings_list = json_store.load_settings()
-    found = False
-    for item in settings_list:
-        if item.get("user_id") == user.id:
-            item["api_key"] = api_key
-            if payload.enable_utcp is not None:
-                item["enable_utcp"] = payload.enable_utcp
-            if payload.enable_web_search is not None:
-                item["enable_web_search"] = payload.enable_web_search
-            found = True
-            break
-    if not found:
-        new_item: dict = {"user_id": user.id, "api_key": api_key}
-        if payload.enable_utcp is not None:
-            new_item["enable_utcp"] = payload.enable_utcp
-        if payload.enable_web_search is not None:
-            new_item["enable_web_search"] = payload.enable_web_search
-        settings_list.append(new_item)
-
-    json_store.save_settings(settings_list)
-    users = json_store.load_users()
-    for u in users:
-        if u.get("id") == user.id:
-            u["api_key"] = api_key
-            break
-    json_store.save_users(users)
+    fields: dict = {"api_key": api_key}
+    if payload.enable_utcp is not None:
+        fields["enable_utcp"] = payload.enable_utcp
+    if payload.enable_web_search is not None:
+        fields["enable_web_search"] = payload.enable_web_search
+    if payload.enable_tool_cache is not None:
+        fields["enable_tool_cache"] = payload.enable_tool_cache
+    if payload.enable_shell_session is not None:
+        fields["enable_shell_session"] = payload.enable_shell_session
+    if payload.model_provider is not None:
+        if payload.model_provider in model_provider.available_providers():
+            fields["model_provider"] = payload.model_provider
+        else:
+            # 旧页面提交回已保存但现已不可用的值时保留原设置（按回退规则使用），不阻止保存其他设置
+            item = json_store.get_user_settings(user.id)
+            if payload.model_provider != (item or {}).get("model_provider"):
+                raise HTTPException(status_code=400, detail="不支持的模型服务提供方")
+    json_store.update_user_settings(user.id, fields)
+    json_store.update_user(user.id, {"api_key": api_key})
 
     return {"status": "ok"}
+
+
+@router.get("/usage")
+async def get_my_usage(
+    group_by: str = Query("conversation", pattern="^(conversation|day)$"),
+    since: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    until: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),
+    limit: int = Query(50, ge=1, le=1000),
+    user: User = Depends(get_current_user),
+):
+    """当前用户的用量汇总（按会话或日期，UTC），按 token 总数降序。"""
+    items = await asyncio.to_thread(usage_ledger.aggregate, group_by, user.id, since, until, limit)
+    return {"group_by": group_by, "items": items}
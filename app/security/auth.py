@@ -28,10 +28,6 @@ def verify_password(plain: str, password_hash: str) -> bool:
 
 def ensure_default_admin() -> None:
     settings = get_settings()
-    users = json_store.load_users()
-    if users:
-        return
-
     admin_user = User(
         id=str(uuid.uuid4()),
         username=settings.default_admin_username,
@@ -39,19 +35,17 @@ def ensure_default_admin() -> None:
         email=None,
         api_key=None,
     )
-    users.append(admin_user.model_dump())
-    json_store.save_users(users)
+    if not json_store.create_user_if_none(admin_user.model_dump()):
+        return
     logger.info("Default admin user created: %s", settings.default_admin_username)
 
 
 def authenticate_user(username: str, password: str) -> Optional[User]:
-    users = json_store.load_users()
-    for u in users:
-        if u.get("username") == username:
-            user = User(**u)
-            if verify_password(password, user.password_hash):
-                return user
-            break
+    raw = json_store.get_user_by_username(username)
+    if raw:
+        user = User(**raw)
+        if verify_password(password, user.password_hash):
+            return user
     return None
 
 
@@ -60,14 +54,21 @@ def get_current_user(request: Request) -> User:
     if not user_id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
 
-    users = json_store.load_users()
-    for u in users:
-        if u.get("id") == user_id:
-            return User(**u)
+    raw = json_store.get_user_by_id(user_id)
+    if raw:
+        return User(**raw)
 
     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
 
 
+def get_admin_user(request: Request) -> User:
+    """仅允许管理员账号（DEFAULT_ADMIN_USERNAME）访问，用于返回跨用户数据的接口。"""
+    user = get_current_user(request)
+    if user.username != get_settings().default_admin_username:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin only")
+    return user
+
+
 def login_user(request: Request, user: User) -> None:
     request.session[SESSION_USER_KEY] = user.id
 
@@ -0,0 +1,357 @@
+"""
+模型调用的准入控制（按 API Key 隔离）：
+
+- 并发上限：每个 Key 同时进行的模型调用数不超过 MODEL_MAX_CONCURRENCY；
+- 公平排队：超出并发的请求按用户轮转排队（同一用户内先来先服务），
+  避免单个用户的大量请求挤占其他用户；排队期间向调用方报告当前位置；
+- 令牌桶限速：每个 Key 每秒发起的调用数不超过 MODEL_RATE_PER_SEC（允许 MODEL_RATE_BURST 的突发）；
+- 重试：限流（429 / Throttling）与临时错误（5xx、连接失败、超时）按带抖动的指数退避重试，
+  流式调用一旦已收到内容则不再重试，避免重复输出；
+- 熔断：上游连续 MODEL_BREAKER_THRESHOLD 次临时错误后熔断 MODEL_BREAKER_COOLDOWN 秒，
+  期间直接失败；冷却结束后放行一个试探请求，成功即恢复。
+
+只在单个事件循环内使用（uvicorn 每个 worker 一个事件循环），多 worker 时各自独立计数。
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import random
+import time
+from collections import deque
+from contextlib import aclosing
+from http import HTTPStatus
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, TypeVar, Union
+
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_RETRY_CAP_SECONDS = 10.0
+# 排队期间即使位置不变也定期报告一次，调用方可借此检查打断
+_QUEUE_REPORT_INTERVAL = 1.0
+
+
+class ModelCallError(Exception):
+    """模型服务返回的错误；retryable 表示可重试，throttled 表示被限流。"""
+
+    def __init__(self, status: int, code: str = "", message: str = "") -> None:
+        super().__init__(f"model service returned {status}: {code} {message}".strip())
+        self.status = status
+        self.code = code or ""
+        self.message = message or ""
+
+    @property
+    def throttled(self) -> bool:
+        return self.status == HTTPStatus.TOO_MANY_REQUESTS or self.code.startswith("Throttling")
+
+    @property
+    def retryable(self) -> bool:
+        return self.throttled or self.status >= 500
+
+
+class CircuitOpenError(Exception):
+    """上游处于熔断状态，请求未发出即失败。"""
+
+
+class QueuePosition(int):
+    """排队位置（1 表示下一个获得调用名额）。"""
+
+
+def _is_transient(exc: BaseException) -> bool:
+    if isinstance(exc, ModelCallError):
+        return exc.status >= 500
+    # 连接失败与超时：aiohttp.ClientError / httpx.TransportError 按类名识别，避免在此导入具体的 HTTP 库
+    names = {cls.__name__ for cls in type(exc).__mro__}
+    return bool(names & {"ClientError", "TransportError", "TimeoutError", "ConnectionError"})
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, ModelCallError):
+        return exc.retryable
+    return _is_transient(exc)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """取走一个令牌，返回需要等待的秒数（令牌不足时预支，等待到补足为止）。"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown: float) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def check(self) -> None:
+        state = self.state
+        if state == "open" or (state == "half-open" and self._probing):
+            raise CircuitOpenError("model service circuit is open")
+        if state == "half-open":
+            self._probing = True
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            # 半开状态下的试探失败同样重新计时
+            if self.opened_at is None:
+                logger.warning("Model service circuit opened after %d consecutive failures", self.failures)
+            self.opened_at = time.monotonic()
+
+    def release_probe(self) -> None:
+        self._probing = False
+
+
+class _Ticket:
+    def __init__(self, limiter: "KeyLimiter", user_id: str) -> None:
+        self.limiter = limiter
+        self.user_id = user_id
+        self.granted = False
+        self.released = False
+        self.position = 0
+        self.changed = asyncio.Event()
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.limiter._release(self)
+
+
+class KeyLimiter:
+    def __init__(self, concurrency: int, rate: float, burst: int) -> None:
+        self.concurrency = max(1, concurrency)
+        self.bucket = TokenBucket(rate, burst)
+        self.active = 0
+        self._queues: Dict[str, Deque[_Ticket]] = {}
+        self._rotation: Deque[str] = deque()
+        self.admitted = 0
+        self.queued = 0
+        self.retries = 0
+        self.failures = 0
+
+    def enqueue(self, user_id: str) -> _Ticket:
+        ticket = _Ticket(self, user_id)
+        if user_id not in self._queues:
+            self._queues[user_id] = deque()
+            self._rotation.append(user_id)
+        self._queues[user_id].append(ticket)
+        self._dispatch()
+        if not ticket.granted:
+            self.queued += 1
+        return ticket
+
+    def waiting(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def _ordered(self) -> List[_Ticket]:
+        """按轮转顺序展开全部等待者，即它们将获得名额的顺序。"""
+        queues = [list(self._queues[u]) for u in self._rotation]
+        order: List[_Ticket] = []
+        depth = 0
+        while True:
+            row = [q[depth] for q in queues if depth < len(q)]
+            if not row:
+                return order
+            order.extend(row)
+            depth += 1
+
+    def _dispatch(self) -> None:
+        while self.active < self.concurrency and self._rotation:
+            user_id = self._rotation.popleft()
+            queue = self._queues[user_id]
+            ticket = queue.popleft()
+            if queue:
+                self._rotation.append(user_id)
+            else:
+                del self._queues[user_id]
+            ticket.granted = True
+            ticket.changed.set()
+            self.active += 1
+            self.admitted += 1
+        for position, ticket in enumerate(self._ordered(), start=1):
+            if ticket.position != position:
+                ticket.position = position
+                ticket.changed.set()
+
+    def _release(self, ticket: _Ticket) -> None:
+        if ticket.granted:
+            self.active -= 1
+        else:
+            queue = self._queues.get(ticket.user_id)
+            if queue is not None and ticket in queue:
+                queue.remove(ticket)
+                if not queue:
+                    del self._queues[ticket.user_id]
+                    self._rotation.remove(ticket.user_id)
+        self._dispatch()
+
+
+_limiters: Dict[str, KeyLimiter] = {}
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def _key_id(api_key: str) -> str:
+    return hashlib.sha1(api_key.encode("utf-8")).hexdigest()[:12]
+
+
+def _get_limiter(api_key: str) -> KeyLimiter:
+    key = _key_id(api_key)
+    limiter = _limiters.get(key)
+    if limiter is None:
+        settings = get_settings()
+        limiter = _limiters[key] = KeyLimiter(
+            settings.model_max_concurrency, settings.model_rate_per_sec, settings.model_rate_burst
+        )
+    return limiter
+
+
+def _get_breaker(upstream: str) -> CircuitBreaker:
+    breaker = _breakers.get(upstream)
+    if breaker is None:
+        settings = get_settings()
+        breaker = _breakers[upstream] = CircuitBreaker(
+            settings.model_breaker_threshold, settings.model_breaker_cooldown_sec
+        )
+    return breaker
+
+
+def _backoff(attempt: int) -> float:
+    """第 attempt 次重试前的等待：指数增长，上限 10 秒，取 [0, 上限] 内的随机值（full jitter）。"""
+    base = get_settings().model_retry_base_ms / 1000
+    return random.uniform(0, min(_RETRY_CAP_SECONDS, base * (2**attempt)))
+
+
+async def _wait_turn(ticket: _Ticket) -> AsyncIterator[QueuePosition]:
+    while True:
+        ticket.changed.clear()
+        if ticket.granted:
+            return
+        yield QueuePosition(ticket.position)
+        try:
+            await asyncio.wait_for(ticket.changed.wait(), timeout=_QUEUE_REPORT_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def guarded_stream(
+    api_key: str,
+    user_id: str,
+    open_stream: Callable[[], AsyncIterator[T]],
+    upstream: str = "dashscope",
+) -> AsyncIterator[Union[QueuePosition, T]]:
+    """
+    在准入控制下发起一次流式调用：排队期间产出 QueuePosition，获得名额后产出上游的每个分块。
+    open_stream 为异步生成器函数，每次调用发起一次新请求（用于重试），上游错误应在其中抛出；
+    分块已开始下发后的错误不再重试。调用方提前结束迭代时须 aclose()，以便及时归还名额。
+    """
+    limiter = _get_limiter(api_key)
+    breaker = _get_breaker(upstream)
+    attempt = 0
+    while True:
+        ticket = limiter.enqueue(user_id)
+        delay = 0.0
+        try:
+            async for position in _wait_turn(ticket):
+                yield position
+            breaker.check()
+            wait = limiter.bucket.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            received = False
+            chunks = open_stream()
+            try:
+                async for item in chunks:
+                    received = True
+                    yield item
+            except Exception as exc:
+                if _is_transient(exc):
+                    breaker.record_failure()
+                limiter.failures += 1
+                if received or not _is_retryable(exc) or attempt >= get_settings().model_max_retries:
+                    raise
+                delay = _backoff(attempt)
+                attempt += 1
+                limiter.retries += 1
+                logger.warning("Model call failed (%s), retry %d in %.2fs", exc, attempt, delay)
+            else:
+                breaker.record_success()
+                return
+            finally:
+                # 试探请求被打断或以非临时错误结束时，允许下一个请求继续试探
+                breaker.release_probe()
+                await chunks.aclose()
+        finally:
+            ticket.release()
+        # 退避期间不占用并发名额
+        await asyncio.sleep(delay)
+
+
+async def guarded_call(
+    api_key: str,
+    user_id: str,
+    call: Callable[[], Awaitable[T]],
+    upstream: str = "dashscope",
+) -> T:
+    """非流式调用的准入控制（排队位置不对外报告）。"""
+
+    async def open_stream() -> AsyncIterator[T]:
+        yield await call()
+
+    # 拿到结果即提前返回，须关闭生成器以立即归还名额、结束熔断试探
+    async with aclosing(guarded_stream(api_key, user_id, open_stream, upstream)) as items:
+        async for item in items:
+            if not isinstance(item, QueuePosition):
+                return item
+    raise RuntimeError("model call returned no result")
+
+
+def stats() -> dict:
+    return {
+        "keys": {
+            key: {
+                "active": limiter.active,
+                "waiting": limiter.waiting(),
+                "admitted": limiter.admitted,
+                "queued": limiter.queued,
+                "retries": limiter.retries,
+                "failures": limiter.failures,
+            }
+            for key, limiter in _limiters.items()
+        },
+        "breakers": {
+            name: {"state": breaker.state, "consecutive_failures": breaker.failures}
+            for name, breaker in _breakers.items()
+        },
+    }
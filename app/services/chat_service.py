@@ -1,29 +1,60 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import logging
+import time
 import uuid
-from typing import Dict, Iterable, List, Optional
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional
 
 from app.config import get_settings
-from app.models.schemas import ChatMessage, Conversation, User
-from app.storage import json_store
-from app.services import dashscope_client
+from app.models.schemas import ChatMessage, Conversation, ConversationSummary, UsageRecord, User
+from app.storage import json_store, search_index, usage_ledger
+from app.services import context_manager, dashscope_client, model_provider, shell_session, tool_cache
+from app.utils import metrics
 
 logger = logging.getLogger(__name__)
 
-_interrupt_flags: Dict[str, bool] = {}
+INTERRUPT_DIR = json_store.DATA_DIR / "interrupts"
+
+
+def _interrupt_marker(request_id: str) -> Path:
+    return INTERRUPT_DIR / hashlib.sha1(request_id.encode("utf-8")).hexdigest()
+
+
+class _InterruptFlags(dict):
+    """
+    request_id -> 是否已请求打断。多 worker 部署时打断请求可能落到另一个进程，
+    因此 interrupt_request 同时写入标记文件；本进程未置位时再检查标记文件。
+    """
+
+    def get(self, key, default=None):
+        value = super().get(key, default)
+        if value or key not in self or get_settings().web_workers <= 1:
+            return value
+        if _interrupt_marker(key).exists():
+            self[key] = True
+            return True
+        return value
+
+    def pop(self, key, default=None):
+        if get_settings().web_workers > 1:
+            _interrupt_marker(key).unlink(missing_ok=True)
+        return super().pop(key, default)
+
+
+_interrupt_flags: Dict[str, bool] = _InterruptFlags()
 
 
 def create_conversation_if_needed(user: User) -> Conversation:
     """若用户尚无任何会话则创建一个并返回，否则返回其第一个会话（用于默认进入页）。"""
-    conversations = [Conversation(**c) for c in json_store.load_conversations()]
-    for conv in conversations:
-        if conv.user_id == user.id:
-            return conv
+    existing = json_store.list_user_conversations(user.id)
+    if existing:
+        return min((Conversation(**c) for c in existing), key=lambda c: c.created_at)
 
     conv = Conversation(id=str(uuid.uuid4()), user_id=user.id, title="默认会话")
-    conversations.append(conv)
-    json_store.save_conversations([c.model_dump(mode="json") for c in conversations])
+    json_store.add_conversation(conv.model_dump(mode="json"))
     return conv
 
 
@@ -38,69 +69,129 @@ def create_new_conversation(user: User) -> Conversation:
         created_at=datetime.utcnow(),
         updated_at=datetime.utcnow(),
     )
-    raw = json_store.load_conversations()
-    raw.append(conv.model_dump(mode="json"))
-    json_store.save_conversations(raw)
+    json_store.add_conversation(conv.model_dump(mode="json"))
     return conv
 
 
-def append_message(message: ChatMessage) -> None:
-    messages = json_store.load_messages()
-    messages.append(message.model_dump(mode="json"))
-    json_store.save_messages(messages)
-
-    conversations = [Conversation(**c) for c in json_store.load_conversations()]
-    for conv in conversations:
-        if conv.id == message.conversation_id:
-            conv.message_ids.append(message.id)
-            conv.updated_at = message.created_at
-            break
-    json_store.save_conversations([c.model_dump(mode="json") for c in conversations])
+def append_message(message: ChatMessage, durable: bool = False) -> None:
+    """保存消息并刷新会话；durable=True 时等到写入落盘后再返回。"""
+    record = message.model_dump(mode="json")
+    json_store.append_message(record, durable)
+    json_store.touch_conversation(
+        message.conversation_id, message.user_id, message.id, record["created_at"], durable
+    )
+    search_index.index_message(record)
 
 
 def get_conversation_by_id(conversation_id: str, user_id: str) -> Optional[Conversation]:
     """获取指定会话（仅当属于该用户时返回）。"""
-    raw = json_store.load_conversations()
-    for c in raw:
-        if c.get("id") == conversation_id and c.get("user_id") == user_id:
-            return Conversation(**c)
+    raw = json_store.get_conversation(conversation_id)
+    if raw and raw.get("user_id") == user_id:
+        return Conversation(**raw)
     return None
 
 
-def list_conversations_for_user(user_id: str) -> List[Conversation]:
-    """返回某用户的会话列表（按更新时间倒序），供左侧历史栏使用。"""
-    raw = json_store.load_conversations()
-    convs = [Conversation(**c) for c in raw if c.get("user_id") == user_id]
-    convs.sort(key=lambda c: c.updated_at, reverse=True)
-    return convs
+def list_conversations_for_user(user_id: str) -> List[ConversationSummary]:
+    """返回某用户的会话摘要列表（按更新时间倒序），供左侧历史栏使用；只读取该用户的摘要索引。"""
+    return [ConversationSummary(**c) for c in json_store.list_conversation_summaries(user_id)]
 
 
 def delete_conversation(conversation_id: str, user_id: str) -> bool:
     """删除指定会话（仅当属于该用户时）。同时从 messages 中移除该会话的消息。返回是否删除成功。"""
-    raw_conv = json_store.load_conversations()
-    new_conv = [c for c in raw_conv if not (c.get("id") == conversation_id and c.get("user_id") == user_id)]
-    if len(new_conv) == len(raw_conv):
-        return False
-    json_store.save_conversations(new_conv)
-    messages = json_store.load_messages()
-    new_messages = [m for m in messages if m.get("conversation_id") != conversation_id]
-    json_store.save_messages(new_messages)
-    return True
-
-
-def list_messages(conversation_id: str) -> List[ChatMessage]:
-    messages = [ChatMessage(**m) for m in json_store.load_messages() if m.get("conversation_id") == conversation_id]
-    return messages
-
-
-def stream_model_reply(
+    deleted = json_store.delete_conversation(conversation_id, user_id)
+    if deleted:
+        search_index.forget_conversation(conversation_id)
+        tool_cache.forget_conversation(conversation_id)
+        shell_session.close(conversation_id)
+    return deleted
+
+
+def _snippet(content: str, query: str, width: int = 60) -> str:
+    """截取内容中第一个命中查询词附近的片段。"""
+    lowered = content.lower()
+    positions = [lowered.find(t) for t in search_index.tokenize(query)]
+    pos = min((p for p in positions if p >= 0), default=0)
+    start = max(0, pos - width)
+    end = min(len(content), pos + width * 2)
+    return ("…" if start else "") + content[start:end] + ("…" if end < len(content) else "")
+
+
+def search_history(user_id: str, query: str, limit: int = 20) -> dict:
+    """
+    在该用户的全部会话中全文检索，返回命中的消息（按相关度）以及按会话聚合的结果
+    （会话得分取其命中消息得分之和）。
+    """
+    summaries = {c["id"]: c for c in json_store.list_conversation_summaries(user_id)}
+    hits = search_index.search(query, set(summaries), limit)
+
+    wanted: Dict[str, set] = {}
+    for _, message_id, conversation_id in hits:
+        wanted.setdefault(conversation_id, set()).add(message_id)
+    # 只按 id 读取命中的消息：不把已归档的会话放回热数据，也不加载整个会话
+    found = json_store.find_messages(wanted)
+
+    messages: List[dict] = []
+    conversations: Dict[str, dict] = {}
+    for score, message_id, conversation_id in hits:
+        m = found.get(message_id)
+        if m is None:
+            continue
+        messages.append(
+            {
+                "id": message_id,
+                "conversation_id": conversation_id,
+                "role": m.get("role"),
+                "created_at": m.get("created_at"),
+                "snippet": _snippet(m.get("content") or "", query),
+                "score": round(score, 4),
+            }
+        )
+        summary = summaries[conversation_id]
+        conv = conversations.setdefault(
+            conversation_id,
+            {
+                "id": conversation_id,
+                "title": summary.get("title"),
+                "updated_at": summary.get("updated_at"),
+                "score": 0.0,
+                "hits": 0,
+            },
+        )
+        conv["score"] = round(conv["score"] + score, 4)
+        conv["hits"] += 1
+    ranked = sorted(conversations.values(), key=lambda c: c["score"], reverse=True)
+    return {"conversations": ranked, "messages": messages}
+
+
+def list_messages(
+    conversation_id: str, limit: Optional[int] = None, before: Optional[str] = None
+) -> List[ChatMessage]:
+    """按时间顺序返回会话消息；before 为消息 id 游标，limit 为只取游标之前最新的若干条。"""
+    return [ChatMessage(**m) for m in json_store.load_conversation_messages(conversation_id, limit, before)]
+
+
+def list_messages_page(
+    conversation_id: str, limit: int, before: Optional[str] = None
+) -> tuple[List[ChatMessage], bool]:
+    """分页读取历史消息，返回 (本页消息, 是否还有更早的消息)。"""
+    messages = list_messages(conversation_id, limit=limit + 1, before=before)
+    has_more = len(messages) > limit
+    return messages[-limit:] if has_more else messages, has_more
+
+
+async def stream_model_reply(
     user: User,
     conversation: Conversation,
     user_content: str,
     files: Optional[List[str]],
     request_id: str,
-) -> Iterable[str]:
+) -> AsyncIterator[str]:
+    """
+    异步流式生成助手回复：在事件循环中直接消费模型的异步流，不占用额外线程；
+    存储读写在线程中执行，结束（含打断、客户端断开）时持久化已生成的回复。
+    """
     logger.debug("Starting model reply stream, request_id=%s", request_id)
+    started = time.perf_counter()
     _interrupt_flags[request_id] = False
 
     user_msg = ChatMessage(
@@ -111,29 +202,61 @@ def stream_model_reply(
         content=user_content,
         files=files or [],
     )
-    history = list_messages(conversation.id)
-    append_message(user_msg)
-    enable_utcp, enable_web_search = _get_user_feature_flags(user.id)
+    history = await asyncio.to_thread(list_messages, conversation.id)
+    await asyncio.to_thread(append_message, user_msg)
+    enable_utcp, enable_web_search, enable_tool_cache, enable_shell_session = await asyncio.to_thread(
+        _get_user_feature_flags, user.id
+    )
+    provider = model_provider.get_provider(await asyncio.to_thread(_get_user_provider_name, user.id))
+    api_key = _get_user_api_key(user)
+    window = context_manager.ContextWindow(history, conversation.context_summary)
 
     full_reply: List[str] = []
+    first_output = True
+    completed = False
+    usage = UsageRecord(
+        user_id=user.id, conversation_id=conversation.id, provider=provider.name, model=provider.model_name()
+    )
+    metrics.CHAT_TURNS.inc()
+    metrics.CHAT_ACTIVE_STREAMS.inc()
     try:
-        for chunk in dashscope_client.stream_chat_with_tools(
+        async for chunk in dashscope_client.stream_chat_with_tools(
             history=history,
             user_message=user_msg,
-            api_key_override=_get_user_api_key(user),
+            api_key_override=api_key,
             request_id=request_id,
             interrupt_flags=_interrupt_flags,
             enable_utcp=enable_utcp,
             enable_web_search=enable_web_search,
+            context=window,
+            provider=provider,
+            enable_tool_cache=enable_tool_cache,
+            enable_shell_session=enable_shell_session,
+            usage=usage,
         ):
-            if _interrupt_flags.get(request_id):
-                logger.info("Interrupted model streaming, request_id=%s", request_id)
-                break
-            full_reply.append(chunk)
+            # 打断后不在此处截断：dashscope_client 会停止模型输出，并送出被终止命令中断前的部分输出
+            if not isinstance(chunk, dashscope_client.ControlChunk):
+                if first_output:
+                    first_output = False
+                    elapsed = time.perf_counter() - started
+                    metrics.CHAT_FIRST_OUTPUT_SECONDS.observe(elapsed)
+                    usage.first_output_ms = int(elapsed * 1000)
+                full_reply.append(chunk)
             yield chunk
+        completed = True
+        context_manager.schedule_summary_refresh(conversation.id, window, api_key, provider)
     finally:
+        metrics.CHAT_ACTIVE_STREAMS.dec()
+        interrupted = _interrupt_flags.get(request_id)
         _interrupt_flags.pop(request_id, None)
-        # 流式结束后将完整助手回复持久化
+        if interrupted:
+            logger.info("Interrupted model streaming, request_id=%s", request_id)
+            metrics.CHAT_INTERRUPTS.inc(reason="user")
+            usage.status = "interrupted"
+        elif not completed:
+            metrics.CHAT_INTERRUPTS.inc(reason="disconnect")
+            usage.status = "disconnected"
+        assistant_msg = None
         if full_reply:
             assistant_msg = ChatMessage(
                 id=str(uuid.uuid4()),
@@ -143,30 +266,69 @@ def stream_model_reply(
                 content="".join(full_reply),
                 files=[],
             )
-            append_message(assistant_msg)
+        # 用量与完整助手回复在线程中写入，不阻塞事件循环。客户端断开时生成器所在的任务已被取消，
+        # 等待可能再次被取消：写入以 shield 保护，在线程中照常完成，只是不再等待其结束
+        persist = asyncio.ensure_future(asyncio.to_thread(_persist_reply, usage, started, assistant_msg))
+        try:
+            await asyncio.shield(persist)
+        except asyncio.CancelledError:
+            logger.debug("Stream cancelled while persisting reply, request_id=%s", request_id)
+
+
+def _persist_reply(usage: UsageRecord, started: float, assistant_msg: Optional[ChatMessage]) -> None:
+    _record_usage(usage, started)
+    if assistant_msg is not None:
+        append_message(assistant_msg)
+
+
+def _record_usage(usage: UsageRecord, started: float) -> None:
+    """把本次回复的用量写入账本；没有发生模型调用（如未配置 API Key）时不记录。"""
+    if not usage.rounds:
+        return
+    usage.total_ms = int((time.perf_counter() - started) * 1000)
+    try:
+        usage_ledger.append(usage)
+    except OSError:
+        logger.exception("Failed to append usage record for conversation %s", usage.conversation_id)
 
 
 def interrupt_request(request_id: str) -> None:
     logger.debug("Set interrupt flag for request_id=%s", request_id)
     _interrupt_flags[request_id] = True
+    if get_settings().web_workers > 1:
+        INTERRUPT_DIR.mkdir(parents=True, exist_ok=True)
+        _interrupt_marker(request_id).touch()
 
 
 def _get_user_api_key(user: User) -> Optional[str]:
-    if user.api_key:
-        return user.api_key
-    settings = get_settings()
-    return settings.dashscope_api_key
-
-
-def _get_user_feature_flags(user_id: str) -> tuple[bool, bool]:
-    """从用户设置中读取 enable_utcp、enable_web_search，缺省为 True。"""
-    for item in json_store.load_settings():
-        if item.get("user_id") == user_id:
-            enable_utcp = item.get("enable_utcp")
-            enable_web_search = item.get("enable_web_search")
-            return (
-                enable_utcp if isinstance(enable_utcp, bool) else True,
-                enable_web_search if isinstance(enable_web_search, bool) else True,
-            )
-    return True, True
+    """用户在设置页填写的 API Key；未填写时由提供方的 resolve_api_key 使用各自的默认 Key。"""
+    return user.api_key or None
+
+
+def _get_user_provider_name(user_id: str) -> Optional[str]:
+    """用户设置中选择的模型服务提供方；未选择时返回 None（使用 MODEL_PROVIDER）。"""
+    item = json_store.get_user_settings(user_id)
+    if item is None:
+        return None
+    name = item.get("model_provider")
+    return name if isinstance(name, str) and name else None
+
+
+def _get_user_feature_flags(user_id: str) -> tuple[bool, bool, bool, bool]:
+    """
+    从用户设置中读取 enable_utcp、enable_web_search（缺省为 True）
+    与 enable_tool_cache、enable_shell_session（缺省为 False）。
+    """
+    item = json_store.get_user_settings(user_id)
+    if item is None:
+        return True, True, False, False
+    enable_utcp = item.get("enable_utcp")
+    enable_web_search = item.get("enable_web_search")
+    enable_tool_cache = item.get("enable_tool_cache")
+    return (
+        enable_utcp if isinstance(enable_utcp, bool) else True,
+        enable_web_search if isinstance(enable_web_search, bool) else True,
+        enable_tool_cache is True,
+        item.get("enable_shell_session") is True,
+    )
 
@@ -0,0 +1,213 @@
+"""
+对话上下文窗口：按近似 token 数在预算（CONTEXT_TOKEN_BUDGET）内组装发给模型的消息。
+
+- 以“轮”为单位取舍（一轮 = 一条 user 消息及其后的 assistant / tool 消息），不拆散工具调用；
+- 最近 CONTEXT_KEEP_TURNS 轮原样保留，更早轮次中超过 CONTEXT_ELIDE_CHARS 的 Shell 输出只保留首尾；
+- 仍超出预算时从最早的轮次开始丢弃；开启 CONTEXT_SUMMARY 时，被丢弃的轮次在回复结束后
+  折叠进会话的滚动摘要（会话记录的 context_summary 字段），之后作为 system 消息放在最前。
+
+token 数为估算值：中日韩字符按 1 个 token，其余字符按 4 个字符 1 个 token。
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import re
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set
+
+from app.config import get_settings
+from app.models.schemas import ChatMessage
+from app.storage import json_store
+
+if TYPE_CHECKING:
+    from app.services.model_provider import ModelProvider
+
+logger = logging.getLogger(__name__)
+
+_CJK = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+_SHELL_OUTPUT = re.compile(r"(\[Shell 输出[^\]\n]*\]\n)(.*?)(\n*\[Shell 输出结束\])", re.S)
+
+# 每条消息的固定开销（角色、分隔符等）
+_MESSAGE_OVERHEAD = 4
+
+SUMMARY_PREFIX = "以下是本会话更早部分的摘要（原文已省略）：\n"
+
+_refreshing: Set[str] = set()
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_tokens(message: Dict[str, Any]) -> int:
+    tokens = _MESSAGE_OVERHEAD + estimate_tokens(message.get("content") or "")
+    if message.get("tool_calls"):
+        tokens += estimate_tokens(json.dumps(message["tool_calls"], ensure_ascii=False))
+    return tokens
+
+
+def elide(text: str, max_chars: int) -> str:
+    """长文本只保留首尾各一半，中间替换为省略说明。"""
+    if len(text) <= max_chars:
+        return text
+    half = max_chars // 2
+    return f"{text[:half]}\n…[已省略 {len(text) - 2 * half} 个字符]…\n{text[-half:]}"
+
+
+def elide_tool_output(message: Dict[str, Any], max_chars: int) -> Dict[str, Any]:
+    """压缩旧消息中的工具输出：tool 消息整体压缩，assistant 消息中只压缩 Shell 输出段。"""
+    content = message.get("content") or ""
+    if message.get("role") == "tool":
+        compact = elide(content, max_chars)
+    elif "[Shell 输出" in content:
+        compact = _SHELL_OUTPUT.sub(lambda m: m.group(1) + elide(m.group(2), max_chars) + m.group(3), content)
+    else:
+        return message
+    return {**message, "content": compact}
+
+
+def message_to_api(m: ChatMessage) -> Dict[str, Any]:
+    """将 ChatMessage 转为模型 API 消息格式。"""
+    msg: Dict[str, Any] = {"role": m.role, "content": m.content or ""}
+    if m.role == "assistant" and m.tool_calls:
+        msg["tool_calls"] = m.tool_calls
+    if m.role == "tool" and m.tool_call_id:
+        msg["tool_call_id"] = m.tool_call_id
+    return msg
+
+
+class _Turn:
+    def __init__(self, messages: List[ChatMessage]) -> None:
+        self.messages = messages
+        self.api = [message_to_api(m) for m in messages]
+        self._elided: Optional[List[Dict[str, Any]]] = None
+        self.tokens = sum(message_tokens(m) for m in self.api)
+        self.elided_tokens = self.tokens
+
+    def elided(self, max_chars: int) -> List[Dict[str, Any]]:
+        if self._elided is None:
+            self._elided = [elide_tool_output(m, max_chars) for m in self.api]
+            self.elided_tokens = sum(message_tokens(m) for m in self._elided)
+        return self._elided
+
+
+def _split_turns(history: List[ChatMessage]) -> List[_Turn]:
+    turns: List[List[ChatMessage]] = []
+    for m in history:
+        if m.role == "user" or not turns:
+            turns.append([])
+        turns[-1].append(m)
+    return [_Turn(t) for t in turns]
+
+
+class ContextWindow:
+    """
+    为一次回复（可能包含多轮工具调用）组装上下文：build() 每轮调用一次，
+    传入本次回复进行中的消息（当前 user 消息及其后的 assistant / tool 消息），始终原样保留。
+    """
+
+    def __init__(
+        self,
+        history: List[ChatMessage],
+        summary: Optional[dict] = None,
+        budget: Optional[int] = None,
+        keep_turns: Optional[int] = None,
+        elide_chars: Optional[int] = None,
+    ) -> None:
+        settings = get_settings()
+        self.budget = budget if budget is not None else settings.context_token_budget
+        self.keep_turns = keep_turns if keep_turns is not None else settings.context_keep_turns
+        self.elide_chars = elide_chars if elide_chars is not None else settings.context_elide_chars
+        self.summary = summary if summary and summary.get("text") else None
+        covered = 0
+        if self.summary:
+            ids = [m.id for m in history]
+            upto = self.summary.get("upto")
+            if upto in ids:
+                covered = ids.index(upto) + 1
+            else:
+                # 摘要覆盖的消息已不存在（如历史被改写），摘要作废
+                self.summary = None
+        # 已折叠进摘要的消息不再逐条发送
+        self._turns = _split_turns(history[covered:])
+        self.dropped: List[ChatMessage] = []
+
+    def build(self, current: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        prefix: List[Dict[str, Any]] = []
+        if self.summary:
+            prefix.append({"role": "system", "content": SUMMARY_PREFIX + self.summary["text"]})
+        remaining = self.budget - sum(message_tokens(m) for m in prefix + current)
+
+        chosen: List[List[Dict[str, Any]]] = []
+        for age, turn in enumerate(reversed(self._turns)):
+            if age < self.keep_turns and turn.tokens <= remaining:
+                version, cost = turn.api, turn.tokens
+            else:
+                version = turn.elided(self.elide_chars)
+                cost = turn.elided_tokens
+            if cost > remaining and chosen:
+                break
+            # 最近一轮即使压缩后仍超预算也保留，否则模型看不到上一轮对话
+            chosen.append(version)
+            remaining -= cost
+        self.dropped = [m for turn in self._turns[: len(self._turns) - len(chosen)] for m in turn.messages]
+        if self.dropped:
+            logger.debug("Context budget %d: dropped %d old messages", self.budget, len(self.dropped))
+        return prefix + [m for version in reversed(chosen) for m in version] + current
+
+
+def schedule_summary_refresh(
+    conversation_id: str,
+    window: ContextWindow,
+    api_key: Optional[str],
+    provider: Optional["ModelProvider"] = None,
+) -> None:
+    """CONTEXT_SUMMARY 开启且本次有轮次因超预算被丢弃时，后台用同一提供方把它们折叠进滚动摘要。"""
+    if not get_settings().context_summary or not window.dropped:
+        return
+    if conversation_id in _refreshing:
+        return
+    _refreshing.add(conversation_id)
+    task = asyncio.get_running_loop().create_task(
+        _refresh_summary(conversation_id, window.summary, window.dropped, window.elide_chars, api_key, provider)
+    )
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _refresh_summary(
+    conversation_id: str,
+    previous: Optional[dict],
+    dropped: List[ChatMessage],
+    elide_chars: int,
+    api_key: Optional[str],
+    provider: Optional["ModelProvider"],
+) -> None:
+    from app.services import dashscope_client
+
+    try:
+        parts: List[str] = []
+        if previous:
+            parts.append(f"【已有摘要】\n{previous['text']}")
+        parts.append("【需要并入摘要的对话】")
+        for m in dropped:
+            content = elide_tool_output(message_to_api(m), elide_chars)["content"]
+            parts.append(f"{m.role}: {content}")
+        # 首次折叠时丢弃的轮次可能很多，送去摘要的原文同样受预算限制
+        prompt = elide("\n\n".join(parts), get_settings().context_token_budget * 2)
+        text = await dashscope_client.summarize(prompt, api_key, provider)
+        if not text:
+            return
+        summary = {"text": text, "upto": dropped[-1].id, "updated_at": datetime.utcnow().isoformat()}
+        await asyncio.to_thread(json_store.update_conversation, conversation_id, {"context_summary": summary})
+        logger.info("Folded %d messages into context summary of %s", len(dropped), conversation_id)
+    except Exception:  # noqa: BLE001
+        logger.exception("Refreshing context summary failed for %s", conversation_id)
+    finally:
+        _refreshing.discard(conversation_id)
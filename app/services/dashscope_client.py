@@ -1,19 +1,29 @@
 from __future__ import annotations
 
+import asyncio
+import functools
+import hashlib
 import json
 import logging
+import threading
 import time
-from pathlib import Path
-from typing import Any, Dict, Iterable, List, Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterable, List, Optional, Tuple, TypeVar
 
 from dashscope import Generation
 
-from app.models.schemas import ChatMessage
+from app.config import get_settings
+from app.models.schemas import ChatMessage, UsageRecord
+from app.services import admission
+from app.services.admission import CircuitOpenError, ModelCallError
+from app.services.context_manager import ContextWindow
+from app.services.model_provider import ModelProvider, extract_text, get_provider
+from app.utils import metrics, tracing
 
 logger = logging.getLogger(__name__)
 
-
-MODEL_NAME = "qwen3-max"  # 多模态模型，占位，需与百炼配置保持一致
+T = TypeVar("T")
 
 # UTCP Shell 工具定义（AI 侧提示词：何时、如何调用 Shell）
 SHELL_TOOL = {
@@ -42,66 +52,143 @@ SHELL_TOOL = {
 }
 
 
-def _extract_text_from_response(rsp) -> str:
-    """从单次 Generation 响应中提取文本（兼容 output.text 与 choices[0].message.content）。"""
-    if not rsp or not getattr(rsp, "output", None):
-        return ""
-    out = rsp.output
-    if hasattr(out, "text") and out.text:
-        return out.text
-    if getattr(out, "choices", None) and len(out.choices) > 0 and out.choices[0].message:
-        msg = out.choices[0].message
-        content = getattr(msg, "content", None)
-        if isinstance(content, str):
-            return content
-        if isinstance(content, list) and content:
-            part = content[0]
-            return part.get("text", str(part)) if isinstance(part, dict) else str(part)
-    return ""
-
-
-def _message_to_api(m: ChatMessage) -> Dict[str, Any]:
-    """将 ChatMessage 转为 DashScope API 消息格式。"""
-    msg: Dict[str, Any] = {"role": m.role, "content": m.content or ""}
-    if m.role == "assistant" and m.tool_calls:
-        msg["tool_calls"] = m.tool_calls
-    if m.role == "tool" and m.tool_call_id:
-        msg["tool_call_id"] = m.tool_call_id
-    return msg
-
-
-def _tool_call_to_dict(tc) -> dict:
-    """将 tool_call 项（可能为对象或 dict）转为统一 dict。"""
-    if isinstance(tc, dict):
-        return tc
-    return {
-        "id": getattr(tc, "id", ""),
-        "type": getattr(tc, "type", "function"),
-        "function": getattr(tc, "function", None) or {},
-    }
-
-
-def _get_tool_calls_from_response(rsp) -> List[dict]:
-    """从 Generation 响应中提取 tool_calls。DashScope 的 message 为 dict-like，缺键时抛 KeyError。"""
-    if not rsp or not getattr(rsp, "output", None):
-        return []
-    out = rsp.output
-    if not getattr(out, "choices", None) or len(out.choices) == 0:
-        return []
-    msg = getattr(out.choices[0], "message", None)
-    if not msg:
-        return []
-    try:
-        # DashScope message 为 dict-like，缺键时用 [] 会抛 KeyError
-        tool_calls = msg.get("tool_calls") if isinstance(msg, dict) else msg["tool_calls"]
-    except (KeyError, TypeError, AttributeError):
-        tool_calls = None
-    if isinstance(tool_calls, list):
-        return [_tool_call_to_dict(tc) for tc in tool_calls]
-    return []
+SUMMARY_INSTRUCTION = (
+    "你负责为安全助手维护对话摘要。请把【已有摘要】与【需要并入摘要的对话】合并为一份新的中文摘要，"
+    "保留用户目标、已确认的事实（主机、端口、路径、凭据位置、版本号等）、已执行的关键命令及结论、未完成事项；"
+    "省略寒暄与大段原始输出。只输出摘要正文，不超过 800 字。"
+)
+
+
+def _merge_tool_call_deltas(calls: Dict[int, dict], deltas: List[dict]) -> None:
+    """
+    流式响应中 tool_calls 分片下发：同一调用的多个片段 index 相同，
+    id / name 只在首个片段出现，arguments 需按顺序拼接。
+    """
+    for pos, delta in enumerate(deltas):
+        index = delta.get("index", pos)
+        call = calls.setdefault(index, {"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+        if delta.get("id"):
+            call["id"] = delta["id"]
+        fn = delta.get("function") or {}
+        if fn.get("name") and not call["function"]["name"]:
+            call["function"]["name"] = fn["name"]
+        if fn.get("arguments"):
+            call["function"]["arguments"] += fn["arguments"]
+
+
+class ControlChunk(str):
+    """流中的控制信息（如排队位置 [QUEUE]n）：转发给前端，但不计入回复正文、不持久化。"""
+
+
+def _error_notice(exc: Exception) -> str:
+    if isinstance(exc, CircuitOpenError):
+        return "[模型服务连续出错，已暂停调用，请稍后再试。]"
+    if isinstance(exc, ModelCallError) and exc.throttled:
+        return "[模型服务限流，重试后仍未成功，请稍后再试。]"
+    if isinstance(exc, ModelCallError) and exc.retryable:
+        return "[模型服务暂时不可用，重试后仍未成功，请稍后再试。]"
+    return "[模型或工具调用异常，请检查日志和配置。]"
+
+
+_tool_executor: Optional[ThreadPoolExecutor] = None
+_tool_executor_guard = threading.Lock()
+
+
+def _get_tool_executor() -> ThreadPoolExecutor:
+    """工具（Shell 命令等阻塞调用）专用的有界线程池，大小由 TOOL_WORKERS 决定。"""
+    global _tool_executor
+    if _tool_executor is None:
+        with _tool_executor_guard:
+            if _tool_executor is None:
+                _tool_executor = ThreadPoolExecutor(
+                    max_workers=get_settings().tool_workers, thread_name_prefix="utcp-tool"
+                )
+    return _tool_executor
+
 
+async def _run_tool(func: Callable[..., T], *args: Any) -> T:
+    return await asyncio.get_running_loop().run_in_executor(_get_tool_executor(), func, *args)
 
-def stream_chat_with_tools(
+
+async def _traced_tool(command: str, func: Callable[..., Tuple[bool, str]], *args: Any) -> Tuple[bool, str]:
+    """
+    在工具线程池中执行并记录 tool.exec span（span 记录在事件循环一侧，线程池不继承追踪上下文）。
+    span 只记录命令的哈希与长度，不记录命令原文（追踪数据不按用户隔离）。
+    """
+    digest = hashlib.sha256(command.encode("utf-8")).hexdigest()[:12]
+    with tracing.span("tool.exec", command_sha=digest, command_chars=len(command)) as sp:
+        ok, out = await _run_tool(func, *args)
+        sp.set(ok=ok, output_chars=len(out))
+        return ok, out
+
+
+class _LiveOutput:
+    """
+    收集工具线程中回调的实时 Shell 输出（utcp_shell.execute 的 on_output），在事件循环中按到达顺序取出。
+    线程通过 call_soon_threadsafe 投递，因此某个调用的输出总是先于其完成通知被处理。
+    """
+
+    def __init__(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._items: Deque[Tuple[int, str]] = deque()
+        self.ready = asyncio.Event()
+
+    def callback(self, index: int) -> Callable[[str], None]:
+        def push(text: str) -> None:
+            try:
+                self._loop.call_soon_threadsafe(self._push, index, text)
+            except RuntimeError:
+                # 事件循环已关闭（请求已结束），丢弃输出
+                pass
+
+        return push
+
+    def _push(self, index: int, text: str) -> None:
+        self._items.append((index, text))
+        self.ready.set()
+
+    def drain(self) -> List[Tuple[int, str]]:
+        items = list(self._items)
+        self._items.clear()
+        self.ready.clear()
+        return items
+
+
+def _should_cancel(abandoned: threading.Event, interrupt_flags: dict, request_id: str) -> bool:
+    """
+    供工具线程轮询：用户打断（多 worker 时 interrupt_flags 还会检查其他进程写入的标记文件），
+    或回复生成器已被关闭（客户端断开）时取消正在执行的命令。
+    """
+    return abandoned.is_set() or bool(interrupt_flags.get(request_id))
+
+
+def _tool_label(tc: dict, index: int) -> str:
+    """并发执行多个工具调用时，输出块以调用 id 标注，便于前端区分（缺少 id 时用序号）。"""
+    return f" {tc.get('id') or f'#{index + 1}'}"
+
+
+def _record_round(
+    provider: str, started: float, round_text: List[str], first_text_at: float, last_text_at: float
+) -> None:
+    """记录一轮模型调用的耗时、输出字符数与输出速度（首个到最后一个文本增量之间）。"""
+    metrics.MODEL_ROUND_SECONDS.observe(time.perf_counter() - started, provider=provider)
+    chars = sum(len(t) for t in round_text)
+    if not chars:
+        return
+    metrics.MODEL_OUTPUT_CHARS.inc(chars, provider=provider)
+    if last_text_at > first_text_at:
+        metrics.MODEL_OUTPUT_CHARS_PER_SECOND.observe(chars / (last_text_at - first_text_at), provider=provider)
+
+
+def _add_token_usage(usage: UsageRecord, current: Dict[str, int], previous: Optional[Dict[str, int]]) -> None:
+    """usage 为本轮截至目前的累计值，只累加与上次相比的增量，这样客户端中途断开时已用的 token 也已计入。"""
+    previous = previous or {}
+    usage.prompt_tokens += current["prompt_tokens"] - previous.get("prompt_tokens", 0)
+    usage.completion_tokens += current["completion_tokens"] - previous.get("completion_tokens", 0)
+    usage.total_tokens += current["total_tokens"] - previous.get("total_tokens", 0)
+
+
+async def stream_chat_with_tools(
     history: List[ChatMessage],
     user_message: ChatMessage,
     api_key_override: Optional[str],
@@ -109,22 +196,35 @@ def stream_chat_with_tools(
     interrupt_flags: dict,
     enable_utcp: bool = True,
     enable_web_search: bool = True,
-) -> Iterable[str]:
+    context: Optional[ContextWindow] = None,
+    provider: Optional[ModelProvider] = None,
+    enable_tool_cache: bool = False,
+    enable_shell_session: bool = False,
+    usage: Optional[UsageRecord] = None,
+) -> AsyncIterator[str]:
     """
-    带 UTCP Shell 工具调用的流式对话：若模型返回 tool_calls 则执行 Shell 并继续对话，
-    直到模型返回纯文本；最终将整轮对话（含 tool 消息）持久化并流式返回最后一段文本。
+    带 UTCP Shell 工具调用的流式对话（异步生成器）：每轮经 provider（默认 MODEL_PROVIDER）
+    流式调用模型，文本增量到达即 yield；若模型返回 tool_calls
+    （分片拼接完整后）则在工具线程池中执行 Shell 并继续对话，直到模型返回纯文本。
     enable_utcp=False 时不传 tools，仅文本对话；enable_web_search=False 时不开启联网搜索。
+    每轮发送的历史由 context（默认按 history 新建）在 token 预算内组装。
+    enable_tool_cache=True 时只读命令的结果在会话内缓存（见 tool_cache）；
+    enable_shell_session=True 时命令在会话的持久 Shell 中执行（见 shell_session）。
+    传入 usage 时累加各轮的 token 用量、轮数、工具调用数以及模型与工具耗时。
     """
-    from app.services import utcp_shell
+    from app.services import shell_session, tool_cache, utcp_shell
 
-    if not api_key_override:
+    provider = provider or get_provider()
+    api_key = provider.resolve_api_key(api_key_override)
+    if not api_key:
         logger.warning("DashScope API key is not configured, cannot call model.")
         yield "[模型未配置 API Key，请在设置页面中填写。]"
         return
 
+    window = context or ContextWindow(history)
+    conversation_id = user_message.conversation_id
+    # 本次回复进行中的消息（当前 user 消息及其后的 assistant / tool 消息），始终完整发送
     api_messages: List[Dict[str, Any]] = []
-    for m in history:
-        api_messages.append(_message_to_api(m))
     user_content = user_message.content or ""
     if getattr(user_message, "files", None) and isinstance(user_message.files, list) and user_message.files:
         file_list = "\n".join("- " + f for f in user_message.files)
@@ -136,41 +236,77 @@ def stream_chat_with_tools(
     api_messages.append({"role": "user", "content": user_content})
 
     full_reply_chunks: List[str] = []
+    rounds = 0
+    abandoned = threading.Event()
+    cancelled = functools.partial(_should_cancel, abandoned, interrupt_flags, request_id)
 
     try:
         while True:
             if interrupt_flags.get(request_id):
                 break
 
-            call_kwargs: Dict[str, Any] = {
-                "model": MODEL_NAME,
-                "messages": api_messages,
-                "api_key": api_key_override,
-                "result_format": "message",
-                "stream": False,
-            }
-            if enable_utcp:
-                call_kwargs["tools"] = [SHELL_TOOL]
-                call_kwargs["tool_choice"] = "auto"
-            if enable_web_search:
-                call_kwargs["enable_search"] = True
-
-            rsp = Generation.call(**call_kwargs)
-
-            text = _extract_text_from_response(rsp)
-            if text:
-                full_reply_chunks.append(text)
-                # #region agent log
+            messages = window.build(api_messages)
+            tools = [SHELL_TOOL] if enable_utcp else None
+
+            # 流式调用：文本增量到达即转发给前端；tool_calls 片段按 index 累积，本轮结束后再执行
+            # 调用经过按 API Key 的准入控制（并发、限速、排队、重试、熔断），排队期间向前端报告位置
+            round_text: List[str] = []
+            partial_calls: Dict[int, dict] = {}
+            rounds += 1
+            round_started = time.perf_counter()
+            first_delta_at = first_text_at = last_text_at = 0.0
+            round_usage: Optional[Dict[str, int]] = None
+            if usage is not None:
+                usage.rounds += 1
+            stream = admission.guarded_stream(
+                api_key,
+                user_message.user_id,
+                lambda: provider.stream(messages, api_key, tools, enable_web_search),
+                upstream=provider.name,
+            )
+            with tracing.span(
+                "model.round", round=rounds, provider=provider.name, messages=len(messages)
+            ) as round_span:
                 try:
-                    _log = Path(__file__).resolve().parent.parent.parent / ".cursor" / "debug-0f4b4c.log"
-                    with _log.open("a") as _f:
-                        _f.write(json.dumps({"sessionId": "0f4b4c", "hypothesisId": "H1", "location": "dashscope_client:yield_text", "message": "backend_yield", "data": {"kind": "text", "len": len(text), "ts": time.time()}, "timestamp": int(time.time() * 1000)}, ensure_ascii=False) + "\n")
-                except Exception:
-                    pass
-                # #endregion
-                yield text
+                    async for delta in stream:
+                        if interrupt_flags.get(request_id):
+                            break
+                        if isinstance(delta, admission.QueuePosition):
+                            tracing.event("model.queued", position=int(delta))
+                            yield ControlChunk(f"[QUEUE]{delta}")
+                            continue
+                        if not first_delta_at:
+                            first_delta_at = time.perf_counter()
+                            metrics.MODEL_FIRST_TOKEN_SECONDS.observe(
+                                first_delta_at - round_started, provider=provider.name
+                            )
+                        if delta.usage:
+                            if usage is not None:
+                                _add_token_usage(usage, delta.usage, round_usage)
+                            round_usage = delta.usage
+                        if delta.tool_calls:
+                            _merge_tool_call_deltas(partial_calls, delta.tool_calls)
+                        text = delta.text
+                        if not text:
+                            continue
+                        if not full_reply_chunks:
+                            tracing.event("model.first_token", round=rounds)
+                        last_text_at = time.perf_counter()
+                        first_text_at = first_text_at or last_text_at
+                        round_text.append(text)
+                        full_reply_chunks.append(text)
+                        yield text
+                finally:
+                    await stream.aclose()
+                    _record_round(provider.name, round_started, round_text, first_text_at, last_text_at)
+                    if usage is not None:
+                        usage.model_ms += int((time.perf_counter() - round_started) * 1000)
+                round_span.set(chars=sum(len(t) for t in round_text), tool_calls=len(partial_calls))
+            if interrupt_flags.get(request_id):
+                break
+            text = "".join(round_text)
 
-            tool_calls = _get_tool_calls_from_response(rsp)
+            tool_calls = [partial_calls[i] for i in sorted(partial_calls)]
             if not tool_calls:
                 # 无工具调用，结束；最终回复为 assistant_content_so_far
                 break
@@ -193,56 +329,123 @@ def stream_chat_with_tools(
             }
             api_messages.append(assistant_msg)
 
-            for tc in tool_calls:
-                if interrupt_flags.get(request_id):
-                    break
+            # 同一条 assistant 消息中的多个工具调用互不依赖：先解析全部调用，再并发提交到工具线程池，
+            # 每个调用完成即输出（多个调用时以调用 id 标注），tool 结果按原顺序写入 api_messages
+            results: List[Optional[str]] = [None] * len(tool_calls)
+            commands: Dict[int, str] = {}
+            for index, tc in enumerate(tool_calls):
                 name = (tc.get("function") or {}).get("name", "")
                 args_str = (tc.get("function") or {}).get("arguments", "{}")
-                tid = tc.get("id", "")
-
                 if name != "shell_execute":
-                    api_messages.append({"role": "tool", "tool_call_id": tid, "content": "[未知工具]"})
+                    results[index] = "[未知工具]"
                     continue
-
                 try:
                     args = json.loads(args_str) if isinstance(args_str, str) else args_str
-                    command = args.get("command", "")
-                except (json.JSONDecodeError, TypeError):
-                    api_messages.append({"role": "tool", "tool_call_id": tid, "content": "[参数解析失败]"})
+                    commands[index] = args.get("command", "")
+                except (json.JSONDecodeError, TypeError, AttributeError):
+                    results[index] = "[参数解析失败]"
+
+            if usage is not None:
+                usage.tool_calls += len(tool_calls)
+            tools_started = time.perf_counter()
+            labels = {i: _tool_label(tool_calls[i], i) if len(commands) > 1 else "" for i in commands}
+            pending: Dict[asyncio.Future, int] = {}
+            cached: Dict[int, tool_cache.CachedResult] = {}
+            live = _LiveOutput()
+            # 持久会话中命令的执行目录随 cd 变化，缓存按会话当前目录区分
+            cwd = shell_session.current_cwd(conversation_id) if enable_shell_session else None
+            for index, command in commands.items():
+                yield f"[执行 Shell{labels[index]}] {command}\n\n"
+                hit = tool_cache.lookup(conversation_id, command, cwd) if enable_tool_cache else None
+                if hit is not None:
+                    cached[index] = hit
                     continue
-
-                # #region agent log
-                try:
-                    _log = Path(__file__).resolve().parent.parent.parent / ".cursor" / "debug-0f4b4c.log"
-                    with _log.open("a") as _f:
-                        _f.write(json.dumps({"sessionId": "0f4b4c", "hypothesisId": "H2", "location": "dashscope_client:yield_shell", "message": "backend_yield", "data": {"kind": "shell_cmd", "ts": time.time()}, "timestamp": int(time.time() * 1000)}, ensure_ascii=False) + "\n")
-                except Exception:
-                    pass
-                # #endregion
-                yield f"[执行 Shell] {command}\n\n"
-                ok, out = utcp_shell.execute(command)
-                result = out if ok else f"[失败] {out}"
-                api_messages.append({"role": "tool", "tool_call_id": tid, "content": result})
-                # #region agent log
-                try:
-                    _log = Path(__file__).resolve().parent.parent.parent / ".cursor" / "debug-0f4b4c.log"
-                    with _log.open("a") as _f:
-                        _f.write(json.dumps({"sessionId": "0f4b4c", "hypothesisId": "H3", "location": "dashscope_client:yield_shell_out", "message": "backend_yield", "data": {"kind": "shell_output", "ts": time.time()}, "timestamp": int(time.time() * 1000)}, ensure_ascii=False) + "\n")
-                except Exception:
-                    pass
-                # #endregion
-                yield f"[Shell 输出]\n{result}\n\n"
+                if enable_shell_session:
+                    execute = functools.partial(
+                        shell_session.execute, conversation_id, on_output=live.callback(index), cancelled=cancelled
+                    )
+                else:
+                    execute = functools.partial(
+                        utcp_shell.execute, on_output=live.callback(index), cancelled=cancelled
+                    )
+                future = asyncio.ensure_future(
+                    _traced_tool(command, tool_cache.run, conversation_id, command, execute, enable_tool_cache, cwd)
+                )
+                pending[future] = index
+
+            # 命中缓存的结果直接输出，并告知模型结果来自缓存
+            for index, hit in cached.items():
+                age = int(hit.age)
+                results[index] = f"[缓存结果：{age} 秒前执行过相同命令，其后本会话未执行写操作]\n{hit.output}"
+                yield f"[Shell 输出{labels[index]}（缓存 {age} 秒前）]\n{hit.output}\n\n"
                 yield "[Shell 输出结束]\n"
 
+            while pending:
+                # 带超时等待，以便执行期间也能及时响应打断；命令运行中产生的输出以控制块 [SHELL_LIVE] 实时转发，
+                # 只用于前端展示，不计入回复正文，命令结束后仍输出完整的 [Shell 输出] 块。
+                # 打断时命令在工具线程中检测到标记后终止整个进程树，这里继续等待其返回中断前的部分输出
+                waiter = asyncio.ensure_future(live.ready.wait())
+                done, _ = await asyncio.wait([*pending, waiter], timeout=0.5, return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                for index, text in live.drain():
+                    yield ControlChunk(f"[SHELL_LIVE]{labels[index]}\n{text}")
+                for future in sorted((f for f in done if f in pending), key=pending.__getitem__):
+                    index = pending.pop(future)
+                    try:
+                        ok, out = future.result()
+                    except Exception as exc:  # noqa: BLE001
+                        logger.exception("Tool call %s failed", tool_calls[index].get("id", ""))
+                        ok, out = False, str(exc)
+                    result = out if ok else f"[失败] {out}"
+                    results[index] = result
+                    yield f"[Shell 输出{labels[index]}]\n{result}\n\n"
+                    yield "[Shell 输出结束]\n"
+            if usage is not None:
+                usage.tool_ms += int((time.perf_counter() - tools_started) * 1000)
+            if interrupt_flags.get(request_id):
+                break
+
+            for index, tc in enumerate(tool_calls):
+                api_messages.append({"role": "tool", "tool_call_id": tc.get("id", ""), "content": results[index]})
+
         # 模型文本已在每轮响应时即时 yield，此处无需再输出 full_reply_chunks
         if interrupt_flags.get(request_id):
             return
+    except (CircuitOpenError, ModelCallError) as exc:
+        logger.warning("Model call failed: %s", exc)
+        cause = str(exc.status) if isinstance(exc, ModelCallError) else "circuit_open"
+        metrics.MODEL_ERRORS.inc(provider=provider.name, cause=cause)
+        if usage is not None:
+            usage.status = "error"
+        yield _error_notice(exc)
     except Exception as exc:  # noqa: BLE001
-        logger.exception("DashScope tool call failed: %s", exc)
-        yield "[模型或工具调用异常，请检查日志和配置。]"
+        logger.exception("Model tool call failed: %s", exc)
+        metrics.MODEL_ERRORS.inc(provider=provider.name, cause="exception")
+        if usage is not None:
+            usage.status = "error"
+        yield _error_notice(exc)
+    finally:
+        abandoned.set()
+        if rounds:
+            metrics.MODEL_ROUNDS_PER_TURN.observe(rounds)
     # 持久化由 chat_service 完成：只保存最终 assistant 文本为一条消息
 
 
+async def summarize(text: str, api_key: Optional[str], provider: Optional[ModelProvider] = None) -> str:
+    """调用模型把对话片段（可含已有摘要）压缩为一段摘要，供上下文窗口折叠旧轮次。"""
+    provider = provider or get_provider()
+    key = provider.resolve_api_key(api_key)
+    if not key:
+        return ""
+    messages = [
+        {"role": "system", "content": SUMMARY_INSTRUCTION},
+        {"role": "user", "content": text},
+    ]
+    # 后台任务不对应具体用户，排队时与各用户轮转
+    reply = await admission.guarded_call(key, "", lambda: provider.complete(messages, key), upstream=provider.name)
+    return reply.strip()
+
+
 def stream_chat(
     history: List[ChatMessage],
     user_message: ChatMessage,
@@ -272,7 +475,7 @@ def stream_chat(
     try:
         # 流式调用：stream=True，每块为增量内容（incremental_output 默认 False）
         stream = Generation.call(
-            model=MODEL_NAME,
+            model=get_settings().model_name,
             messages=[{"role": msg.role, "content": msg.content} for msg in messages],
             api_key=api_key_override,
             result_format="message",
@@ -281,7 +484,7 @@ def stream_chat(
         for rsp in stream:
             if interrupt_flags.get(request_id):
                 break
-            text = _extract_text_from_response(rsp)
+            text = extract_text(rsp)
             if text:
                 yield text
     except Exception as exc:  # noqa: BLE001
@@ -0,0 +1,453 @@
+"""
+模型服务提供方。对话、流式输出与工具调用统一经由 ModelProvider 接口，按用户设置选择：
+
+- dashscope：百炼 DashScope SDK（AioGeneration，SDK 内部按事件循环共享连接池）
+- openai：OpenAI 兼容接口（openai 可选依赖，AsyncOpenAI + httpx 长连接池），
+  可指向百炼兼容模式端点或本地 vLLM / llama.cpp 等服务（OPENAI_BASE_URL）
+- fake：进程内确定性模拟，按 FAKE_LATENCY_MS / FAKE_TOKENS_PER_SEC 输出，用于离线测试与压测；
+  用户消息以 /sh 开头时返回一次 shell_execute 工具调用。只在 MODEL_PROVIDER=fake 或 DEBUG_MODE 开启时可选，
+  避免生产环境中用户在设置页选到模拟回复
+
+上游错误统一转换为 admission.ModelCallError（连接失败为 ConnectionError），以便准入控制重试与熔断。
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import ipaddress
+import json
+import logging
+import re
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from http import HTTPStatus
+from typing import Any, AsyncIterator, Callable, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
+
+from dashscope import AioGeneration
+
+from app.config import get_settings
+from app.services import context_manager
+from app.services.admission import ModelCallError
+
+try:
+    import httpx
+    import openai
+except ImportError:  # 可选依赖
+    httpx = None  # type: ignore[assignment]
+    openai = None  # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+
+class StreamDelta(NamedTuple):
+    """
+    流式响应的一个增量：文本片段与 tool_calls 片段（OpenAI 格式，按 index 拼接）。
+    usage 为本次调用截至目前的 token 用量（prompt_tokens / completion_tokens / total_tokens），
+    服务未返回时为 None；同一次调用中后到的 usage 覆盖先到的。
+    """
+
+    text: str
+    tool_calls: List[dict]
+    usage: Optional[Dict[str, int]] = None
+
+
+def _usage(prompt: Optional[int], completion: Optional[int], total: Optional[int] = None) -> Dict[str, int]:
+    prompt, completion = int(prompt or 0), int(completion or 0)
+    return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": int(total or prompt + completion)}
+
+
+class ModelProvider(ABC):
+    name = ""
+
+    def model_name(self) -> str:
+        """记入用量账本的模型名称。"""
+        return get_settings().model_name
+
+    def resolve_api_key(self, user_key: Optional[str]) -> Optional[str]:
+        """
+        返回本次调用使用的 API Key；None 表示未配置，无法调用。
+        user_key 只是用户在设置页填写的 Key，未填写时由各提供方使用自己的默认 Key（DASH_SCOPE_API_KEY / OPENAI_API_KEY）。
+        """
+        return user_key
+
+    @abstractmethod
+    def stream(
+        self,
+        messages: List[Dict[str, Any]],
+        api_key: str,
+        tools: Optional[List[dict]] = None,
+        enable_search: bool = False,
+    ) -> AsyncIterator[StreamDelta]:
+        """发起一次流式调用（异步生成器函数），每次调用都是一次新请求。"""
+
+    @abstractmethod
+    async def complete(self, messages: List[Dict[str, Any]], api_key: str) -> str:
+        """非流式调用，返回完整文本。"""
+
+
+# ---------- DashScope ----------
+
+
+def extract_text(rsp) -> str:
+    """从单次 Generation 响应中提取文本（兼容 output.text 与 choices[0].message.content）。"""
+    if not rsp or not getattr(rsp, "output", None):
+        return ""
+    out = rsp.output
+    if hasattr(out, "text") and out.text:
+        return out.text
+    if getattr(out, "choices", None) and len(out.choices) > 0 and out.choices[0].message:
+        msg = out.choices[0].message
+        content = getattr(msg, "content", None)
+        if isinstance(content, str):
+            return content
+        if isinstance(content, list) and content:
+            part = content[0]
+            return part.get("text", str(part)) if isinstance(part, dict) else str(part)
+    return ""
+
+
+def _tool_call_to_dict(tc) -> dict:
+    """将 tool_call 项（可能为对象或 dict）转为统一 dict。"""
+    if isinstance(tc, dict):
+        return tc
+    return {
+        "id": getattr(tc, "id", ""),
+        "type": getattr(tc, "type", "function"),
+        "function": getattr(tc, "function", None) or {},
+    }
+
+
+def _get_tool_calls(rsp) -> List[dict]:
+    """从 Generation 响应中提取 tool_calls。DashScope 的 message 为 dict-like，缺键时抛 KeyError。"""
+    if not rsp or not getattr(rsp, "output", None):
+        return []
+    out = rsp.output
+    if not getattr(out, "choices", None) or len(out.choices) == 0:
+        return []
+    msg = getattr(out.choices[0], "message", None)
+    if not msg:
+        return []
+    try:
+        # DashScope message 为 dict-like，缺键时用 [] 会抛 KeyError
+        tool_calls = msg.get("tool_calls") if isinstance(msg, dict) else msg["tool_calls"]
+    except (KeyError, TypeError, AttributeError):
+        tool_calls = None
+    if isinstance(tool_calls, list):
+        return [_tool_call_to_dict(tc) for tc in tool_calls]
+    return []
+
+
+def _get_usage(rsp) -> Optional[Dict[str, int]]:
+    """DashScope 流式响应的每个分片都带有截至目前的累计 usage（input_tokens / output_tokens）。"""
+    usage = getattr(rsp, "usage", None)
+    if not usage:
+        return None
+    try:
+        return _usage(usage.get("input_tokens"), usage.get("output_tokens"), usage.get("total_tokens"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def _check_response(rsp) -> None:
+    status = getattr(rsp, "status_code", HTTPStatus.OK)
+    if status != HTTPStatus.OK:
+        raise ModelCallError(int(status), getattr(rsp, "code", "") or "", getattr(rsp, "message", "") or "")
+
+
+class DashScopeProvider(ModelProvider):
+    name = "dashscope"
+
+    def resolve_api_key(self, user_key: Optional[str]) -> Optional[str]:
+        return user_key or get_settings().dashscope_api_key
+
+    async def stream(self, messages, api_key, tools=None, enable_search=False):
+        kwargs: Dict[str, Any] = {
+            "model": get_settings().model_name,
+            "messages": messages,
+            "api_key": api_key,
+            "result_format": "message",
+            "stream": True,
+            "incremental_output": True,
+        }
+        if tools:
+            kwargs["tools"] = tools
+            kwargs["tool_choice"] = "auto"
+            kwargs["parallel_tool_calls"] = True
+        if enable_search:
+            kwargs["enable_search"] = True
+        async for rsp in await AioGeneration.call(**kwargs):
+            _check_response(rsp)
+            yield StreamDelta(extract_text(rsp), _get_tool_calls(rsp), _get_usage(rsp))
+
+    async def complete(self, messages, api_key):
+        rsp = await AioGeneration.call(
+            model=get_settings().model_name,
+            messages=messages,
+            api_key=api_key,
+            result_format="message",
+        )
+        _check_response(rsp)
+        return extract_text(rsp)
+
+
+# ---------- OpenAI 兼容接口 ----------
+
+
+def _is_local_url(url: str) -> bool:
+    """服务地址是否指向本机或内网（localhost、回环 / 私有地址、不含点的单标签主机名）。"""
+    host = urlparse(url).hostname or ""
+    if host == "localhost" or (host and "." not in host and ":" not in host):
+        return True
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return address.is_loopback or address.is_private
+
+
+class _PooledClient:
+    """缓存中的一个客户端：所属事件循环、进行中的调用数，以及是否已被淘汰（调用结束后关闭）。"""
+
+    __slots__ = ("loop", "client", "leases", "evicted")
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, client: Any) -> None:
+        self.loop = loop
+        self.client = client
+        self.leases = 0
+        self.evicted = False
+
+    def close(self) -> None:
+        """在所属事件循环中关闭客户端及其连接池；事件循环已关闭时连接随之失效，直接丢弃。"""
+        if self.loop.is_closed():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.client.close(), self.loop)
+        except RuntimeError:
+            pass
+
+
+class OpenAICompatibleProvider(ModelProvider):
+    name = "openai"
+
+    def __init__(self) -> None:
+        settings = get_settings()
+        self.base_url = settings.openai_base_url
+        # 联网搜索是百炼的扩展参数，只在指向百炼兼容端点时传递，其他服务可能拒绝未知参数
+        self.supports_search = "dashscope" in self.base_url
+        self._clients: "OrderedDict[Tuple[int, str], _PooledClient]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve_api_key(self, user_key: Optional[str]) -> Optional[str]:
+        key = user_key or get_settings().openai_api_key
+        if key:
+            return key
+        # 本地推理服务通常不校验 Key，但 SDK 要求非空；远端服务未配置 Key 时按未配置处理
+        return "EMPTY" if _is_local_url(self.base_url) else None
+
+    def _acquire(self, api_key: str) -> _PooledClient:
+        """
+        取出（必要时创建）当前事件循环、该 Key 的客户端并计入一次调用，复用其 httpx 连接池（keep-alive）。
+        缓存按最近使用保留 OPENAI_MAX_CLIENTS 个，被淘汰的客户端在其进行中的调用结束后关闭。
+        """
+        loop = asyncio.get_running_loop()
+        key = (id(loop), hashlib.sha1(api_key.encode("utf-8")).hexdigest())
+        evicted: List[_PooledClient] = []
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is not None and entry.loop is not loop:
+                # 事件循环已销毁、id 被新循环复用
+                evicted.append(self._clients.pop(key))
+                entry = None
+            if entry is None:
+                entry = self._clients[key] = _PooledClient(loop, self._new_client(api_key))
+                while len(self._clients) > get_settings().openai_max_clients:
+                    evicted.append(self._clients.popitem(last=False)[1])
+            else:
+                self._clients.move_to_end(key)
+            entry.leases += 1
+            for old in evicted:
+                old.evicted = True
+            idle = [old for old in evicted if old.leases == 0]
+        for old in idle:
+            old.close()
+        return entry
+
+    def _release(self, entry: _PooledClient) -> None:
+        with self._lock:
+            entry.leases -= 1
+            idle = entry.evicted and entry.leases == 0
+        if idle:
+            entry.close()
+
+    def _new_client(self, api_key: str):
+        settings = get_settings()
+        limits = httpx.Limits(
+            max_connections=settings.openai_max_connections,
+            max_keepalive_connections=settings.openai_max_connections,
+            keepalive_expiry=60,
+        )
+        return openai.AsyncOpenAI(
+            api_key=api_key,
+            base_url=self.base_url,
+            # 重试由准入控制统一处理
+            max_retries=0,
+            timeout=httpx.Timeout(120, connect=10),
+            http_client=httpx.AsyncClient(limits=limits, http2=False),
+        )
+
+    def _request(self, messages, tools, enable_search) -> Dict[str, Any]:
+        kwargs: Dict[str, Any] = {"model": get_settings().model_name, "messages": messages}
+        if tools:
+            kwargs["tools"] = tools
+            kwargs["tool_choice"] = "auto"
+            kwargs["parallel_tool_calls"] = True
+        if enable_search and self.supports_search:
+            kwargs["extra_body"] = {"enable_search": True}
+        return kwargs
+
+    @staticmethod
+    def _translate(exc: Exception) -> Exception:
+        if isinstance(exc, openai.APIStatusError):
+            body = exc.body if isinstance(exc.body, dict) else {}
+            return ModelCallError(exc.status_code, str(body.get("code") or ""), exc.message)
+        if isinstance(exc, openai.APIConnectionError):
+            return ConnectionError(str(exc))
+        return exc
+
+    async def stream(self, messages, api_key, tools=None, enable_search=False):
+        entry = self._acquire(api_key)
+        try:
+            chunks = await entry.client.chat.completions.create(
+                stream=True,
+                # 最后一个分片（choices 为空）携带整次调用的 usage
+                stream_options={"include_usage": True},
+                **self._request(messages, tools, enable_search),
+            )
+            async for chunk in chunks:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                    yield StreamDelta("", [], _usage(usage.prompt_tokens, usage.completion_tokens, usage.total_tokens))
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                calls = [tc.model_dump(exclude_none=True) for tc in (delta.tool_calls or [])]
+                yield StreamDelta(delta.content or "", calls)
+        except openai.OpenAIError as exc:
+            raise self._translate(exc) from exc
+        finally:
+            self._release(entry)
+
+    async def complete(self, messages, api_key):
+        entry = self._acquire(api_key)
+        try:
+            rsp = await entry.client.chat.completions.create(**self._request(messages, None, False))
+        except openai.OpenAIError as exc:
+            raise self._translate(exc) from exc
+        finally:
+            self._release(entry)
+        if not rsp.choices:
+            return ""
+        return rsp.choices[0].message.content or ""
+
+
+# ---------- 模拟 ----------
+
+_FAKE_TOKEN = re.compile(r"\s*(?:[0-9A-Za-z_]+|\S)")
+
+
+class FakeProvider(ModelProvider):
+    """确定性模拟：回复内容只取决于输入，输出速度由配置决定。"""
+
+    name = "fake"
+
+    def model_name(self) -> str:
+        return "fake"
+
+    def resolve_api_key(self, user_key: Optional[str]) -> Optional[str]:
+        return "fake"
+
+    @staticmethod
+    def _reply(messages: List[Dict[str, Any]]) -> Tuple[str, List[dict]]:
+        last = messages[-1] if messages else {"role": "user", "content": ""}
+        content = last.get("content") or ""
+        if last.get("role") == "tool":
+            return f"（模拟回复）命令已执行，输出 {len(content)} 个字符。", []
+        if last.get("role") == "user" and content.startswith("/sh "):
+            digest = hashlib.sha1(content.encode("utf-8")).hexdigest()[:8]
+            call = {
+                "index": 0,
+                "id": f"call_fake_{digest}",
+                "type": "function",
+                "function": {
+                    "name": "shell_execute",
+                    "arguments": json.dumps({"command": content[4:]}, ensure_ascii=False),
+                },
+            }
+            return "", [call]
+        return f"（模拟回复）收到 {len(messages)} 条上下文消息。最后一条消息：{content[:200]}", []
+
+    async def stream(self, messages, api_key, tools=None, enable_search=False):
+        settings = get_settings()
+        text, calls = self._reply(messages)
+        if not tools:
+            calls = []
+            text = text or "（模拟回复）未启用工具。"
+        await asyncio.sleep(settings.fake_latency_ms / 1000)
+        interval = 1 / settings.fake_tokens_per_sec if settings.fake_tokens_per_sec > 0 else 0
+        for token in _FAKE_TOKEN.findall(text):
+            yield StreamDelta(token, [])
+            if interval:
+                await asyncio.sleep(interval)
+        if calls:
+            yield StreamDelta("", calls)
+        # 按上下文窗口的估算方法模拟 usage
+        prompt = sum(context_manager.message_tokens(m) for m in messages)
+        completion = context_manager.estimate_tokens(text) + sum(
+            context_manager.estimate_tokens(c["function"]["arguments"]) for c in calls
+        )
+        yield StreamDelta("", [], _usage(prompt, completion))
+
+    async def complete(self, messages, api_key):
+        await asyncio.sleep(get_settings().fake_latency_ms / 1000)
+        content = (messages[-1].get("content") or "") if messages else ""
+        return f"（模拟摘要）{content[:200]}"
+
+
+_FACTORIES: Dict[str, Callable[[], ModelProvider]] = {
+    "dashscope": DashScopeProvider,
+    "openai": OpenAICompatibleProvider,
+    "fake": FakeProvider,
+}
+
+_AVAILABLE = {
+    "dashscope": True,
+    "openai": openai is not None and httpx is not None,
+    "fake": True,
+}
+
+_providers: Dict[str, ModelProvider] = {}
+
+
+def _is_available(name: str) -> bool:
+    if name == "fake":
+        settings = get_settings()
+        return settings.model_provider == "fake" or settings.debug_mode
+    return _AVAILABLE.get(name, False)
+
+
+def available_providers() -> List[str]:
+    return [name for name in _AVAILABLE if _is_available(name)]
+
+
+def get_provider(name: Optional[str] = None) -> ModelProvider:
+    """按名称返回提供方（缺省取 MODEL_PROVIDER）；未知名称、可选依赖未安装或未开放模拟时退回 dashscope。"""
+    name = (name or get_settings().model_provider).strip().lower()
+    if name not in _providers:
+        if name in _FACTORIES and _is_available(name):
+            _providers[name] = _FACTORIES[name]()
+        else:
+            logger.warning("Model provider %r is unavailable, falling back to dashscope", name)
+            _providers[name] = get_provider("dashscope")
+    return _providers[name]
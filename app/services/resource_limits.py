@@ -0,0 +1,233 @@
+"""
+Shell 命令的资源隔离：避免模型执行的失控命令（fork 炸弹、yes > file、吃内存的编译等）拖垮同机的 Web 服务。
+
+- 每条命令（持久会话则是整个 bash 会话）在 preexec 中以 setrlimit 限制 CPU 时间、地址空间、进程数与单文件大小，
+  并降低 nice 优先级；I/O 优先级通过 ionice 包装启动（ionice 不存在时跳过）；
+- SHELL_CGROUP 指向的 cgroup v2 目录可用时，所有命令加入这个共享的 slice：memory.max / pids.max 限制全部命令合计的
+  内存与进程数，cpu.weight 降低其 CPU 份额；cgroup v1、目录不可写或控制器未启用时只使用 rlimit；
+- 命令因限制失败时，describe() 给出明确的说明追加到工具结果中（CPU / 文件大小由终止信号判断，
+  内存与进程数由 cgroup 的 oom_kill 计数或典型错误输出判断）；命令成功退出时不报告。
+
+rlimit 对每个进程分别生效（子进程继承各自计数）；RLIMIT_NPROC 按运行服务的用户统计其全部进程与线程，对 root 不生效。
+"""
+from __future__ import annotations
+
+import logging
+import os
+import re
+import shutil
+import signal
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.config import get_settings
+
+try:
+    import resource
+except ImportError:  # 非 POSIX 平台没有 rlimit
+    resource = None  # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+# CPU 软限制先发送 SIGXCPU，忽略该信号的进程在该秒数后由硬限制 SIGKILL
+CPU_HARD_GRACE = 5
+_MB = 1024 * 1024
+# 组合命令失败、但退出码不是终止信号时（如 set -e 或管道中的一段被终止），改由 Shell 打印的终止原因判断；
+# 命令成功时不检查输出，避免把输出中恰好含有这些文字的命令误报为被终止
+_SIGNAL_MESSAGES = {
+    "cpu": re.compile(r"CPU time limit exceeded"),
+    "file_size": re.compile(r"File size limit exceeded"),
+}
+# 内存 / 进程数耗尽时常见的错误输出（只在命令失败时检查输出末尾）
+_MEMORY_ERRORS = re.compile(r"Cannot allocate memory|MemoryError|std::bad_alloc|out of memory", re.IGNORECASE)
+_PROCESS_ERRORS = re.compile(r"fork: (?:retry|Resource temporarily unavailable)|[Cc]an(?:no|')t fork")
+
+_lock = threading.Lock()
+_cgroup: Optional[Path] = None
+_cgroup_ready = False
+
+
+def _clamp(limit: int, value: int) -> int:
+    """不超过当前硬限制（非特权进程无法调高硬限制，超出时 setrlimit 会失败）。"""
+    _, hard = resource.getrlimit(limit)
+    return value if hard == resource.RLIM_INFINITY else min(value, hard)
+
+
+def _rlimits() -> List[Tuple[int, Tuple[int, int]]]:
+    settings = get_settings()
+    limits: List[Tuple[int, Tuple[int, int]]] = []
+    if resource is None:
+        return limits
+    if settings.shell_limit_cpu_seconds > 0:
+        cpu = settings.shell_limit_cpu_seconds
+        soft = _clamp(resource.RLIMIT_CPU, cpu)
+        limits.append((resource.RLIMIT_CPU, (soft, _clamp(resource.RLIMIT_CPU, cpu + CPU_HARD_GRACE))))
+    for limit, value in (
+        (resource.RLIMIT_AS, settings.shell_limit_memory_mb * _MB),
+        (resource.RLIMIT_NPROC, settings.shell_limit_nproc),
+        (resource.RLIMIT_FSIZE, settings.shell_limit_file_mb * _MB),
+    ):
+        if value > 0:
+            value = _clamp(limit, value)
+            limits.append((limit, (value, value)))
+    return limits
+
+
+def _write(path: Path, value: str) -> bool:
+    try:
+        path.write_text(value)
+        return True
+    except OSError:
+        return False
+
+
+def _setup_cgroup() -> Optional[Path]:
+    """创建并配置共享的 cgroup v2 slice，失败时返回 None（只在首次使用时执行一次）。"""
+    settings = get_settings()
+    if not settings.shell_cgroup:
+        return None
+    path = Path(settings.shell_cgroup)
+    parent = path.parent
+    if not (parent / "cgroup.controllers").exists():
+        logger.info("cgroup v2 is not available at %s, shell commands use rlimits only", parent)
+        return None
+    try:
+        path.mkdir(exist_ok=True)
+    except OSError as exc:
+        logger.info("Cannot create shell cgroup %s (%s), shell commands use rlimits only", path, exc)
+        return None
+    # 父 cgroup 需在 subtree_control 中启用控制器，slice 中才会出现对应的限制文件
+    for controller in ("memory", "pids", "cpu"):
+        _write(parent / "cgroup.subtree_control", f"+{controller}")
+    applied = []
+    for name, value in (
+        ("memory.max", settings.shell_cgroup_memory_mb * _MB),
+        ("pids.max", settings.shell_cgroup_pids),
+        ("cpu.weight", settings.shell_cgroup_cpu_weight),
+    ):
+        if value > 0 and (path / name).exists() and _write(path / name, str(value)):
+            applied.append(f"{name}={value}")
+    if not os.access(path / "cgroup.procs", os.W_OK):
+        logger.info("Shell cgroup %s is not writable, shell commands use rlimits only", path)
+        return None
+    logger.info("Shell commands run in cgroup %s (%s)", path, ", ".join(applied) or "no limits applied")
+    return path
+
+
+def _get_cgroup() -> Optional[Path]:
+    global _cgroup, _cgroup_ready
+    if not _cgroup_ready:
+        with _lock:
+            if not _cgroup_ready:
+                _cgroup = _setup_cgroup()
+                _cgroup_ready = True
+    return _cgroup
+
+
+def preexec_fn() -> Optional[Callable[[], None]]:
+    """返回传给 Popen(preexec_fn=...) 的函数；限制所需的值在父进程中算好，子进程中只做系统调用。"""
+    if resource is None:
+        return None
+    limits = _rlimits()
+    nice = get_settings().shell_nice
+    cgroup = _get_cgroup()
+    procs = str(cgroup / "cgroup.procs") if cgroup is not None else None
+
+    def apply() -> None:
+        if procs is not None:
+            try:
+                fd = os.open(procs, os.O_WRONLY)
+                try:
+                    os.write(fd, str(os.getpid()).encode())
+                finally:
+                    os.close(fd)
+            except OSError:
+                pass
+        for limit, values in limits:
+            resource.setrlimit(limit, values)
+        if nice > 0:
+            os.nice(nice)
+
+    return apply
+
+
+def wrap(argv: List[str]) -> List[str]:
+    """按 SHELL_IONICE_CLASS 用 ionice 包装启动命令（ionice 以 exec 启动目标程序，不多出进程）。"""
+    settings = get_settings()
+    ionice = shutil.which("ionice") if settings.shell_ionice_class in (2, 3) else None
+    if ionice is None:
+        return argv
+    prefix = [ionice, "-c", str(settings.shell_ionice_class)]
+    if settings.shell_ionice_class == 2:
+        prefix += ["-n", str(settings.shell_ionice_level)]
+    return prefix + argv
+
+
+def oom_kills() -> int:
+    """slice 中累计被 OOM 终止的进程数（无 cgroup 时为 0），执行前后比较以判断命令是否因内存上限被终止。"""
+    cgroup = _get_cgroup()
+    if cgroup is None:
+        return 0
+    try:
+        for line in (cgroup / "memory.events").read_text().splitlines():
+            name, _, value = line.partition(" ")
+            if name == "oom_kill":
+                return int(value)
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def _signal_of(returncode: int) -> Optional[int]:
+    """Popen 以负数返回终止信号，Shell 中的 $? 则为 128 + 信号。"""
+    if returncode < 0:
+        return -returncode
+    if returncode > 128:
+        return returncode - 128
+    return None
+
+
+def describe(returncode: int, output: str, oom_kills_before: int) -> Optional[Tuple[str, str]]:
+    """判断命令是否因资源限制失败，返回 (限制名, 说明)；未触发限制时返回 None。"""
+    if returncode == 0:
+        return None
+    settings = get_settings()
+    sig = _signal_of(returncode)
+    tail = output[-2000:]
+    if settings.shell_limit_cpu_seconds > 0 and (sig == signal.SIGXCPU or _SIGNAL_MESSAGES["cpu"].search(tail)):
+        return "cpu", f"CPU 时间超过上限 {settings.shell_limit_cpu_seconds} 秒（SHELL_LIMIT_CPU_SECONDS），进程被终止"
+    if settings.shell_limit_file_mb > 0 and (sig == signal.SIGXFSZ or _SIGNAL_MESSAGES["file_size"].search(tail)):
+        return "file_size", f"写入的文件超过大小上限 {settings.shell_limit_file_mb} MB（SHELL_LIMIT_FILE_MB），进程被终止"
+    if oom_kills() > oom_kills_before:
+        return "memory", (
+            f"Shell 命令合计内存超过上限 {settings.shell_cgroup_memory_mb} MB（SHELL_CGROUP_MEMORY_MB），"
+            "进程被 OOM 终止"
+        )
+    if settings.shell_limit_memory_mb > 0 and _MEMORY_ERRORS.search(tail):
+        return "memory", f"内存分配失败，可能超过了地址空间上限 {settings.shell_limit_memory_mb} MB（SHELL_LIMIT_MEMORY_MB）"
+    if (settings.shell_limit_nproc > 0 or _get_cgroup() is not None) and _PROCESS_ERRORS.search(tail):
+        return "processes", "无法创建新进程，可能超过了进程数上限（SHELL_LIMIT_NPROC / SHELL_CGROUP_PIDS）"
+    return None
+
+
+def stats() -> Dict[str, object]:
+    settings = get_settings()
+    cgroup = _get_cgroup()
+    result: Dict[str, object] = {
+        "cpu_seconds": settings.shell_limit_cpu_seconds,
+        "memory_mb": settings.shell_limit_memory_mb,
+        "nproc": settings.shell_limit_nproc,
+        "file_mb": settings.shell_limit_file_mb,
+        "nice": settings.shell_nice,
+        "ionice_class": settings.shell_ionice_class,
+        "cgroup": str(cgroup) if cgroup is not None else None,
+    }
+    if cgroup is not None:
+        for name in ("memory.current", "pids.current"):
+            try:
+                result[name] = int((cgroup / name).read_text())
+            except (OSError, ValueError):
+                pass
+        result["oom_kills"] = oom_kills()
+    return result
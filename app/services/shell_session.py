@@ -0,0 +1,270 @@
+"""
+按对话保持的持久 Shell（用户在设置页开启后生效）：同一对话中的命令在同一个 bash 进程中执行，
+cd、export、source venv/bin/activate 等状态在命令之间保留，也省去每条命令启动 Shell 的开销。
+
+- bash 以 --noprofile --norc 启动并通过管道驱动：每条命令经 here-document 交给 eval 在当前 Shell 中执行
+  （stdin 重定向到 /dev/null，避免命令读走后续输入），随后输出带随机标记的结束行，携带退出码与当前目录；
+- 每条命令执行前仍按会话当前目录做 PROJECT_SAVE 检查（utcp_shell.execute）；
+- 命令超时、被打断或执行了 exit 时整个会话随之结束，下一条命令在新会话中执行；
+- 空闲超过 SHELL_SESSION_IDLE_TIMEOUT 秒的会话由后台线程回收；会话数达到 SHELL_SESSION_MAX 时先回收最久未用的
+  空闲会话，仍无空位则本条命令以一次性 Shell 执行；
+- 一个会话同时只执行一条命令：同一轮并发的多个工具调用中，会话正忙时其余命令以一次性 Shell 在会话当前目录执行。
+
+会话只在进程内，多 worker 时各自独立。
+"""
+from __future__ import annotations
+
+import atexit
+import logging
+import subprocess
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.config import PROJECT_ROOT, get_settings
+from app.services import resource_limits, utcp_shell
+
+logger = logging.getLogger(__name__)
+
+REAP_INTERVAL = 30.0
+
+
+class ShellSession:
+    def __init__(self, conversation_id: str) -> None:
+        self.conversation_id = conversation_id
+        self.cwd = PROJECT_ROOT
+        self.busy = False
+        self.last_used = time.monotonic()
+        self.commands = 0
+        # 资源限制施加在 bash 上，会话中执行的命令逐个继承
+        self._proc = subprocess.Popen(
+            resource_limits.wrap(["bash", "--noprofile", "--norc"]),
+            cwd=str(PROJECT_ROOT),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+            preexec_fn=resource_limits.preexec_fn(),
+        )
+
+    @property
+    def alive(self) -> bool:
+        return self._proc.poll() is None
+
+    def run(
+        self,
+        command: str,
+        on_output: Optional[Callable[[str], None]] = None,
+        cancelled: Optional[Callable[[], bool]] = None,
+    ) -> Tuple[Optional[int], str, str]:
+        """
+        在会话中执行一条命令，返回值同 utcp_shell._run：(退出码, 输出, 中止原因)。
+        超时或取消时终止整个会话；命令执行 exit 结束会话时退出码为 bash 的退出码。
+        """
+        token = uuid.uuid4().hex
+        marker = f"__JD_DONE_{token}__"
+        # 结束行前先输出一个换行，保证标记位于行首（命令输出可能不以换行结尾）；
+        # 每行的换行符推迟到下一行输出时再补上，这个多出的换行因此不会进入输出
+        script = (
+            f"eval \"$(cat <<'__JD_CMD_{token}__'\n{command}\n__JD_CMD_{token}__\n)\" </dev/null\n"
+            f"printf '\\n{marker}:%d:%s\\n' \"$?\" \"$PWD\"\n"
+        )
+        self.commands += 1
+        collector = utcp_shell.OutputCollector(on_output)
+        carry = ""
+        newline = ""
+        done: Dict[str, str] = {}
+
+        def feed(text: str) -> bool:
+            nonlocal carry, newline
+            lines = (carry + text).split("\n")
+            carry = lines.pop()
+            for line in lines:
+                if line.startswith(marker):
+                    code, _, cwd = line[len(marker) + 1 :].partition(":")
+                    done.update(code=code, cwd=cwd)
+                    return True
+                collector.add(newline + line)
+                newline = "\n"
+            if len(carry) > utcp_shell.READ_SIZE:
+                # 超长的单行（如无换行的进度输出）不再等待换行
+                collector.add(newline + carry)
+                carry = newline = ""
+            return False
+
+        try:
+            self._proc.stdin.write(script.encode("utf-8"))
+            self._proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            return self._proc.wait(), "", ""
+        deadline = time.monotonic() + utcp_shell.COMMAND_TIMEOUT
+        try:
+            stopped = utcp_shell.pump_output(self._proc.stdout.fileno(), feed, collector, cancelled, deadline)
+            if stopped or not done:
+                collector.add(newline + carry)
+            if not stopped and not done:
+                # 读到 EOF：命令执行了 exit 或关闭了 stdout，等待会话结束
+                stopped = utcp_shell.wait_exit(self._proc, cancelled, deadline)
+            if stopped:
+                self.close()
+                return None, collector.text(), stopped
+            if not done:
+                return self._proc.returncode, collector.text(), ""
+            if done["cwd"]:
+                self.cwd = Path(done["cwd"])
+            return int(done["code"] or 0), collector.text(), ""
+        finally:
+            collector.close()
+
+    def close(self) -> None:
+        if self.alive:
+            utcp_shell.terminate(self._proc)
+        for stream in (self._proc.stdin, self._proc.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+
+_sessions: "OrderedDict[str, ShellSession]" = OrderedDict()
+_lock = threading.Lock()
+_reaper: Optional[threading.Thread] = None
+_unavailable = False
+
+
+def _close_all(sessions: List[ShellSession]) -> None:
+    for session in sessions:
+        session.close()
+
+
+def _acquire(conversation_id: str) -> Tuple[Optional[ShellSession], Path]:
+    """
+    取出（必要时创建）对话的会话并标记为忙碌；无法使用会话时返回 (None, 执行目录)，
+    调用方以一次性 Shell 在该目录执行。
+    """
+    global _unavailable
+    settings = get_settings()
+    evicted: List[ShellSession] = []
+    try:
+        with _lock:
+            session = _sessions.get(conversation_id)
+            if session is not None and not session.alive:
+                del _sessions[conversation_id]
+                session = None
+            if session is not None:
+                if session.busy:
+                    return None, session.cwd
+                session.busy = True
+                _sessions.move_to_end(conversation_id)
+                return session, session.cwd
+            if _unavailable:
+                return None, PROJECT_ROOT
+            while len(_sessions) >= settings.shell_session_max:
+                idle = next((key for key, s in _sessions.items() if not s.busy), None)
+                if idle is None:
+                    return None, PROJECT_ROOT
+                evicted.append(_sessions.pop(idle))
+            try:
+                session = ShellSession(conversation_id)
+            except OSError as exc:
+                _unavailable = True
+                logger.warning("Persistent shell sessions are unavailable (%s), using one-shot shells", exc)
+                return None, PROJECT_ROOT
+            session.busy = True
+            _sessions[conversation_id] = session
+            _start_reaper()
+            return session, session.cwd
+    finally:
+        _close_all(evicted)
+
+
+def _release(session: ShellSession) -> None:
+    with _lock:
+        session.busy = False
+        session.last_used = time.monotonic()
+        if not session.alive and _sessions.get(session.conversation_id) is session:
+            del _sessions[session.conversation_id]
+
+
+def execute(
+    conversation_id: str,
+    command: str,
+    on_output: Optional[Callable[[str], None]] = None,
+    cancelled: Optional[Callable[[], bool]] = None,
+) -> Tuple[bool, str]:
+    """在对话的持久会话中执行命令，参数与返回值同 utcp_shell.execute。"""
+    session, cwd = _acquire(conversation_id)
+    if session is None:
+        return utcp_shell.execute(command, cwd=cwd, on_output=on_output, cancelled=cancelled)
+    try:
+        return utcp_shell.execute(command, on_output=on_output, cancelled=cancelled, session=session)
+    finally:
+        _release(session)
+
+
+def current_cwd(conversation_id: str) -> Path:
+    """对话的会话当前所在目录（尚无会话时为项目根目录）。"""
+    with _lock:
+        session = _sessions.get(conversation_id)
+        return session.cwd if session is not None else PROJECT_ROOT
+
+
+def close(conversation_id: str) -> None:
+    """结束对话的会话（如对话被删除）；正在执行的命令一并终止。"""
+    with _lock:
+        session = _sessions.pop(conversation_id, None)
+    if session is not None:
+        session.close()
+
+
+def _reap_idle() -> None:
+    timeout = get_settings().shell_session_idle_timeout
+    now = time.monotonic()
+    with _lock:
+        idle = [key for key, s in _sessions.items() if not s.busy and (now - s.last_used > timeout or not s.alive)]
+        expired = [_sessions.pop(key) for key in idle]
+    if expired:
+        logger.info("Closing %d idle shell session(s)", len(expired))
+    _close_all(expired)
+
+
+def _loop() -> None:
+    while True:
+        time.sleep(REAP_INTERVAL)
+        try:
+            _reap_idle()
+        except Exception:  # noqa: BLE001
+            logger.exception("Reaping idle shell sessions failed")
+
+
+def _start_reaper() -> None:
+    """首次创建会话时启动回收线程（调用方持有 _lock）。"""
+    global _reaper
+    if _reaper is None:
+        _reaper = threading.Thread(target=_loop, name="shell-session-reaper", daemon=True)
+        _reaper.start()
+
+
+def _shutdown() -> None:
+    with _lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    _close_all(sessions)
+
+
+atexit.register(_shutdown)
+
+
+def stats() -> dict:
+    settings = get_settings()
+    with _lock:
+        return {
+            "sessions": len(_sessions),
+            "busy": sum(1 for s in _sessions.values() if s.busy),
+            "commands": sum(s.commands for s in _sessions.values()),
+            "max_sessions": settings.shell_session_max,
+            "idle_timeout": settings.shell_session_idle_timeout,
+        }
@@ -0,0 +1,164 @@
+"""
+会话内的工具结果缓存（用户在设置页开启后生效）：模型在同一任务中经常重复执行
+cat /etc/os-release、ls -la、ip a、which nmap 等检查命令，命中缓存时不再启动 Shell。
+
+- 只缓存 utcp_shell.is_read_only_command() 判定为只读、且执行成功的命令，按 (工作目录, 命令) 为键；
+- 条目在 TOOL_CACHE_TTL 秒后过期，每个会话至多 TOOL_CACHE_MAX_ENTRIES 条（LRU）；
+- 同一会话中执行任何非只读命令时清空该会话的缓存（无论是否开启缓存，避免开启后读到旧结果）；
+  与写命令并发执行的只读命令结果不写入缓存。
+
+缓存只在进程内，多 worker 时各自独立。
+"""
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+from app.config import PROJECT_ROOT, get_settings
+from app.services import utcp_shell
+
+# 同时保留缓存的会话数上限（LRU）
+MAX_CONVERSATIONS = 1024
+
+
+class CachedResult(NamedTuple):
+    ok: bool
+    output: str
+    age: float
+
+
+def _key(command: str, cwd: Path) -> Tuple[str, str]:
+    return str(cwd), " ".join(command.split())
+
+
+class ToolResultCache:
+    def __init__(self, ttl: float, max_entries: int) -> None:
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, OrderedDict[Tuple[str, str], Tuple[bool, str, float]]]" = OrderedDict()
+        # 每次失效递增；只读命令执行前后代数不同说明期间有写命令，结果不入缓存
+        self._generations: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.invalidations = 0
+
+    def lookup(self, conversation_id: str, command: str, cwd: Optional[Path] = None) -> Optional[CachedResult]:
+        key = _key(command, cwd or PROJECT_ROOT)
+        now = time.monotonic()
+        with self._lock:
+            entries = self._entries.get(conversation_id)
+            item = entries.get(key) if entries is not None else None
+            if item is None or now - item[2] > self.ttl:
+                if item is not None:
+                    del entries[key]
+                self.misses += 1
+                return None
+            entries.move_to_end(key)
+            self._entries.move_to_end(conversation_id)
+            self.hits += 1
+            return CachedResult(item[0], item[1], now - item[2])
+
+    def run(
+        self,
+        conversation_id: str,
+        command: str,
+        execute: Callable[[str], Tuple[bool, str]],
+        store: bool = True,
+        cwd: Optional[Path] = None,
+    ) -> Tuple[bool, str]:
+        """执行命令并维护缓存：写命令前后各失效一次；store=True 时保存只读命令的成功结果。"""
+        cwd = cwd or PROJECT_ROOT
+        if not utcp_shell.is_read_only_command(command, cwd):
+            self.invalidate(conversation_id)
+            try:
+                return execute(command)
+            finally:
+                self.invalidate(conversation_id)
+        with self._lock:
+            generation = self._generations.get(conversation_id, 0)
+        ok, output = execute(command)
+        if store and ok:
+            self._store(conversation_id, _key(command, cwd), ok, output, generation)
+        return ok, output
+
+    def _store(self, conversation_id: str, key: Tuple[str, str], ok: bool, output: str, generation: int) -> None:
+        with self._lock:
+            if self._generations.get(conversation_id, 0) != generation:
+                return
+            entries = self._entries.get(conversation_id)
+            if entries is None:
+                entries = self._entries[conversation_id] = OrderedDict()
+                while len(self._entries) > MAX_CONVERSATIONS:
+                    evicted, _ = self._entries.popitem(last=False)
+                    self._generations.pop(evicted, None)
+            entries[key] = (ok, output, time.monotonic())
+            entries.move_to_end(key)
+            self._entries.move_to_end(conversation_id)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            self.stores += 1
+
+    def invalidate(self, conversation_id: str) -> None:
+        with self._lock:
+            self._generations[conversation_id] = self._generations.get(conversation_id, 0) + 1
+            if self._entries.pop(conversation_id, None):
+                self.invalidations += 1
+
+    def forget(self, conversation_id: str) -> None:
+        with self._lock:
+            self._entries.pop(conversation_id, None)
+            self._generations.pop(conversation_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "conversations": len(self._entries),
+                "entries": sum(len(e) for e in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "stores": self.stores,
+                "invalidations": self.invalidations,
+            }
+
+
+_cache: Optional[ToolResultCache] = None
+_cache_guard = threading.Lock()
+
+
+def _get_cache() -> ToolResultCache:
+    global _cache
+    if _cache is None:
+        with _cache_guard:
+            if _cache is None:
+                settings = get_settings()
+                _cache = ToolResultCache(settings.tool_cache_ttl, settings.tool_cache_max_entries)
+    return _cache
+
+
+def lookup(conversation_id: str, command: str, cwd: Optional[Path] = None) -> Optional[CachedResult]:
+    return _get_cache().lookup(conversation_id, command, cwd)
+
+
+def run(
+    conversation_id: str,
+    command: str,
+    execute: Callable[[str], Tuple[bool, str]],
+    store: bool = True,
+    cwd: Optional[Path] = None,
+) -> Tuple[bool, str]:
+    return _get_cache().run(conversation_id, command, execute, store, cwd)
+
+
+def forget_conversation(conversation_id: str) -> None:
+    _get_cache().forget(conversation_id)
+
+
+def stats() -> dict:
+    return _get_cache().stats()
@@ -4,19 +4,43 @@ UTCP Shell 插件：为 AI 提供完全权限的 Shell 执行能力。
 """
 from __future__ import annotations
 
+import codecs
 import logging
+import os
 import re
+import selectors
+import signal
 import subprocess
+import time
+import uuid
+from collections import deque
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import TYPE_CHECKING, BinaryIO, Callable, Deque, List, Optional, Tuple
 
 from app.config import PROJECT_ROOT, get_settings
+from app.services import resource_limits
+from app.utils import metrics
+
+if TYPE_CHECKING:
+    from app.services.shell_session import ShellSession
 
 logger = logging.getLogger(__name__)
 
 # 项目本体受保护目录：PROJECT_ROOT 下除 tmp 以外的所有路径
 TMP_DIR = PROJECT_ROOT / "tmp"
 
+# 单条命令的超时（秒）
+COMMAND_TIMEOUT = 300
+# 流式输出的合并间隔（秒）：期间产生的输出合并为一次回调，避免逐行推送
+STREAM_FLUSH_INTERVAL = 0.2
+READ_SIZE = 65536
+# 取消或超时时先向进程组发送 SIGTERM，等待该秒数后仍未退出则 SIGKILL
+KILL_GRACE = 2.0
+# 超长输出的完整内容写入该目录（在 tmp/ 下，PROJECT_SAVE 开启时模型仍可读取），保留该秒数后清理
+SPILL_DIR = TMP_DIR / "tool_outputs"
+SPILL_RETENTION = 24 * 3600
+SESSION_ENDED_NOTE = "[Shell 会话已结束，下一条命令将在新会话中执行，工作目录与环境变量恢复初始状态]"
+
 
 def _resolve_path(path_str: str, cwd: Path) -> Optional[Path]:
     """将可能相对或含 ~ 的路径解析为绝对路径。"""
@@ -88,6 +112,62 @@ def _paths_touched_by_command(command: str, cwd: Path) -> list[Tuple[Path, str]]
     return touched
 
 
+# 只读检查命令白名单：输出只取决于系统状态、且不修改任何文件。
+# date / uptime / ps 等每次结果都不同的命令，以及 env / command 这类会执行其他程序的命令不在其列
+_READ_ONLY_PROGRAMS = frozenset(
+    {
+        "cat", "head", "tail", "ls", "ll", "tree", "stat", "file", "wc", "md5sum", "sha1sum",
+        "sha256sum", "grep", "egrep", "fgrep", "rg", "find", "locate", "which", "whereis", "type",
+        "uname", "id", "whoami", "groups", "pwd", "printenv", "lsb_release", "arch", "nproc",
+        "lscpu", "lsblk", "lspci", "lsusb", "lsmod", "df", "du", "getent", "ip", "dpkg",
+        "apt-cache", "readlink", "realpath", "basename", "dirname", "sort", "uniq", "cut", "tr",
+        "column", "nl", "echo", "printf", "test", "true",
+    }
+)
+# 白名单程序中会写入或执行其他程序的参数 / 子命令（出现即不视为只读）
+_WRITE_ARGS = {
+    "find": {"-exec", "-execdir", "-ok", "-okdir", "-delete", "-fprint", "-fprint0", "-fprintf", "-fls"},
+    "ip": {"add", "del", "delete", "set", "flush", "change", "replace", "append", "exec", "-batch", "-b"},
+    "rg": {"--pre"},
+    "sort": {"-o", "--output"},
+    "apt-cache": {"gencaches"},
+}
+# 只有首个参数在此列出的查询操作时才视为只读
+_READ_ONLY_ACTIONS = {
+    "dpkg": {"-l", "--list", "-L", "--listfiles", "-s", "--status", "-S", "--search", "-p", "--print-avail",
+             "--get-selections", "--print-architecture", "--version"},
+}
+# 命令替换、进程替换、重定向、后台执行、换行与变量赋值都可能带来写入或不可预期的副作用
+_UNSAFE_SYNTAX = re.compile(r"`|\$\(|<\(|>|(?<!&)&(?!&)|\n|(?:^|\s)\w+=")
+_SEGMENT_SEP = re.compile(r"\|\|?|&&|;")
+# 丢弃输出或合并 stderr 的重定向不写文件，判断前先去掉
+_HARMLESS_REDIRECT = re.compile(r"(?<=\s)(?:[12]?>\s*/dev/null|2>&1|1>&2)(?=\s|$)")
+
+
+def is_read_only_command(command: str, cwd: Path) -> bool:
+    """
+    判断命令是否为只读检查命令：不触及任何写/删路径（_paths_touched_by_command），
+    不含重定向、命令替换等语法，且管道 / 命令列表中的每一段都以白名单程序开头、不带写操作参数。
+    """
+    command = _HARMLESS_REDIRECT.sub("", command.strip()).strip()
+    if not command or _UNSAFE_SYNTAX.search(command):
+        return False
+    if _paths_touched_by_command(command, cwd):
+        return False
+    for segment in _SEGMENT_SEP.split(command):
+        words = segment.split()
+        if not words:
+            return False
+        program = words[0].rsplit("/", 1)[-1]
+        if program not in _READ_ONLY_PROGRAMS:
+            return False
+        if _WRITE_ARGS.get(program, set()) & set(words[1:]):
+            return False
+        if program in _READ_ONLY_ACTIONS and (len(words) < 2 or words[1] not in _READ_ONLY_ACTIONS[program]):
+            return False
+    return True
+
+
 def _is_protected_path(path: Path) -> bool:
     """路径在项目本体内且不在 tmp 下则受保护。"""
     try:
@@ -129,33 +209,298 @@ def check_command_allowed(command: str, cwd: Path) -> Tuple[bool, str]:
     return True, ""
 
 
-def execute(command: str, cwd: Path | None = None) -> Tuple[bool, str]:
+def terminate(proc: subprocess.Popen) -> None:
+    """终止命令及其全部子进程：先 SIGTERM 整个进程组，KILL_GRACE 秒后 SIGKILL 仍残留的进程。"""
+    if not hasattr(os, "killpg"):  # 非 POSIX 平台只能终止 shell 本身
+        proc.kill()
+        proc.wait()
+        return
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            break
+        if sig == signal.SIGTERM:
+            try:
+                proc.wait(KILL_GRACE)
+            except subprocess.TimeoutExpired:
+                pass
+    proc.wait()
+
+
+def _trim_left(parts: Deque[str], size: int, limit: int) -> int:
+    """从左侧丢弃 parts 中的文本直到总长度不超过 limit，返回丢弃后的总长度。"""
+    while size > limit:
+        first = parts[0]
+        if size - len(first) >= limit:
+            parts.popleft()
+            size -= len(first)
+        else:
+            parts[0] = first[size - limit :]
+            size = limit
+    return size
+
+
+def _prune_spill_files() -> None:
+    cutoff = time.time() - SPILL_RETENTION
+    for path in SPILL_DIR.glob("*.log"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            pass
+
+
+class OutputCollector:
+    """
+    收集命令输出，内存占用有上限：
+    - 总长度不超过 TOOL_OUTPUT_HEAD_CHARS + TOOL_OUTPUT_TAIL_CHARS 时完整保留；
+    - 超出后完整输出写入 tmp/tool_outputs/<id>.log，内存中只保留开头与末尾两段，
+      text() 返回“开头 + 省略说明（含文件路径）+ 末尾”，交给模型与前端的都是这份截断视图；
+    - 至多每 STREAM_FLUSH_INTERVAL 秒把新增部分合并回调一次 on_output，每秒最多推送
+      TOOL_OUTPUT_STREAM_RATE 个字符，超出的部分只推送最新的一段并注明跳过的字符数。
+    """
+
+    def __init__(self, on_output: Optional[Callable[[str], None]] = None) -> None:
+        settings = get_settings()
+        self._on_output = on_output
+        self._head_limit = settings.tool_output_head_chars
+        self._tail_limit = settings.tool_output_tail_chars
+        self._flush_limit = max(1, int(settings.tool_output_stream_rate * STREAM_FLUSH_INTERVAL))
+        self._head: List[str] = []
+        self._head_size = 0
+        self._tail: Deque[str] = deque()
+        self._tail_size = 0
+        self._total = 0
+        self._spill: Optional[BinaryIO] = None
+        self._spill_path: Optional[Path] = None
+        self._spill_failed = False
+        self._pending: Deque[str] = deque()
+        self._pending_size = 0
+        self._skipped = 0
+        self._last_flush = time.monotonic()
+
+    def add(self, text: str) -> None:
+        if not text:
+            return
+        chunk = text
+        self._total += len(text)
+        if self._spill is not None:
+            self._write_spill(text)
+        room = self._head_limit - self._head_size
+        if room > 0:
+            self._head.append(text[:room])
+            self._head_size += min(room, len(text))
+            text = text[room:]
+        if text:
+            self._tail.append(text)
+            self._tail_size += len(text)
+            if self._tail_size > self._tail_limit:
+                if self._spill is None and not self._spill_failed:
+                    # 首次超出上限时内存中仍是完整输出，一次写入文件后转为逐段追加
+                    self._open_spill()
+                self._tail_size = _trim_left(self._tail, self._tail_size, self._tail_limit)
+        if self._on_output is not None:
+            self._pending.append(chunk)
+            self._pending_size += len(chunk)
+            if self._pending_size > self._flush_limit:
+                size = _trim_left(self._pending, self._pending_size, self._flush_limit)
+                self._skipped += self._pending_size - size
+                self._pending_size = size
+
+    def _open_spill(self) -> None:
+        try:
+            SPILL_DIR.mkdir(parents=True, exist_ok=True)
+            _prune_spill_files()
+            self._spill_path = SPILL_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.log"
+            self._spill = self._spill_path.open("wb")
+        except OSError as exc:
+            logger.warning("Cannot spill tool output to %s: %s", SPILL_DIR, exc)
+            self._spill_failed = True
+            self._spill_path = None
+            return
+        self._write_spill("".join(self._head) + "".join(self._tail))
+
+    def _write_spill(self, text: str) -> None:
+        try:
+            self._spill.write(text.encode("utf-8"))
+        except OSError as exc:
+            logger.warning("Writing spilled tool output to %s failed: %s", self._spill_path, exc)
+            self._spill_failed = True
+            self.close()
+
+    def flush(self, force: bool = False) -> None:
+        if self._pending and (force or time.monotonic() - self._last_flush >= STREAM_FLUSH_INTERVAL):
+            text = "".join(self._pending)
+            if self._skipped:
+                text = f"[… 输出过快，跳过 {self._skipped} 个字符 …]\n{text}"
+            self._on_output(text)
+            self._pending.clear()
+            self._pending_size = self._skipped = 0
+            self._last_flush = time.monotonic()
+
+    def close(self) -> None:
+        if self._spill is not None:
+            try:
+                self._spill.close()
+            except OSError:
+                pass
+            self._spill = None
+
+    def text(self) -> str:
+        head = "".join(self._head)
+        tail = "".join(self._tail)
+        omitted = self._total - len(head) - len(tail)
+        if omitted <= 0:
+            return head + tail
+        if self._spill_path is not None and not self._spill_failed:
+            where = f"完整输出（{self._total} 个字符）已保存到 {self._spill_path.relative_to(PROJECT_ROOT)}，可用 sed -n / grep / tail 查看"
+        else:
+            where = "完整输出未能保存"
+        return f"{head}\n[… 输出过长，省略中间 {omitted} 个字符；{where} …]\n{tail}"
+
+
+def pump_output(
+    fd: int,
+    feed: Callable[[str], bool],
+    collector: OutputCollector,
+    cancelled: Optional[Callable[[], bool]],
+    deadline: float,
+) -> str:
+    """
+    非阻塞读取 fd（selectors）并把解码后的文本交给 feed，feed 返回 True 表示已读到结束位置；
+    每次读取间隙检查超时与 cancelled()，并按间隔刷新 collector。
+    返回中止原因：读到 EOF 或 feed 结束时为空串，否则为 timeout / cancelled。
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    with selectors.DefaultSelector() as selector:
+        selector.register(fd, selectors.EVENT_READ)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return "timeout"
+            if cancelled is not None and cancelled():
+                return "cancelled"
+            done = False
+            if selector.select(min(remaining, STREAM_FLUSH_INTERVAL)):
+                data = os.read(fd, READ_SIZE)
+                done = feed(decoder.decode(data, final=not data)) or not data
+            collector.flush(force=done)
+            if done:
+                return ""
+
+
+def wait_exit(proc: subprocess.Popen, cancelled: Optional[Callable[[], bool]], deadline: float) -> str:
+    """
+    输出读到 EOF 后等待进程退出：命令可能关闭 stdout 后继续运行（如 exec >&-; sleep 1000），
+    因此按 STREAM_FLUSH_INTERVAL 分段等待，同样检查超时与 cancelled()。返回值同 pump_output。
+    """
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return "timeout"
+        if cancelled is not None and cancelled():
+            return "cancelled"
+        try:
+            proc.wait(min(remaining, STREAM_FLUSH_INTERVAL))
+            return ""
+        except subprocess.TimeoutExpired:
+            pass
+
+
+def _run(
+    command: str,
+    cwd: Path,
+    on_output: Optional[Callable[[str], None]],
+    cancelled: Optional[Callable[[], bool]],
+) -> Tuple[Optional[int], str, str]:
+    """
+    以 Popen 执行一次命令：命令在独立的进程组中运行并受 resource_limits 限制，stderr 合并到 stdout 同一管道，按产生顺序读取。
+    返回 (退出码, 完整输出, 中止原因)；超时或取消时终止整个进程组，退出码为 None，中止原因为 timeout / cancelled。
+    """
+    proc = subprocess.Popen(
+        resource_limits.wrap(["/bin/sh", "-c", command]),
+        cwd=str(cwd),
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        start_new_session=True,
+        preexec_fn=resource_limits.preexec_fn(),
+    )
+    collector = OutputCollector(on_output)
+
+    def feed(text: str) -> bool:
+        if text:
+            collector.add(text)
+        return False
+
+    deadline = time.monotonic() + COMMAND_TIMEOUT
+    try:
+        stopped = pump_output(proc.stdout.fileno(), feed, collector, cancelled, deadline)
+        if not stopped:
+            stopped = wait_exit(proc, cancelled, deadline)
+        if stopped:
+            terminate(proc)
+            return None, collector.text(), stopped
+        return proc.returncode, collector.text(), ""
+    finally:
+        collector.close()
+        proc.stdout.close()
+        if proc.poll() is None:
+            terminate(proc)
+
+
+def execute(
+    command: str,
+    cwd: Path | None = None,
+    on_output: Optional[Callable[[str], None]] = None,
+    cancelled: Optional[Callable[[], bool]] = None,
+    session: Optional[ShellSession] = None,
+) -> Tuple[bool, str]:
     """
     执行 shell 命令。cwd 默认为项目根目录。
-    返回 (success, output)，output 为 stdout+stderr 的合并输出。
+    返回 (success, output)，output 为 stdout+stderr 按产生顺序合并的输出。
+    传入 on_output 时在命令运行期间分段回调已产生的输出（在执行线程中调用），用于实时展示；
+    传入 cancelled 时定期检查，返回 True 即终止命令的整个进程树，并返回已产生的部分输出。
+    传入 session 时在该持久 Shell 会话中执行（工作目录取会话当前目录，见 shell_session），否则每次启动新的 Shell。
     """
-    base_cwd = cwd or PROJECT_ROOT
+    base_cwd = session.cwd if session is not None else (cwd or PROJECT_ROOT)
     allowed, err = check_command_allowed(command, base_cwd)
     if not allowed:
+        metrics.SHELL_EXITS.inc(code="denied")
         return False, err
 
+    started = time.perf_counter()
+    code = "error"
+    oom_kills = resource_limits.oom_kills()
     try:
-        result = subprocess.run(
-            command,
-            shell=True,
-            cwd=str(base_cwd),
-            capture_output=True,
-            text=True,
-            timeout=300,
-        )
-        out = (result.stdout or "") + (result.stderr or "")
-        if result.returncode != 0 and not out.strip():
-            out = f"[exit code {result.returncode}]"
-        elif result.returncode != 0:
-            out = f"{out.strip()}\n[exit code {result.returncode}]"
-        return result.returncode == 0, out.strip() or "(无输出)"
-    except subprocess.TimeoutExpired:
-        return False, "[命令执行超时 (300s)]"
+        if session is not None:
+            returncode, out, stopped = session.run(command, on_output, cancelled)
+        else:
+            returncode, out, stopped = _run(command, base_cwd, on_output, cancelled)
+        # 会话中的命令被终止或执行了 exit 时会话随之结束，需告知模型之前的 cd / export 已失效
+        note = "" if session is None or session.alive else f"\n{SESSION_ENDED_NOTE}"
+        if stopped == "cancelled":
+            code = "cancelled"
+            logger.info("Shell command cancelled after %.1fs: %s", time.perf_counter() - started, command[:200])
+            return False, f"{out.strip()}\n[命令已被用户中断，以上为中断前的部分输出]{note}".lstrip()
+        if stopped == "timeout":
+            code = "timeout"
+            return False, f"{out.strip()}\n[命令执行超时 ({COMMAND_TIMEOUT}s)]{note}".lstrip()
+        code = str(returncode)
+        limit = resource_limits.describe(returncode, out, oom_kills)
+        if limit is not None:
+            metrics.SHELL_LIMIT_HITS.inc(limit=limit[0])
+            logger.info("Shell command hit the %s limit: %s", limit[0], command[:200])
+            note = f"\n[资源限制] {limit[1]}{note}"
+        if returncode != 0 and not out.strip():
+            out = f"[exit code {returncode}]"
+        elif returncode != 0:
+            out = f"{out.strip()}\n[exit code {returncode}]"
+        return returncode == 0, (out.strip() or "(无输出)") + note
     except Exception as e:
         logger.exception("Shell 执行异常: %s", e)
         return False, f"[执行异常] {e!s}"
+    finally:
+        metrics.SHELL_EXEC_SECONDS.observe(time.perf_counter() - started)
+        metrics.SHELL_EXITS.inc(code=code)
@@ -0,0 +1,120 @@
+"""
+冷会话归档：长期闲置会话的消息从热数据文件移到 data/archive/<conversation_id>.json.gz，
+每个会话一个 gzip 压缩段；会话再次被访问时由 json_store 按需取回（rehydrate）。
+
+所有段共用一把跨进程锁（data/archive/segments.lock），归档与取回都很少发生，不必细分。
+"""
+from __future__ import annotations
+
+import gzip
+import hashlib
+import os
+import re
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from typing import Iterator, List, Tuple
+
+from app.storage import codecs
+from app.storage.filelock import file_lock
+
+_SAFE_NAME = re.compile(r"[A-Za-z0-9_-]+")
+SEGMENT_SUFFIX = ".json.gz"
+
+
+class SegmentArchive:
+    def __init__(self, directory: Path, fsync: bool = False) -> None:
+        self.directory = directory
+        self.fsync = fsync
+        self._stats_lock = Lock()
+        self.archived_conversations = 0
+        self.archived_messages = 0
+        self.lookups = 0
+        self.hits = 0
+        self.rehydrated_messages = 0
+
+    def path(self, conversation_id: str) -> Path:
+        name = conversation_id
+        if not _SAFE_NAME.fullmatch(name):
+            name = hashlib.sha1(name.encode("utf-8")).hexdigest()
+        return self.directory / f"{name}{SEGMENT_SUFFIX}"
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        with file_lock(self.directory / "segments"):
+            yield
+
+    def exists(self, conversation_id: str) -> bool:
+        """查询会话是否已归档（一次 stat），同时计入命中统计。"""
+        found = self.path(conversation_id).exists()
+        with self._stats_lock:
+            self.lookups += 1
+            if found:
+                self.hits += 1
+        return found
+
+    def write(self, conversation_id: str, messages: List[dict]) -> None:
+        """写入（或与已有段合并）某会话的归档段；调用方需持有 lock()。"""
+        existing = self.read(conversation_id)
+        if existing:
+            seen = {m.get("id") for m in messages}
+            messages = [m for m in existing if m.get("id") not in seen] + messages
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.path(conversation_id)
+        tmp_path = path.with_name(path.name + ".tmp")
+        payload = codecs.json_dumps_line({"conversation_id": conversation_id, "messages": messages})
+        with tmp_path.open("wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as f:
+                f.write(payload)
+            if self.fsync:
+                raw.flush()
+                os.fsync(raw.fileno())
+        tmp_path.replace(path)
+        with self._stats_lock:
+            self.archived_conversations += 1
+            self.archived_messages += len(messages)
+
+    def read(self, conversation_id: str) -> List[dict]:
+        path = self.path(conversation_id)
+        try:
+            with gzip.open(path, "rb") as f:
+                return codecs.json_loads(f.read()).get("messages", [])
+        except FileNotFoundError:
+            return []
+
+    def remove(self, conversation_id: str, rehydrated: int = 0) -> None:
+        self.path(conversation_id).unlink(missing_ok=True)
+        if rehydrated:
+            with self._stats_lock:
+                self.rehydrated_messages += rehydrated
+
+    def iter_segments(self) -> Iterator[Tuple[str, List[dict]]]:
+        """遍历全部归档段，产出 (conversation_id, messages)。"""
+        if not self.directory.exists():
+            return
+        for path in sorted(self.directory.glob(f"*{SEGMENT_SUFFIX}")):
+            with gzip.open(path, "rb") as f:
+                data = codecs.json_loads(f.read())
+            yield data.get("conversation_id", ""), data.get("messages", [])
+
+    def stats(self) -> dict:
+        segments = 0
+        size = 0
+        if self.directory.exists():
+            for path in self.directory.glob(f"*{SEGMENT_SUFFIX}"):
+                try:
+                    size += path.stat().st_size
+                except FileNotFoundError:
+                    continue
+                segments += 1
+        with self._stats_lock:
+            return {
+                "segments": segments,
+                "bytes": size,
+                "archived_conversations": self.archived_conversations,
+                "archived_messages": self.archived_messages,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_ratio": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+                "rehydrated_messages": self.rehydrated_messages,
+            }
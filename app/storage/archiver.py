@@ -0,0 +1,83 @@
+"""
+冷会话归档任务：把闲置超过 ARCHIVE_AFTER_DAYS 天的会话消息移入 data/archive/ 压缩段。
+
+ARCHIVE_AFTER_DAYS>0 时服务启动后在后台每 ARCHIVE_INTERVAL_MINUTES 分钟执行一次；
+也可在项目根目录下手动执行：
+    python -m app.storage.archiver --days 30
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import sys
+import threading
+from typing import List, Optional
+
+from app.config import get_settings
+from app.storage import json_store
+
+logger = logging.getLogger(__name__)
+
+_thread: Optional[threading.Thread] = None
+
+
+def run_once(days: float) -> dict:
+    counts = json_store.archive_cold_conversations(days)
+    if counts["conversations"]:
+        logger.info(
+            "Archived %d cold conversations (%d messages) idle for more than %s days",
+            counts["conversations"],
+            counts["messages"],
+            days,
+        )
+    return counts
+
+
+def _loop(days: float, interval: float) -> None:
+    stop = threading.Event()
+    while not stop.wait(interval):
+        try:
+            run_once(days)
+        except Exception:  # noqa: BLE001
+            logger.exception("Cold conversation archival failed")
+
+
+def start_background_archiver() -> None:
+    """按配置启动后台归档线程（每个进程至多一个；sqlite 后端或未配置时不启动）。"""
+    global _thread
+    settings = get_settings()
+    if settings.archive_after_days <= 0 or settings.storage_backend == "sqlite" or _thread is not None:
+        return
+    _thread = threading.Thread(
+        target=_loop,
+        args=(settings.archive_after_days, settings.archive_interval_minutes * 60),
+        name="json-store-archiver",
+        daemon=True,
+    )
+    _thread.start()
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="将闲置会话的消息归档到 data/archive/")
+    parser.add_argument(
+        "--days",
+        type=float,
+        default=None,
+        help="闲置天数阈值，默认取 ARCHIVE_AFTER_DAYS",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    days = args.days if args.days is not None else get_settings().archive_after_days
+    if days <= 0:
+        logger.error("请通过 --days 或 ARCHIVE_AFTER_DAYS 指定大于 0 的闲置天数")
+        return 1
+    counts = run_once(days)
+    json_store.flush()
+    logger.info("Archive: %s", json_store.archive_stats())
+    if not counts["conversations"]:
+        logger.info("No conversations to archive")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
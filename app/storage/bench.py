@@ -0,0 +1,93 @@
+"""
+数据文件编码基准：生成合成消息库，比较各编码器的保存 / 加载耗时与文件大小。
+
+用法（项目根目录下）：
+    python -m app.storage.bench                      # 默认 500k 条消息
+    python -m app.storage.bench --messages 100000 --repeat 3
+"""
+from __future__ import annotations
+
+import argparse
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List
+
+from app.storage import codecs
+
+_SAMPLES = [
+    "请帮我扫描一下 192.168.1.0/24 网段的存活主机",
+    "[执行 Shell] nmap -sn 192.168.1.0/24\n\n[Shell 输出]\nStarting Nmap 7.94 ( https://nmap.org )\n"
+    "Nmap scan report for 192.168.1.1\nHost is up (0.0021s latency).\n[Shell 输出结束]\n",
+    "已完成扫描，共发现 12 台存活主机，建议进一步对 22、80、443 端口做服务识别。",
+    "cat /etc/os-release",
+    "The target appears to run OpenSSH 8.9p1; check CVE advisories for this version.",
+]
+
+
+def synth_messages(count: int, conversations: int = 5000, seed: int = 42) -> List[dict]:
+    rng = random.Random(seed)
+    conv_ids = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(conversations)]
+    user_id = str(uuid.UUID(int=rng.getrandbits(128)))
+    start = datetime(2026, 1, 1)
+    messages = []
+    for i in range(count):
+        messages.append(
+            {
+                "id": str(uuid.UUID(int=rng.getrandbits(128))),
+                "conversation_id": conv_ids[rng.randrange(conversations)],
+                "user_id": user_id,
+                "role": "user" if i % 2 == 0 else "assistant",
+                "content": rng.choice(_SAMPLES),
+                "files": [],
+                "created_at": (start + timedelta(seconds=i)).isoformat(),
+                "tool_calls": None,
+                "tool_call_id": None,
+            }
+        )
+    return messages
+
+
+def bench_codec(name: str, data: dict, workdir: Path, repeat: int) -> dict:
+    codec = codecs.get_codec(name)
+    path = workdir / f"messages.{name}"
+    save_times, load_times = [], []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        path.write_bytes(codec.dumps(data))
+        save_times.append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        loaded = codecs.decode(path.read_bytes())
+        load_times.append(time.perf_counter() - t0)
+        assert len(loaded["messages"]) == len(data["messages"])
+    return {
+        "codec": name,
+        "size_mb": path.stat().st_size / 1024 / 1024,
+        "save_s": min(save_times),
+        "load_s": min(load_times),
+    }
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="比较数据文件编码器的加载与保存耗时")
+    parser.add_argument("--messages", type=int, default=500_000)
+    parser.add_argument("--repeat", type=int, default=1, help="每个编码器重复次数，取最快一次")
+    args = parser.parse_args(argv)
+
+    print(f"Generating {args.messages} synthetic messages ...")
+    data = {"messages": synth_messages(args.messages)}
+    print(f"Available codecs: {', '.join(codecs.available_codecs())}")
+    print(f"{'codec':<12}{'size(MB)':>10}{'save(s)':>10}{'load(s)':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in codecs.available_codecs():
+            r = bench_codec(name, data, Path(tmp), args.repeat)
+            print(f"{r['codec']:<12}{r['size_mb']:>10.1f}{r['save_s']:>10.2f}{r['load_s']:>10.2f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
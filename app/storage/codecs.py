@@ -0,0 +1,135 @@
+"""
+数据文件编解码器。写入格式由 STORE_CODEC 决定；读取时按内容自动识别，
+因此切换编码后旧文件仍可直接加载，并在下一次写入时转换为新格式。
+
+- json-pretty：标准库 json，indent=2（旧版默认格式）
+- json：标准库 json，紧凑输出
+- orjson：orjson（可选依赖），紧凑 JSON，编解码更快
+- msgpack：msgpack（可选依赖），二进制格式
+"""
+from __future__ import annotations
+
+import json
+import logging
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict
+
+try:
+    import orjson
+except ImportError:  # 可选依赖
+    orjson = None  # type: ignore[assignment]
+
+try:
+    import msgpack
+except ImportError:  # 可选依赖
+    msgpack = None  # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+
+class Codec(ABC):
+    name = ""
+
+    @abstractmethod
+    def dumps(self, data: Any) -> bytes:
+        ...
+
+    @abstractmethod
+    def loads(self, raw: bytes) -> Any:
+        ...
+
+
+class JsonCodec(Codec):
+    def __init__(self, pretty: bool) -> None:
+        self.pretty = pretty
+        self.name = "json-pretty" if pretty else "json"
+
+    def dumps(self, data: Any) -> bytes:
+        if self.pretty:
+            text = json.dumps(data, ensure_ascii=False, indent=2)
+        else:
+            text = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        return text.encode("utf-8")
+
+    def loads(self, raw: bytes) -> Any:
+        return json_loads(raw)
+
+
+class OrjsonCodec(Codec):
+    name = "orjson"
+
+    def dumps(self, data: Any) -> bytes:
+        return orjson.dumps(data)
+
+    def loads(self, raw: bytes) -> Any:
+        return orjson.loads(raw)
+
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+
+    def dumps(self, data: Any) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, raw: bytes) -> Any:
+        return msgpack.unpackb(raw, raw=False)
+
+
+_FACTORIES: Dict[str, Callable[[], Codec]] = {
+    "json-pretty": lambda: JsonCodec(pretty=True),
+    "json": lambda: JsonCodec(pretty=False),
+    "orjson": OrjsonCodec,
+    "msgpack": MsgpackCodec,
+}
+
+_AVAILABLE = {
+    "json-pretty": True,
+    "json": True,
+    "orjson": orjson is not None,
+    "msgpack": msgpack is not None,
+}
+
+_codecs: Dict[str, Codec] = {}
+
+
+def available_codecs() -> list[str]:
+    return [name for name, ok in _AVAILABLE.items() if ok]
+
+
+def get_codec(name: str) -> Codec:
+    """按名称返回编码器；未知名称或可选依赖未安装时退回紧凑 json。"""
+    if name not in _FACTORIES or not _AVAILABLE[name]:
+        if name not in _codecs:
+            logger.warning("Storage codec %r is unavailable, falling back to compact json", name)
+            _codecs[name] = _FACTORIES["json"]()
+        return _codecs[name]
+    if name not in _codecs:
+        _codecs[name] = _FACTORIES[name]()
+    return _codecs[name]
+
+
+def json_loads(raw: bytes) -> Any:
+    """解析 JSON；安装了 orjson 时使用 orjson。"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def json_dumps_line(data: Any) -> bytes:
+    """编码为单行紧凑 JSON（以换行结尾），用于 JSONL 日志。"""
+    if orjson is not None:
+        return orjson.dumps(data) + b"\n"
+    return (json.dumps(data, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def decode(raw: bytes) -> Any:
+    """
+    按内容识别格式并解析：以 { 或 [ 开头（忽略前导空白与 BOM）视为 JSON，否则视为 msgpack。
+    格式错误时抛出 ValueError。
+    """
+    head = raw.lstrip(b" \t\r\n\xef\xbb\xbf")[:1]
+    if head in (b"{", b"[") or not head:
+        return json_loads(raw.lstrip(b"\xef\xbb\xbf"))
+    if msgpack is None:
+        raise ValueError("data is not JSON and msgpack is not installed")
+    return msgpack.unpackb(raw, raw=False)
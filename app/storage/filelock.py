@@ -0,0 +1,51 @@
+"""
+跨进程文件锁：进程内用 threading.Lock 串行化，进程间用 fcntl.flock 建议锁。
+
+锁加在旁路文件 <path>.lock 上而不是数据文件本身，因为数据文件会被
+原子替换（tmp + rename），替换后旧 inode 上的锁对新文件不再生效。
+无 fcntl 的平台（Windows）退化为仅进程内加锁。
+"""
+from __future__ import annotations
+
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Iterator
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - 非 POSIX 平台
+    fcntl = None  # type: ignore[assignment]
+
+_thread_locks: Dict[str, Lock] = {}
+_thread_locks_guard = Lock()
+
+
+def _thread_lock(path: Path) -> Lock:
+    key = str(path)
+    with _thread_locks_guard:
+        lock = _thread_locks.get(key)
+        if lock is None:
+            lock = _thread_locks[key] = Lock()
+        return lock
+
+
+def lock_path_for(path: Path) -> Path:
+    return path.with_name(path.name + ".lock")
+
+
+@contextmanager
+def file_lock(path: Path, shared: bool = False) -> Iterator[None]:
+    """对 path 加锁；shared=True 为读锁（进程间可并发），否则为独占写锁。"""
+    with _thread_lock(path):
+        if fcntl is None:
+            yield
+            return
+        lock_file = lock_path_for(path)
+        lock_file.parent.mkdir(parents=True, exist_ok=True)
+        with lock_file.open("a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
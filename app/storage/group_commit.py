@@ -0,0 +1,148 @@
+"""
+后台批量提交（group commit）写入器：把多个请求提交的变更按目标文件合并，
+每个提交间隔（或积压达到阈值）对每个文件只做一次读-改-写或一次追加。
+
+调用方 submit() 立即返回 CommitTicket；需要确认变更已落盘时调用 ticket.wait()。
+读取某个文件前应先 flush(key)，以保证读到本进程已提交但尚未落盘的变更。
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 批量提交函数：接收同一 key 下按提交顺序排列的 payload 列表，返回等长结果列表；
+# 结果为异常对象表示对应变更失败
+BatchCommit = Callable[[List[Any]], List[Any]]
+
+
+class CommitTicket:
+    def __init__(self) -> None:
+        self._event = threading.Event()
+        self._result: Any = None
+        self._error: Optional[BaseException] = None
+
+    def _resolve(self, result: Any = None, error: Optional[BaseException] = None) -> None:
+        self._result = result
+        self._error = error
+        self._event.set()
+
+    @property
+    def done(self) -> bool:
+        return self._event.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> Any:
+        """阻塞直到该变更已提交（按配置 fsync），返回变更函数的结果；提交失败时抛出原异常。"""
+        if not self._event.wait(timeout):
+            raise TimeoutError("group commit did not complete in time")
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class GroupCommitWriter:
+    def __init__(self, interval: float, max_batch: int) -> None:
+        self.interval = interval
+        self.max_batch = max_batch
+        self._cond = threading.Condition()
+        self._pending: Dict[str, List[tuple[Any, CommitTicket]]] = {}
+        self._committers: Dict[str, BatchCommit] = {}
+        self._inflight: Dict[str, List[CommitTicket]] = {}
+        self._pending_count = 0
+        self._urgent = False
+        self._stopped = False
+        self.commits = 0
+        self.mutations = 0
+        self._thread = threading.Thread(target=self._run, name="json-store-group-commit", daemon=True)
+        self._thread.start()
+
+    def submit(self, key: str, commit: BatchCommit, payload: Any) -> CommitTicket:
+        ticket = CommitTicket()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("group commit writer is stopped")
+            self._committers[key] = commit
+            self._pending.setdefault(key, []).append((payload, ticket))
+            self._pending_count += 1
+            if self._pending_count >= self.max_batch:
+                self._urgent = True
+            self._cond.notify_all()
+        return ticket
+
+    def flush(self, key: Optional[str] = None) -> None:
+        """立即提交 key（None 表示全部）下积压的变更并等待完成。"""
+        with self._cond:
+            keys = [key] if key is not None else list(set(self._pending) | set(self._inflight))
+            tickets = [t for k in keys for t in self._inflight.get(k, [])]
+            tickets += [t for k in keys for _, t in self._pending.get(k, [])]
+            if not tickets:
+                return
+            self._urgent = True
+            self._cond.notify_all()
+        for ticket in tickets:
+            ticket._event.wait()
+
+    def stop(self) -> None:
+        """提交全部积压变更后停止后台线程（进程退出时调用）。"""
+        with self._cond:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._urgent = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "commits": self.commits,
+                "mutations": self.mutations,
+                "pending": self._pending_count,
+                "avg_batch": round(self.mutations / self.commits, 2) if self.commits else 0.0,
+            }
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if not self._pending and self._stopped:
+                    return
+                # 等满一个提交间隔，期间积压达到阈值或有人 flush 则提前提交
+                deadline = time.monotonic() + self.interval
+                while not self._urgent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending
+                self._pending = {}
+                self._pending_count = 0
+                self._urgent = False
+                self._inflight = {k: [t for _, t in items] for k, items in batch.items()}
+                committers = {k: self._committers[k] for k in batch}
+            for key, items in batch.items():
+                self._commit(key, committers[key], items)
+            with self._cond:
+                self._inflight = {}
+
+    def _commit(self, key: str, commit: BatchCommit, items: List[tuple[Any, CommitTicket]]) -> None:
+        try:
+            results = commit([payload for payload, _ in items])
+        except BaseException as exc:  # noqa: BLE001
+            logger.exception("Group commit failed for %s (%d mutations)", key, len(items))
+            for _, ticket in items:
+                ticket._resolve(error=exc)
+            return
+        with self._cond:
+            self.commits += 1
+            self.mutations += len(items)
+        for (_, ticket), result in zip(items, results):
+            # 批量提交函数以异常对象表示单个变更失败，其余变更照常提交
+            if isinstance(result, BaseException):
+                ticket._resolve(error=result)
+            else:
+                ticket._resolve(result)
@@ -1,85 +1,806 @@
 from __future__ import annotations
 
-import json
+import atexit
+import hashlib
+import os
+import re
+import shutil
+import time
+from datetime import datetime, timedelta
 from pathlib import Path
 from threading import Lock
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, TypeVar
 
-from app.config import PROJECT_ROOT
+from app.config import PROJECT_ROOT, get_settings
+from app.storage import codecs, sqlite_store
+from app.storage.archive import SegmentArchive
+from app.storage.filelock import file_lock
+from app.storage.group_commit import GroupCommitWriter
+from app.storage.message_log import MessageLog
+from app.utils import metrics, tracing
 
 
 DATA_DIR = PROJECT_ROOT / "data"
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
-_locks: Dict[str, Lock] = {}
+T = TypeVar("T")
 
+_writer: Optional[GroupCommitWriter] = None
+_writer_guard = Lock()
 
-def _get_lock(name: str) -> Lock:
-    if name not in _locks:
-        _locks[name] = Lock()
-    return _locks[name]
+
+def _get_writer() -> Optional[GroupCommitWriter]:
+    """STORE_GROUP_COMMIT 开启时返回进程内唯一的后台批量写入器，否则返回 None。"""
+    global _writer
+    settings = get_settings()
+    if not settings.store_group_commit:
+        return None
+    if _writer is None:
+        with _writer_guard:
+            if _writer is None:
+                _writer = GroupCommitWriter(
+                    interval=settings.store_commit_interval_ms / 1000,
+                    max_batch=settings.store_commit_max_batch,
+                )
+                atexit.register(_writer.stop)
+    return _writer
+
+
+def _flush_pending(path: Path) -> None:
+    """读取前先提交本进程对该文件尚未落盘的变更，保证读到自己的写入。"""
+    if _writer is not None:
+        _writer.flush(str(path))
+
+
+def flush() -> None:
+    """等待所有已提交到后台写入器的变更落盘（未开启批量提交时为空操作）。"""
+    if _writer is not None:
+        _writer.flush()
+
+
+def _fsync_dir(path: Path) -> None:
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _metric_label(path: Path) -> str:
+    """指标中的文件标签：data/ 下的文件取文件名，按用户 / 会话拆分的文件取所在目录名，避免标签无限增长。"""
+    return path.stem if path.parent == DATA_DIR else path.parent.name
+
+
+def _load_file(path: Path, default: Any) -> Any:
+    """读取数据文件，格式（JSON / msgpack）按内容自动识别。"""
+    if not path.exists():
+        return default
+    started = time.perf_counter()
+    raw = path.read_bytes()
+    try:
+        return codecs.decode(raw)
+    except ValueError:
+        return default
+    finally:
+        label = _metric_label(path)
+        metrics.STORE_READ_SECONDS.observe(time.perf_counter() - started, file=label)
+        metrics.STORE_READ_BYTES.inc(len(raw), file=label)
+
+
+def _dump_file(path: Path, data: Any) -> None:
+    """以 STORE_CODEC 指定的格式原子写入数据文件。"""
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    settings = get_settings()
+    fsync = settings.store_fsync
+    started = time.perf_counter()
+    raw = codecs.get_codec(settings.store_codec).dumps(data)
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with tmp_path.open("wb") as f:
+        f.write(raw)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    tmp_path.replace(path)
+    if fsync:
+        _fsync_dir(path.parent)
+    label = _metric_label(path)
+    metrics.STORE_WRITE_SECONDS.observe(time.perf_counter() - started, file=label)
+    metrics.STORE_WRITE_BYTES.inc(len(raw), file=label)
 
 
 def _read_json(path: Path, default: Any) -> Any:
-    lock = _get_lock(str(path))
-    with lock:
-        if not path.exists():
-            return default
-        with path.open("r", encoding="utf-8") as f:
-            try:
-                return json.load(f)
-            except json.JSONDecodeError:
-                return default
+    _flush_pending(path)
+    with file_lock(path, shared=True):
+        return _load_file(path, default)
 
 
 def _write_json(path: Path, data: Any) -> None:
-    lock = _get_lock(str(path))
-    DATA_DIR.mkdir(parents=True, exist_ok=True)
-    with lock:
-        tmp_path = path.with_suffix(path.suffix + ".tmp")
-        with tmp_path.open("w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        tmp_path.replace(path)
+    if _get_writer() is not None:
+        # 经写入器排队，保证与之前提交的变更保持先后顺序
+        root_key = next(iter(data))
+        _update_json(path, root_key, lambda items: items.__setitem__(slice(None), data[root_key]))
+        return
+    with file_lock(path):
+        _dump_file(path, data)
+
+
+def _json_batch_committer(path: Path, root_key: str):
+    """批量提交：一次加锁读取，按顺序应用所有变更，有改动时只写回一次。"""
+
+    def commit(mutations: List[Callable[[List[dict]], Any]]) -> List[Any]:
+        results: List[Any] = []
+        with file_lock(path):
+            data = _load_file(path, {root_key: []})
+            items = data.setdefault(root_key, [])
+            changed = False
+            for mutate in mutations:
+                try:
+                    result = mutate(items)
+                except Exception as exc:  # noqa: BLE001
+                    results.append(exc)
+                    continue
+                changed = changed or result is not False
+                results.append(result)
+            if changed:
+                _dump_file(path, data)
+        return results
+
+    return commit
+
+
+def _update_json(path: Path, root_key: str, mutate: Callable[[List[dict]], T], wait: bool = True) -> Optional[T]:
+    """
+    读-改-写事务：在跨进程独占锁内读取 path 下 root_key 列表，调用 mutate 原地修改，
+    再整体写回。mutate 返回 False 表示无改动，跳过写回；返回值原样传给调用方。
+
+    开启批量提交时变更交给后台写入器与其他变更合并提交；wait=False 时不等待落盘，返回 None。
+    """
+    writer = _get_writer()
+    if writer is not None:
+        ticket = writer.submit(str(path), _json_batch_committer(path, root_key), mutate)
+        return ticket.wait() if wait else None
+    with file_lock(path):
+        data = _load_file(path, {root_key: []})
+        items = data.setdefault(root_key, [])
+        result = mutate(items)
+        if result is not False:
+            _dump_file(path, data)
+        return result
+
+
+class _FileCache:
+    """
+    缓存某个 JSON 文件解析后的列表，并按若干字段建立索引。
+    每次访问用 (inode, mtime, size) 校验文件是否被改动（包括其他进程写入），
+    本进程通过 save_* 写入时主动失效。文件不存在时以 _ABSENT 作为签名缓存空结果，文件出现后即失效。
+    """
+
+    _ABSENT = ("absent",)
+
+    def __init__(self, path: Path, root_key: str, index_fields: tuple[str, ...]) -> None:
+        self.path = path
+        self.root_key = root_key
+        self.index_fields = index_fields
+        self._lock = Lock()
+        self._signature: tuple | None = None
+        self._indexes: Dict[str, Dict[str, dict]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _stat_signature(self) -> tuple:
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            return self._ABSENT
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def lookup(self, field: str, value: str) -> Optional[dict]:
+        with self._lock:
+            signature = self._stat_signature()
+            if self._signature is not None and signature == self._signature:
+                self.hits += 1
+            else:
+                self.misses += 1
+                items = _read_json(self.path, {self.root_key: []}).get(self.root_key, [])
+                indexes: Dict[str, Dict[str, dict]] = {f: {} for f in self.index_fields}
+                for item in items:
+                    for f in self.index_fields:
+                        key = item.get(f)
+                        if isinstance(key, str):
+                            indexes[f].setdefault(key, item)
+                self._indexes = indexes
+                self._signature = signature
+            item = self._indexes[field].get(value)
+            return dict(item) if item is not None else None
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._signature = None
+            self._indexes = {}
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
 
 
 USERS_FILE = DATA_DIR / "users.json"
 CONVERSATIONS_FILE = DATA_DIR / "conversations.json"
 MESSAGES_FILE = DATA_DIR / "messages.json"
 SETTINGS_FILE = DATA_DIR / "settings.json"
+MESSAGE_LOG_FILE = DATA_DIR / "messages.jsonl"
+MESSAGE_INDEX_FILE = DATA_DIR / "messages.idx"
+CONVERSATION_INDEX_DIR = DATA_DIR / "conversation_index"
+ARCHIVE_DIR = DATA_DIR / "archive"
+_SAFE_NAME = re.compile(r"[A-Za-z0-9_-]+")
+
+_users_cache = _FileCache(USERS_FILE, "users", ("id", "username"))
+_settings_cache = _FileCache(SETTINGS_FILE, "settings", ("user_id",))
+
+_message_log = MessageLog(MESSAGE_LOG_FILE, MESSAGE_INDEX_FILE)
+_message_log_migrated = False
+_archive = SegmentArchive(ARCHIVE_DIR)
+
+
+def _use_sqlite() -> bool:
+    return get_settings().storage_backend == "sqlite"
+
+
+def _use_message_log() -> bool:
+    return get_settings().message_store == "jsonl"
+
+
+def _get_message_log(flush: bool = True) -> MessageLog:
+    """
+    返回追加式消息日志；flush=True 时先提交本进程积压的追加，之后可直接读写。
+    首次启用时将 messages.json 中的历史消息一次性导入。
+    """
+    global _message_log_migrated
+    _message_log.fsync = get_settings().store_fsync
+    if flush:
+        _flush_pending(MESSAGE_LOG_FILE)
+    if not _message_log_migrated:
+        # 持有 messages.json 的独占锁，避免多个 worker 重复导入
+        with file_lock(MESSAGES_FILE):
+            if not _message_log_migrated:
+                if not _message_log.exists():
+                    legacy = _load_file(MESSAGES_FILE, {"messages": []}).get("messages", [])
+                    if legacy:
+                        _message_log.rewrite(legacy)
+                _message_log_migrated = True
+    return _message_log
+
+
+def _log_append(message: dict, durable: bool = False) -> None:
+    writer = _get_writer()
+    log = _get_message_log(flush=False)
+    if writer is None:
+        log.append(message)
+        return
+
+    def commit(records: List[dict]) -> List[None]:
+        log.append_many(records)
+        return [None] * len(records)
+
+    ticket = writer.submit(str(MESSAGE_LOG_FILE), commit, message)
+    if durable:
+        ticket.wait()
 
 
 def load_users() -> List[dict]:
+    if _use_sqlite():
+        return sqlite_store.load_users()
     data = _read_json(USERS_FILE, {"users": []})
     return data.get("users", [])
 
 
 def save_users(users: List[dict]) -> None:
+    if _use_sqlite():
+        sqlite_store.save_users(users)
+        return
     _write_json(USERS_FILE, {"users": users})
+    _users_cache.invalidate()
+
+
+def get_user_by_id(user_id: str) -> Optional[dict]:
+    if _use_sqlite():
+        return sqlite_store.get_user_by_id(user_id)
+    return _users_cache.lookup("id", user_id)
+
+
+def get_user_by_username(username: str) -> Optional[dict]:
+    if _use_sqlite():
+        return sqlite_store.get_user_by_username(username)
+    return _users_cache.lookup("username", username)
+
+
+def update_user(user_id: str, fields: dict) -> None:
+    if _use_sqlite():
+        sqlite_store.update_user(user_id, fields)
+        return
+
+    def mutate(users: List[dict]) -> bool:
+        for u in users:
+            if u.get("id") == user_id:
+                u.update(fields)
+                return True
+        return False
+
+    _update_json(USERS_FILE, "users", mutate)
+    _users_cache.invalidate()
+
+
+def create_user_if_none(user: dict) -> bool:
+    """仅当尚无任何用户时创建该用户（多 worker 同时启动时只会创建一次），返回是否创建。"""
+    if _use_sqlite():
+        return sqlite_store.create_user_if_none(user)
+
+    def mutate(users: List[dict]) -> bool:
+        if users:
+            return False
+        users.append(user)
+        return True
+
+    created = _update_json(USERS_FILE, "users", mutate)
+    _users_cache.invalidate()
+    return created
 
 
 def load_conversations() -> List[dict]:
+    if _use_sqlite():
+        return sqlite_store.load_conversations()
     data = _read_json(CONVERSATIONS_FILE, {"conversations": []})
     return data.get("conversations", [])
 
 
 def save_conversations(conversations: List[dict]) -> None:
+    if _use_sqlite():
+        sqlite_store.save_conversations(conversations)
+        return
     _write_json(CONVERSATIONS_FILE, {"conversations": conversations})
+    _drop_summary_indexes()
+
+
+# ---------- 每用户会话摘要索引（侧栏用） ----------
+# data/conversation_index/<user_id>.json 只保存 id / title / updated_at / message_count，
+# 按 updated_at 倒序排列，由新增会话、追加消息、删除会话增量维护；文件缺失时从会话表重建。
+
+def _summary_path(user_id: str) -> Path:
+    name = user_id if _SAFE_NAME.fullmatch(user_id) else hashlib.sha1(user_id.encode("utf-8")).hexdigest()
+    return CONVERSATION_INDEX_DIR / f"{name}.json"
+
+
+def _summary_of(conversation: dict) -> dict:
+    return {
+        "id": conversation.get("id"),
+        "title": conversation.get("title", ""),
+        "updated_at": conversation.get("updated_at"),
+        "message_count": len(conversation.get("message_ids") or []),
+    }
+
+
+def _insert_summary(summaries: List[dict], summary: dict) -> None:
+    """按 updated_at 倒序插入（追加消息的会话通常落在首位）；已存在同 id 的条目时先移除。"""
+    summaries[:] = [item for item in summaries if item.get("id") != summary.get("id")]
+    updated_at = summary.get("updated_at") or ""
+    pos = 0
+    while pos < len(summaries) and (summaries[pos].get("updated_at") or "") > updated_at:
+        pos += 1
+    summaries.insert(pos, summary)
+
+
+def _ensure_summary_index(user_id: str) -> Path:
+    path = _summary_path(user_id)
+    if path.exists():
+        return path
+    convs = [c for c in load_conversations() if c.get("user_id") == user_id]
+    convs.sort(key=lambda c: c.get("updated_at") or "", reverse=True)
+    with file_lock(path):
+        if not path.exists():
+            CONVERSATION_INDEX_DIR.mkdir(parents=True, exist_ok=True)
+            _dump_file(path, {"conversations": [_summary_of(c) for c in convs]})
+    return path
+
+
+def _drop_summary_indexes() -> None:
+    """会话表被整体替换后，删除全部摘要索引，下次访问时重建。"""
+    flush()
+    shutil.rmtree(CONVERSATION_INDEX_DIR, ignore_errors=True)
+
+
+def list_conversation_summaries(user_id: str) -> List[dict]:
+    """返回某用户的会话摘要（id / title / updated_at / message_count），按 updated_at 倒序。"""
+    if _use_sqlite():
+        return sqlite_store.list_conversation_summaries(user_id)
+    return _read_json(_ensure_summary_index(user_id), {"conversations": []}).get("conversations", [])
+
+
+def get_conversation(conversation_id: str) -> Optional[dict]:
+    if _use_sqlite():
+        return sqlite_store.get_conversation(conversation_id)
+    for c in load_conversations():
+        if c.get("id") == conversation_id:
+            _rehydrate(conversation_id)
+            return c
+    return None
+
+
+def list_user_conversations(user_id: str) -> List[dict]:
+    """返回某用户的会话（按 updated_at 倒序）。"""
+    if _use_sqlite():
+        return sqlite_store.list_user_conversations(user_id)
+    convs = [c for c in load_conversations() if c.get("user_id") == user_id]
+    convs.sort(key=lambda c: c.get("updated_at") or "", reverse=True)
+    return convs
+
+
+def add_conversation(conversation: dict, durable: bool = False) -> None:
+    """新增会话并写入摘要索引；durable=True 时等到变更落盘后再返回（默认交给批量提交，不等待）。"""
+    if _use_sqlite():
+        sqlite_store.add_conversation(conversation)
+        return
+    _update_json(CONVERSATIONS_FILE, "conversations", lambda convs: convs.append(conversation), wait=durable)
+    summary = _summary_of(conversation)
+    _update_json(
+        _ensure_summary_index(conversation["user_id"]),
+        "conversations",
+        lambda summaries: _insert_summary(summaries, summary),
+        wait=durable,
+    )
+
+
+def update_conversation(conversation_id: str, fields: dict) -> None:
+    """合并更新会话记录的字段（如 context_summary）；不改变 updated_at 与摘要索引。"""
+    if _use_sqlite():
+        sqlite_store.update_conversation(conversation_id, fields)
+        return
+
+    def mutate(conversations: List[dict]) -> bool:
+        for c in conversations:
+            if c.get("id") == conversation_id:
+                c.update(fields)
+                return True
+        return False
+
+    _update_json(CONVERSATIONS_FILE, "conversations", mutate)
+
+
+def touch_conversation(
+    conversation_id: str, user_id: str, message_id: str, updated_at: str, durable: bool = False
+) -> None:
+    """
+    会话新增一条消息后记录 message_id、刷新 updated_at，并更新该用户的会话摘要索引；
+    durable=True 时等到变更落盘后再返回。
+    """
+    if _use_sqlite():
+        sqlite_store.touch_conversation(conversation_id, message_id, updated_at)
+        return
+
+    def mutate(conversations: List[dict]) -> bool:
+        for c in conversations:
+            if c.get("id") == conversation_id:
+                c.setdefault("message_ids", []).append(message_id)
+                c["updated_at"] = updated_at
+                return True
+        return False
+
+    _update_json(CONVERSATIONS_FILE, "conversations", mutate, wait=durable)
+
+    def touch_summary(summaries: List[dict]) -> bool:
+        for i, item in enumerate(summaries):
+            if item.get("id") == conversation_id:
+                summary = summaries.pop(i)
+                summary["updated_at"] = updated_at
+                summary["message_count"] = int(summary.get("message_count") or 0) + 1
+                _insert_summary(summaries, summary)
+                return True
+        return False
+
+    _update_json(_ensure_summary_index(user_id), "conversations", touch_summary, wait=durable)
+
+
+def delete_conversation(conversation_id: str, user_id: str) -> bool:
+    """删除属于该用户的会话及其消息，返回是否删除成功。"""
+    if _use_sqlite():
+        return sqlite_store.delete_conversation(conversation_id, user_id)
+
+    def mutate(conversations: List[dict]) -> bool:
+        before = len(conversations)
+        conversations[:] = [
+            c for c in conversations if not (c.get("id") == conversation_id and c.get("user_id") == user_id)
+        ]
+        return len(conversations) != before
+
+    if not _update_json(CONVERSATIONS_FILE, "conversations", mutate):
+        return False
+    _update_json(
+        _ensure_summary_index(user_id),
+        "conversations",
+        lambda summaries: summaries.__setitem__(
+            slice(None), [item for item in summaries if item.get("id") != conversation_id]
+        ),
+        wait=False,
+    )
+    delete_conversation_messages(conversation_id)
+    return True
 
 
 def load_messages() -> List[dict]:
+    if _use_sqlite():
+        return sqlite_store.load_messages()
+    if _use_message_log():
+        return list(_get_message_log().iter_all())
     data = _read_json(MESSAGES_FILE, {"messages": []})
     return data.get("messages", [])
 
 
 def save_messages(messages: List[dict]) -> None:
+    if _use_sqlite():
+        sqlite_store.save_messages(messages)
+        return
+    if _use_message_log():
+        _get_message_log().rewrite(messages)
+        return
     _write_json(MESSAGES_FILE, {"messages": messages})
 
 
+def append_message(message: dict, durable: bool = False) -> None:
+    """
+    追加一条消息。jsonl 模式下为 O(1) 追加，json 模式下整文件重写。
+    默认交给批量提交后立即返回；durable=True 时等到这条消息落盘（按 STORE_FSYNC）后再返回。
+    """
+    with tracing.span("store.append", role=message.get("role")):
+        if _use_sqlite():
+            sqlite_store.append_message(message)
+            return
+        if _use_message_log():
+            _log_append(message, durable)
+            return
+        _update_json(MESSAGES_FILE, "messages", lambda messages: messages.append(message), wait=durable)
+
+
+def load_conversation_messages(
+    conversation_id: str, limit: Optional[int] = None, before: Optional[str] = None
+) -> List[dict]:
+    """
+    按写入顺序返回某会话的消息。before 为消息 id 游标（只返回其之前的消息，游标不存在时返回空），
+    limit 为只返回最新的若干条。jsonl / sqlite 模式下只读取目标页的记录。
+    """
+    with tracing.span("store.load", limit=limit):
+        return _load_conversation_messages(conversation_id, limit, before)
+
+
+def _load_conversation_messages(conversation_id: str, limit: Optional[int], before: Optional[str]) -> List[dict]:
+    if _use_sqlite():
+        return sqlite_store.load_conversation_messages(conversation_id, limit, before)
+    _rehydrate(conversation_id)
+    if _use_message_log():
+        return _get_message_log().read_conversation(conversation_id, limit, before)
+    messages = [m for m in load_messages() if m.get("conversation_id") == conversation_id]
+    end = len(messages)
+    if before is not None:
+        end = next((i for i in range(end - 1, -1, -1) if messages[i].get("id") == before), 0)
+    start = 0 if limit is None else max(0, end - limit)
+    return messages[start:end]
+
+
+def read_messages_since(cursor: Optional[tuple]) -> Tuple[List[dict], tuple]:
+    """
+    增量读取消息（供进程内搜索索引追上其他 worker 的写入）：返回 cursor 之后新增的消息与新游标，
+    cursor=None 表示从头读取。结果可能与之前返回的重复（如 json 模式下文件一变就返回全部消息），
+    也可能包含已删除会话的消息，调用方按消息 id 去重并自行过滤。
+    """
+    if _use_sqlite():
+        seq = cursor[1] if cursor and cursor[0] == "sqlite" else 0
+        records, seq = sqlite_store.load_messages_after(seq)
+        return records, ("sqlite", seq)
+    if _use_message_log():
+        position = cursor[1:] if cursor and cursor[0] == "jsonl" else None
+        records, position = _get_message_log().read_since(position)
+        return records, ("jsonl", *position)
+    _flush_pending(MESSAGES_FILE)
+    try:
+        st = MESSAGES_FILE.stat()
+    except FileNotFoundError:
+        return [], ("json", None)
+    signature = ("json", st.st_ino, st.st_mtime_ns, st.st_size)
+    if cursor == signature:
+        return [], signature
+    return load_messages(), signature
+
+
+def find_messages(wanted: Dict[str, Set[str]]) -> Dict[str, dict]:
+    """
+    按 {会话 id: 消息 id 集合} 读取若干条消息（供检索结果生成片段），返回 {消息 id: 消息}。
+    与 load_conversation_messages 不同，已归档会话的消息直接从归档段读取，不放回热数据；
+    jsonl / sqlite 模式下只读取命中的记录，json 模式下整个消息文件只扫描一次。
+    """
+    ids: Set[str] = set().union(*wanted.values()) if wanted else set()
+    if _use_sqlite():
+        return {m["id"]: m for m in sqlite_store.load_messages_by_ids(ids)}
+    found: Dict[str, dict] = {}
+    for conversation_id, message_ids in wanted.items():
+        if _archive.exists(conversation_id):
+            found.update((m["id"], m) for m in _archive.read(conversation_id) if m.get("id") in message_ids)
+    if _use_message_log():
+        log = _get_message_log()
+        for conversation_id, message_ids in wanted.items():
+            missing = message_ids - found.keys()
+            if missing:
+                found.update((m["id"], m) for m in log.read_messages(conversation_id, missing))
+    elif len(found) < len(ids):
+        found.update((m["id"], m) for m in load_messages() if m.get("id") in ids and m["id"] not in found)
+    return found
+
+
+def iter_archived_messages() -> Iterator[dict]:
+    """遍历已归档（冷会话）的全部消息。"""
+    for _, messages in _archive.iter_segments():
+        yield from messages
+
+
+def delete_conversation_messages(conversation_id: str) -> None:
+    if _use_sqlite():
+        sqlite_store.delete_conversation_messages(conversation_id)
+        return
+    if _archive.path(conversation_id).exists():
+        with _archive.lock():
+            _archive.remove(conversation_id)
+    if _use_message_log():
+        _get_message_log().delete_conversation(conversation_id)
+        return
+
+    def mutate(messages: List[dict]) -> bool:
+        before = len(messages)
+        messages[:] = [m for m in messages if m.get("conversation_id") != conversation_id]
+        return len(messages) != before
+
+    _update_json(MESSAGES_FILE, "messages", mutate)
+
+
+# ---------- 冷会话归档（仅 json 后端） ----------
+
+def archive_cold_conversations(max_idle_days: float) -> Dict[str, int]:
+    """
+    把 updated_at 早于 max_idle_days 天前的会话消息移出热数据文件（messages.json / messages.jsonl），
+    写入 data/archive/ 下的压缩段；会话记录与摘要索引保持不变。返回本次归档的会话数与消息数。
+    """
+    counts = {"conversations": 0, "messages": 0}
+    if _use_sqlite():
+        return counts
+    cutoff = (datetime.utcnow() - timedelta(days=max_idle_days)).isoformat()
+    cold = {c["id"] for c in load_conversations() if c.get("id") and (c.get("updated_at") or "") < cutoff}
+    if not cold:
+        return counts
+    _archive.fsync = get_settings().store_fsync
+
+    def keep(conversation_id: str, messages: List[dict]) -> bool:
+        _archive.write(conversation_id, messages)
+        counts["conversations"] += 1
+        counts["messages"] += len(messages)
+        return True
+
+    with _archive.lock():
+        if _use_message_log():
+            log = _get_message_log()
+            for conversation_id in sorted(cold):
+                log.extract_conversation(conversation_id, lambda records: keep(conversation_id, records))
+            if counts["conversations"]:
+                log.compact()
+            return counts
+
+        def mutate(messages: List[dict]) -> bool:
+            groups: Dict[str, List[dict]] = {}
+            hot: List[dict] = []
+            for m in messages:
+                if m.get("conversation_id") in cold:
+                    groups.setdefault(m["conversation_id"], []).append(m)
+                else:
+                    hot.append(m)
+            if not groups:
+                return False
+            # 先写归档段再改写热文件：中途失败时消息至多两处重复（取回时按 id 去重），不会丢失
+            for conversation_id, items in groups.items():
+                keep(conversation_id, items)
+            messages[:] = hot
+            return True
+
+        _update_json(MESSAGES_FILE, "messages", mutate)
+    return counts
+
+
+def _rehydrate(conversation_id: str) -> None:
+    """会话已归档时把归档段中的消息放回热数据文件（排在该会话现有消息之前），再删除归档段。"""
+    if not _archive.exists(conversation_id):
+        return
+    with _archive.lock():
+        archived = _archive.read(conversation_id)
+        if archived and _use_message_log():
+            _get_message_log().restore_conversation(conversation_id, archived)
+        elif archived:
+
+            def mutate(messages: List[dict]) -> bool:
+                hot_ids = {m.get("id") for m in messages if m.get("conversation_id") == conversation_id}
+                missing = [m for m in archived if m.get("id") not in hot_ids]
+                if not missing:
+                    return False
+                pos = next(
+                    (i for i, m in enumerate(messages) if m.get("conversation_id") == conversation_id),
+                    len(messages),
+                )
+                messages[pos:pos] = missing
+                return True
+
+            _update_json(MESSAGES_FILE, "messages", mutate)
+        _archive.remove(conversation_id, rehydrated=len(archived))
+
+
+def compact_messages() -> None:
+    """jsonl 模式下回收已删除会话占用的日志空间；其他模式无需处理。"""
+    if _use_message_log() and not _use_sqlite():
+        _get_message_log().compact()
+
+
 def load_settings() -> List[dict]:
+    if _use_sqlite():
+        return sqlite_store.load_settings()
     data = _read_json(SETTINGS_FILE, {"settings": []})
     return data.get("settings", [])
 
 
 def save_settings(settings: List[dict]) -> None:
+    if _use_sqlite():
+        sqlite_store.save_settings(settings)
+        return
     _write_json(SETTINGS_FILE, {"settings": settings})
+    _settings_cache.invalidate()
+
+
+def get_user_settings(user_id: str) -> Optional[dict]:
+    if _use_sqlite():
+        return sqlite_store.get_user_settings(user_id)
+    return _settings_cache.lookup("user_id", user_id)
+
+
+def update_user_settings(user_id: str, fields: dict) -> None:
+    """合并更新某用户的设置项，不存在时新建。"""
+    if _use_sqlite():
+        sqlite_store.update_user_settings(user_id, fields)
+        return
+
+    def mutate(settings: List[dict]) -> None:
+        for item in settings:
+            if item.get("user_id") == user_id:
+                item.update(fields)
+                return
+        settings.append({"user_id": user_id, **fields})
+
+    _update_json(SETTINGS_FILE, "settings", mutate)
+    _settings_cache.invalidate()
+
+
+def cache_stats() -> Dict[str, Any]:
+    """users / settings 查询缓存的命中统计（仅 json 后端使用缓存）。"""
+    return {
+        "backend": get_settings().storage_backend,
+        "users": _users_cache.stats(),
+        "settings": _settings_cache.stats(),
+    }
+
+
+def archive_stats() -> dict:
+    """归档段数量与总大小，以及本进程的归档、命中（访问到已归档会话）与取回统计。"""
+    return {"after_days": get_settings().archive_after_days, **_archive.stats()}
+
 
+def writer_stats() -> dict:
+    """后台批量写入器的提交次数、合并的变更数与当前积压。"""
+    if _writer is None:
+        return {"enabled": get_settings().store_group_commit}
+    return {"enabled": True, **_writer.stats()}
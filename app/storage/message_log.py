@@ -0,0 +1,353 @@
+"""
+追加式消息日志：消息逐行写入 JSONL 段文件，另维护一份同样只追加的侧索引，
+记录 conversation_id -> [(字节偏移, 长度, message_id)]。
+
+- 追加一条消息只写两行（日志一行 + 索引一行），与历史消息总量无关；
+- 读取某个会话时只 seek 读取该会话的记录；
+- 删除会话只在索引中追加一条删除标记，日志空间由 compact() 回收。
+
+写操作持有跨进程独占锁，读操作持有共享锁，多个 worker 进程可同时使用；
+各进程的内存索引在每次访问时增量追读索引文件，从而看到其他进程的写入。
+
+崩溃恢复：
+- 整体加载索引时核对其最后一条记录与日志中对应位置的记录是否一致。compact / rewrite 先替换日志再替换索引，
+  两次替换之间崩溃会留下新日志与旧索引，此时按日志重建索引（只读访问先在内存中重建，下一次写入时落盘）；
+- 日志尾部未被索引的完整记录在写入前补进索引；崩溃留下的不完整尾行被截掉，避免下一条记录接在其后无法解析。
+
+索引行格式（字段以制表符分隔）：
+    A  <conversation_id>  <offset>  <length>  <message_id>    追加
+    D  <conversation_id>                                     删除会话
+"""
+from __future__ import annotations
+
+import logging
+import os
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from app.storage.codecs import json_dumps_line, json_loads
+from app.storage.filelock import file_lock
+
+logger = logging.getLogger(__name__)
+
+# (offset, length, message_id)
+IndexEntry = Tuple[int, int, str]
+
+
+def _encode(record: dict) -> bytes:
+    return json_dumps_line(record)
+
+
+class MessageLog:
+    def __init__(self, log_path: Path, index_path: Path, fsync: bool = False) -> None:
+        self.log_path = log_path
+        self.index_path = index_path
+        # 为 True 时每次写入后 fsync 日志与索引
+        self.fsync = fsync
+        self._offsets: Dict[str, List[IndexEntry]] = {}
+        self._index_pos = 0
+        self._index_ino: int | None = None
+        self._log_end = 0
+        # 偏移最大的一条索引记录，用于核对索引与日志是否匹配
+        self._last_entry: Optional[IndexEntry] = None
+        # 索引与日志不匹配、内存中为按日志重建的索引（索引文件尚未重写）
+        self._stale = False
+
+    # ---------- 索引维护 ----------
+
+    def _apply_index_line(self, line: str) -> None:
+        parts = line.rstrip("\n").split("\t")
+        if parts[0] == "A" and len(parts) == 5:
+            offset, length = int(parts[2]), int(parts[3])
+            self._offsets.setdefault(parts[1], []).append((offset, length, parts[4]))
+            if offset + length > self._log_end:
+                self._log_end = offset + length
+                self._last_entry = (offset, length, parts[4])
+        elif parts[0] == "D" and len(parts) == 2:
+            self._offsets.pop(parts[1], None)
+
+    def _refresh(self, writable: bool = False) -> None:
+        """
+        增量读取索引文件中尚未加载的行；索引被整体替换（compact）时重新加载。
+        writable=True（持有独占锁）时顺带补齐日志尾部未被索引的记录。
+        """
+        if not self.index_path.exists():
+            if self._index_ino is not None:
+                self._reset()
+            if writable:
+                self._recover_tail()
+            return
+        st = self.index_path.stat()
+        if self._index_ino is not None and (st.st_ino != self._index_ino or st.st_size < self._index_pos):
+            self._reset()
+        if self._stale:
+            if writable:
+                self._rebuild_index()
+            return
+        loading = self._index_pos == 0
+        if st.st_size > self._index_pos:
+            with self.index_path.open("rb") as f:
+                f.seek(self._index_pos)
+                data = f.read()
+            # 只消费完整的行，未写完的尾行留到下次
+            end = data.rfind(b"\n") + 1
+            for raw in data[:end].decode("utf-8").splitlines():
+                if raw:
+                    self._apply_index_line(raw)
+            self._index_pos += end
+        self._index_ino = st.st_ino
+        if loading and not self._matches_log():
+            logger.warning("Index %s does not match %s, rebuilding it from the log", self.index_path, self.log_path)
+            if writable:
+                self._rebuild_index()
+                return
+            self._offsets, self._log_end, self._last_entry = {}, 0, None
+            for line in self._scan_log(0)[0]:
+                self._apply_index_line(line)
+            self._stale = True
+            return
+        if writable:
+            self._recover_tail()
+
+    def _reset(self) -> None:
+        self._offsets = {}
+        self._index_pos = 0
+        self._index_ino = None
+        self._log_end = 0
+        self._last_entry = None
+        self._stale = False
+
+    def _matches_log(self) -> bool:
+        """索引中偏移最大的记录在日志的对应位置上是否确为该消息。"""
+        if self._last_entry is None:
+            return True
+        offset, length, message_id = self._last_entry
+        try:
+            with self.log_path.open("rb") as f:
+                f.seek(offset)
+                raw = f.read(length)
+            record = json_loads(raw)
+        except (FileNotFoundError, ValueError):
+            return False
+        return len(raw) == length and isinstance(record, dict) and record.get("id", "") == message_id
+
+    def _scan_log(self, start: int) -> Tuple[List[str], int]:
+        """从 start 起顺序扫描日志，返回各完整记录的索引行，以及最后一个完整行的结束偏移。"""
+        lines: List[str] = []
+        offset = start
+        with self.log_path.open("rb") as f:
+            f.seek(start)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break
+                try:
+                    record = json_loads(raw)
+                except ValueError:
+                    offset += len(raw)
+                    continue
+                lines.append(
+                    f"A\t{record.get('conversation_id', '')}\t{offset}\t{len(raw)}\t{record.get('id', '')}\n"
+                )
+                offset += len(raw)
+        return lines, offset
+
+    def _rebuild_index(self) -> None:
+        """按日志重写整个索引（持有独占锁）；已删除但尚未 compact 的会话会重新出现。"""
+        lines = self._scan_log(0)[0] if self.log_path.exists() else []
+        tmp_index = self.index_path.with_suffix(self.index_path.suffix + ".tmp")
+        with tmp_index.open("w", encoding="utf-8") as f:
+            f.write("".join(lines))
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        tmp_index.replace(self.index_path)
+        self._reset()
+        self._refresh(writable=True)
+
+    def _recover_tail(self) -> None:
+        """
+        日志写入后、索引写入前进程崩溃时，日志尾部会有未被索引的记录，此处补齐；
+        写入中途崩溃留下的不完整尾行被截掉，否则下一次追加会接在其后，使该条记录也无法解析。
+        """
+        if not self.log_path.exists():
+            return
+        size = self.log_path.stat().st_size
+        if size <= self._log_end:
+            return
+        recovered, end = self._scan_log(self._log_end)
+        if end < size:
+            logger.warning("Truncating %d bytes of incomplete record at the end of %s", size - end, self.log_path)
+            os.truncate(self.log_path, end)
+        if recovered:
+            logger.warning("Recovered %d unindexed records from %s", len(recovered), self.log_path)
+            self._append_index_lines(recovered)
+
+    def _append_index_lines(self, lines: Iterable[str]) -> None:
+        with self.index_path.open("a", encoding="utf-8") as f:
+            f.write("".join(lines))
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        self._refresh()
+
+    def _append_locked(self, records: List[dict], index_lines: List[str]) -> None:
+        """追加记录；index_lines 为需要排在这些记录之前写入索引的行（如删除标记）。"""
+        self.log_path.parent.mkdir(parents=True, exist_ok=True)
+        with self.log_path.open("ab") as f:
+            offset = f.seek(0, os.SEEK_END)
+            payload = bytearray()
+            for record in records:
+                line = _encode(record)
+                index_lines.append(
+                    f"A\t{record.get('conversation_id', '')}\t{offset + len(payload)}\t{len(line)}\t{record.get('id', '')}\n"
+                )
+                payload += line
+            f.write(payload)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        self._append_index_lines(index_lines)
+
+    # ---------- 对外接口 ----------
+
+    def append(self, record: dict) -> None:
+        self.append_many([record])
+
+    def append_many(self, records: List[dict]) -> None:
+        if not records:
+            return
+        with file_lock(self.log_path):
+            self._refresh(writable=True)
+            self._append_locked(records, [])
+
+    def read_conversation(
+        self, conversation_id: str, limit: Optional[int] = None, before: Optional[str] = None
+    ) -> List[dict]:
+        """
+        按写入顺序返回某会话的消息。before 为消息 id 游标，只返回其之前的消息；
+        limit 限制只返回最新的 limit 条。游标定位只扫描内存索引，只读取目标页的记录。
+        """
+        with file_lock(self.log_path, shared=True):
+            self._refresh()
+            entries = self._offsets.get(conversation_id, [])
+            end = len(entries)
+            if before is not None:
+                end = next((i for i in range(end - 1, -1, -1) if entries[i][2] == before), 0)
+            start = 0 if limit is None else max(0, end - limit)
+            return self._read_entries(entries[start:end])
+
+    def read_messages(self, conversation_id: str, message_ids: Set[str]) -> List[dict]:
+        """按消息 id 读取某会话中的若干条消息，只读取命中的记录。"""
+        with file_lock(self.log_path, shared=True):
+            self._refresh()
+            entries = [e for e in self._offsets.get(conversation_id, []) if e[2] in message_ids]
+            return self._read_entries(entries)
+
+    def _read_entries(self, entries: List[IndexEntry]) -> List[dict]:
+        if not entries or not self.log_path.exists():
+            return []
+        records: List[dict] = []
+        with self.log_path.open("rb") as f:
+            for offset, length, _ in entries:
+                f.seek(offset)
+                try:
+                    records.append(json_loads(f.read(length)))
+                except ValueError:
+                    logger.warning("Corrupted message record at offset %d in %s", offset, self.log_path)
+        return records
+
+    def delete_conversation(self, conversation_id: str) -> None:
+        with file_lock(self.log_path):
+            self._refresh(writable=True)
+            if conversation_id not in self._offsets:
+                return
+            self._append_index_lines([f"D\t{conversation_id}\n"])
+
+    def extract_conversation(self, conversation_id: str, keep: Callable[[List[dict]], bool]) -> List[dict]:
+        """
+        在同一把独占锁内读取某会话的全部消息并交给 keep 处理（如写入归档），
+        keep 返回 True 后再把该会话标记为删除，期间的并发追加不会丢失。返回读取到的消息。
+        """
+        with file_lock(self.log_path):
+            self._refresh(writable=True)
+            records = self._read_entries(self._offsets.get(conversation_id, []))
+            if records and keep(records):
+                self._append_index_lines([f"D\t{conversation_id}\n"])
+            return records
+
+    def restore_conversation(self, conversation_id: str, records: List[dict]) -> None:
+        """
+        把 records（如归档中的旧消息）放回某会话，排在该会话现有消息之前；按 id 去重。
+        现有消息会被标记删除后与 records 一并重新追加，读取方只会看到合并后的顺序。
+        """
+        with file_lock(self.log_path):
+            self._refresh(writable=True)
+            hot = self._read_entries(self._offsets.get(conversation_id, []))
+            ids = {r.get("id") for r in records}
+            merged = records + [r for r in hot if r.get("id") not in ids]
+            if merged:
+                self._append_locked(merged, [f"D\t{conversation_id}\n"] if hot else [])
+
+    def read_since(self, cursor: Optional[Tuple[int, int]]) -> Tuple[List[dict], Tuple[int, int]]:
+        """
+        顺序读取日志中 cursor（inode, 字节偏移）之后追加的记录，返回记录与新游标；
+        不区分是否已删除。日志被整体重写（inode 变化）或 cursor 为 None 时从头读取。
+        """
+        with file_lock(self.log_path, shared=True):
+            try:
+                st = self.log_path.stat()
+            except FileNotFoundError:
+                return [], (0, 0)
+            pos = cursor[1] if cursor is not None and cursor[0] == st.st_ino and cursor[1] <= st.st_size else 0
+            with self.log_path.open("rb") as f:
+                f.seek(pos)
+                data = f.read()
+        end = data.rfind(b"\n") + 1
+        records: List[dict] = []
+        for raw in data[:end].splitlines():
+            if not raw:
+                continue
+            try:
+                records.append(json_loads(raw))
+            except ValueError:
+                logger.warning("Skipping corrupted record in %s", self.log_path)
+        return records, (st.st_ino, pos + end)
+
+    def iter_all(self) -> Iterator[dict]:
+        """按写入顺序遍历所有未删除的消息。"""
+        with file_lock(self.log_path, shared=True):
+            self._refresh()
+            entries = sorted(e for es in self._offsets.values() for e in es)
+            records = self._read_entries(entries)
+        yield from records
+
+    def rewrite(self, records: List[dict]) -> None:
+        """用给定记录整体重写日志与索引（用于 save_messages）。"""
+        with file_lock(self.log_path):
+            self._rewrite_locked(records)
+
+    def compact(self) -> None:
+        """丢弃已删除会话占用的日志空间。"""
+        with file_lock(self.log_path):
+            self._refresh(writable=True)
+            entries = sorted(e for es in self._offsets.values() for e in es)
+            self._rewrite_locked(self._read_entries(entries))
+
+    def _rewrite_locked(self, records: List[dict]) -> None:
+        self.log_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_log = self.log_path.with_suffix(self.log_path.suffix + ".tmp")
+        tmp_index = self.index_path.with_suffix(self.index_path.suffix + ".tmp")
+        offset = 0
+        with tmp_log.open("wb") as lf, tmp_index.open("w", encoding="utf-8") as xf:
+            for record in records:
+                line = _encode(record)
+                lf.write(line)
+                xf.write(f"A\t{record.get('conversation_id', '')}\t{offset}\t{len(line)}\t{record.get('id', '')}\n")
+                offset += len(line)
+        tmp_log.replace(self.log_path)
+        tmp_index.replace(self.index_path)
+        self._reset()
+        self._refresh()
+
+    def exists(self) -> bool:
+        return self.log_path.exists() or self.index_path.exists()
@@ -0,0 +1,74 @@
+"""
+一次性迁移：将 data/*.json（以及 jsonl 消息日志，若存在）导入 SQLite 数据库。
+
+用法（项目根目录下）：
+    python -m app.storage.migrate            # 目标库非空时拒绝执行
+    python -m app.storage.migrate --force    # 覆盖目标库中的已有数据
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import sys
+from typing import Dict, List
+
+from app.storage import json_store, sqlite_store
+
+logger = logging.getLogger(__name__)
+
+
+def _load_json_messages() -> List[dict]:
+    """优先读取追加日志（若曾启用 jsonl 模式），否则读取 messages.json；另含已归档的冷会话消息。"""
+    log = json_store._message_log
+    if log.exists():
+        messages = list(log.iter_all())
+    else:
+        messages = json_store._read_json(json_store.MESSAGES_FILE, {"messages": []}).get("messages", [])
+    seen = {m.get("id") for m in messages}
+    for _, archived in json_store._archive.iter_segments():
+        messages.extend(m for m in archived if m.get("id") not in seen)
+    return messages
+
+
+def migrate_json_to_sqlite(force: bool = False) -> Dict[str, int]:
+    if not sqlite_store.is_empty() and not force:
+        raise RuntimeError(f"目标数据库 {sqlite_store.db_path()} 已有数据，如需覆盖请加 --force")
+
+    users = json_store._read_json(json_store.USERS_FILE, {"users": []}).get("users", [])
+    conversations = json_store._read_json(json_store.CONVERSATIONS_FILE, {"conversations": []}).get(
+        "conversations", []
+    )
+    messages = _load_json_messages()
+    settings = json_store._read_json(json_store.SETTINGS_FILE, {"settings": []}).get("settings", [])
+
+    # 四张表在同一个事务中导入：中途失败时整体回滚，目标库保持为空，可直接重新执行
+    with sqlite_store._transaction():
+        sqlite_store.save_users(users)
+        sqlite_store.save_conversations(conversations)
+        sqlite_store.save_messages(messages)
+        sqlite_store.save_settings(settings)
+    return {
+        "users": len(users),
+        "conversations": len(conversations),
+        "messages": len(messages),
+        "settings": len(settings),
+    }
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="将 data/*.json 导入 SQLite 数据库")
+    parser.add_argument("--force", action="store_true", help="覆盖目标数据库中的已有数据")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    try:
+        counts = migrate_json_to_sqlite(force=args.force)
+    except RuntimeError as exc:
+        logger.error("%s", exc)
+        return 1
+    logger.info("Imported into %s: %s", sqlite_store.db_path(), counts)
+    logger.info("在 .env 中设置 STORAGE_BACKEND=sqlite 后重启服务即可切换到 SQLite 后端。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,234 @@
+"""
+会话历史全文检索：进程内的倒排索引，覆盖 ChatMessage.content。
+
+- 分词：ASCII 按字母数字切分并转小写（192.168.1.5 -> 192 / 168 / 1 / 5），
+  中日韩文字按相邻二字切分（bigram，单字词保留单字），不依赖分词词典；
+- 每条消息只记录去重后的词项，倒排表为按文档序号递增的 array('I')；求交集、按会话过滤
+  尽量交给 set 的 C 实现完成，候选集远小于倒排表时改用二分查找；
+- 本进程的 append_message / delete_conversation 直接增量更新索引，单 worker（WEB_WORKERS=1）时
+  建好索引后查询不再读取存储；多 worker 时每次查询前通过 json_store.read_messages_since() 追上
+  其他 worker 的写入（按消息 id 去重）。jsonl / sqlite 模式下只读取新增的记录，json 模式下
+  文件一有变化就要重新解析整个 messages.json，代价随消息总数增长，多 worker 部署应使用 jsonl 或 sqlite；
+- 删除会话只记录墓碑，查询时连同“不属于当前用户的会话”一起过滤，不回收倒排表空间。
+
+首次查询（或服务启动后的预热线程）会全量构建索引，包括已归档的冷会话。
+"""
+from __future__ import annotations
+
+import logging
+import heapq
+import math
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Set
+
+from app.config import get_settings
+from app.storage import json_store
+
+logger = logging.getLogger(__name__)
+
+# 单条消息参与索引的最大字符数（超长的工具输出只索引开头部分）
+MAX_INDEXED_CHARS = 20_000
+
+_ASCII_WORD = re.compile(r"[0-9a-z]+")
+_CJK_RUN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+")
+
+
+def tokenize(text: str) -> Set[str]:
+    """把文本切分为去重后的词项集合。"""
+    text = text[:MAX_INDEXED_CHARS].lower()
+    tokens: Set[str] = set(_ASCII_WORD.findall(text))
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            tokens.add(run)
+        else:
+            tokens.update(run[i : i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def _contains(postings: array, doc: int) -> bool:
+    i = bisect_left(postings, doc)
+    return i < len(postings) and postings[i] == doc
+
+
+class SearchIndex:
+    def __init__(self) -> None:
+        self._lock = threading.RLock()
+        self._postings: Dict[str, array] = {}
+        self._doc_ids: List[str] = []
+        self._doc_convs: List[str] = []
+        self._doc_lens = array("I")
+        self._by_id: Dict[str, int] = {}
+        self._conv_docs: Dict[str, array] = {}
+        self._deleted_convs: Set[str] = set()
+        self._total_len = 0
+        self._cursor: Optional[tuple] = None
+        self._built = False
+
+    # ---------- 维护 ----------
+
+    def add(self, message: dict) -> None:
+        with self._lock:
+            self._add(message)
+
+    def _add(self, message: dict) -> None:
+        message_id = message.get("id")
+        conversation_id = message.get("conversation_id")
+        if not message_id or not conversation_id or message_id in self._by_id:
+            return
+        if conversation_id in self._deleted_convs:
+            return
+        tokens = tokenize(message.get("content") or "")
+        doc = len(self._doc_ids)
+        self._doc_ids.append(message_id)
+        self._doc_convs.append(conversation_id)
+        self._doc_lens.append(len(tokens))
+        self._by_id[message_id] = doc
+        conv_docs = self._conv_docs.get(conversation_id)
+        if conv_docs is None:
+            conv_docs = self._conv_docs[conversation_id] = array("I")
+        conv_docs.append(doc)
+        self._total_len += len(tokens)
+        for token in tokens:
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = array("I")
+            postings.append(doc)
+
+    def forget_conversation(self, conversation_id: str) -> None:
+        with self._lock:
+            self._deleted_convs.add(conversation_id)
+            self._conv_docs.pop(conversation_id, None)
+
+    def _add_many(self, messages: Iterable[dict]) -> int:
+        before = len(self._doc_ids)
+        for message in messages:
+            self._add(message)
+        return len(self._doc_ids) - before
+
+    def sync(self) -> None:
+        """首次调用时全量构建；之后只在多 worker 时追读存储中其他进程新增的消息。"""
+        if self._built and get_settings().web_workers <= 1:
+            return
+        with self._lock:
+            started = time.perf_counter()
+            records, self._cursor = json_store.read_messages_since(self._cursor)
+            added = self._add_many(records)
+            if not self._built:
+                added += self._add_many(json_store.iter_archived_messages())
+                self._built = True
+                logger.info(
+                    "Search index built: %d messages, %d terms in %.2fs",
+                    len(self._doc_ids),
+                    len(self._postings),
+                    time.perf_counter() - started,
+                )
+            elif added:
+                logger.debug("Search index caught up %d messages", added)
+
+    # ---------- 查询 ----------
+
+    def search(self, query: str, conversation_ids: Set[str], limit: int) -> List[tuple]:
+        """
+        返回 [(score, message_id, conversation_id)]，按分数降序。
+        所有查询词项都须出现（AND）；分数为 BM25（tf 视为 1，因此同一查询下只取决于消息长度），
+        同分时较新的消息在前。只返回 conversation_ids 中的会话。
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        with self._lock:
+            lists = []
+            for token in tokens:
+                postings = self._postings.get(token)
+                if postings is None:
+                    return []
+                lists.append(postings)
+            lists.sort(key=len)
+            candidates = set(lists[0])
+            for postings in lists[1:]:
+                if len(candidates) * 16 < len(postings):
+                    candidates = {doc for doc in candidates if _contains(postings, doc)}
+                else:
+                    candidates.intersection_update(postings)
+                if not candidates:
+                    return []
+            candidates = self._scope(candidates, conversation_ids)
+
+            n_docs = len(self._doc_ids) or 1
+            avg_len = self._total_len / n_docs or 1.0
+            idf = sum(math.log(1 + (n_docs - len(p) + 0.5) / (len(p) + 0.5)) for p in lists)
+            k1, b = 1.2, 0.75
+            lens = self._doc_lens
+            top = heapq.nsmallest(limit, candidates, key=lambda doc: (lens[doc], -doc))
+            return [
+                (
+                    idf * (k1 + 1) / (1 + k1 * (1 - b + b * lens[doc] / avg_len)),
+                    self._doc_ids[doc],
+                    self._doc_convs[doc],
+                )
+                for doc in top
+            ]
+
+    def _scope(self, candidates: Set[int], conversation_ids: Set[str]) -> Set[int]:
+        """只保留属于 conversation_ids（且未删除）的会话中的候选消息。"""
+        if len(candidates) <= 50_000:
+            return {
+                doc
+                for doc in candidates
+                if self._doc_convs[doc] in conversation_ids and self._doc_convs[doc] not in self._deleted_convs
+            }
+        allowed: Set[int] = set()
+        for conversation_id in conversation_ids:
+            docs = self._conv_docs.get(conversation_id)
+            if docs is not None:
+                allowed.update(docs)
+        return candidates & allowed
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "built": self._built,
+                "messages": len(self._doc_ids),
+                "terms": len(self._postings),
+                "deleted_conversations": len(self._deleted_convs),
+            }
+
+
+_index = SearchIndex()
+
+
+def index_message(message: dict) -> None:
+    """
+    本进程新增消息后立即写入索引。索引尚未构建（或正在构建）时同样写入：
+    构建读到的同一条消息按 id 去重，构建开始后才写入存储的消息也不会遗漏。
+    """
+    _index.add(message)
+
+
+def forget_conversation(conversation_id: str) -> None:
+    _index.forget_conversation(conversation_id)
+
+
+def search(query: str, conversation_ids: Set[str], limit: int = 20) -> List[tuple]:
+    _index.sync()
+    return _index.search(query, conversation_ids, limit)
+
+
+def index_stats() -> dict:
+    return _index.stats()
+
+
+def start_background_build() -> None:
+    """在后台线程中预先构建索引，避免第一次搜索等待全量构建。"""
+
+    def build() -> None:
+        try:
+            _index.sync()
+        except Exception:  # noqa: BLE001
+            logger.exception("Building search index failed")
+
+    threading.Thread(target=build, name="search-index-build", daemon=True).start()
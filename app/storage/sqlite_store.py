@@ -0,0 +1,390 @@
+"""
+SQLite（WAL 模式）存储后端，接口与 json_store 的公开函数一一对应，
+由 json_store 在 STORAGE_BACKEND=sqlite 时转发调用。
+
+表结构中常用字段为独立列并建索引，其余字段序列化进 extra 列，
+以便模型新增字段时无需迁移表结构。
+"""
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from app.config import PROJECT_ROOT, get_settings
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    username TEXT NOT NULL UNIQUE,
+    password_hash TEXT NOT NULL,
+    email TEXT,
+    api_key TEXT,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    title TEXT NOT NULL DEFAULT '',
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_user_updated ON conversations (user_id, updated_at DESC);
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    conversation_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL DEFAULT '',
+    created_at TEXT NOT NULL,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS idx_messages_conversation_created ON messages (conversation_id, created_at);
+CREATE TABLE IF NOT EXISTS settings (
+    user_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL DEFAULT '{}'
+);
+"""
+
+USER_COLUMNS = ("id", "username", "password_hash", "email", "api_key")
+CONVERSATION_COLUMNS = ("id", "user_id", "title", "created_at", "updated_at")
+MESSAGE_COLUMNS = ("id", "conversation_id", "user_id", "role", "content", "created_at")
+
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized_paths: set[str] = set()
+
+
+def db_path() -> Path:
+    path = Path(get_settings().sqlite_path)
+    return path if path.is_absolute() else PROJECT_ROOT / path
+
+
+def _connect() -> sqlite3.Connection:
+    """每个线程复用一个连接；WAL 模式下读者与写者互不阻塞。"""
+    path = str(db_path())
+    conn: Optional[sqlite3.Connection] = getattr(_local, "conn", None)
+    if conn is not None and getattr(_local, "path", None) == path:
+        return conn
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    with _init_lock:
+        if path not in _initialized_paths:
+            conn.executescript(SCHEMA)
+            _initialized_paths.add(path)
+    _local.conn = conn
+    _local.path = path
+    return conn
+
+
+@contextmanager
+def _transaction() -> Iterator[sqlite3.Connection]:
+    """写事务；已在事务中时并入外层事务，由外层统一提交或回滚（如迁移时多张表一次导入）。"""
+    conn = _connect()
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _split(record: dict, columns: tuple) -> tuple[list, str]:
+    values = [record.get(c) for c in columns]
+    extra = {k: v for k, v in record.items() if k not in columns}
+    return values, json.dumps(extra, ensure_ascii=False)
+
+
+def _join(row: sqlite3.Row, columns: tuple) -> dict:
+    record: Dict[str, Any] = {c: row[c] for c in columns}
+    record.update(json.loads(row["extra"] or "{}"))
+    return record
+
+
+def _insert_sql(table: str, columns: tuple, verb: str = "INSERT") -> str:
+    cols = ", ".join(columns + ("extra",))
+    marks = ", ".join("?" for _ in range(len(columns) + 1))
+    return f"{verb} INTO {table} ({cols}) VALUES ({marks})"
+
+
+# ---------- users ----------
+
+def load_users() -> List[dict]:
+    rows = _connect().execute("SELECT * FROM users ORDER BY rowid").fetchall()
+    return [_join(r, USER_COLUMNS) for r in rows]
+
+
+def save_users(users: List[dict]) -> None:
+    with _transaction() as conn:
+        conn.execute("DELETE FROM users")
+        sql = _insert_sql("users", USER_COLUMNS)
+        for u in users:
+            values, extra = _split(u, USER_COLUMNS)
+            conn.execute(sql, values + [extra])
+
+
+def get_user_by_id(user_id: str) -> Optional[dict]:
+    row = _connect().execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+    return _join(row, USER_COLUMNS) if row else None
+
+
+def get_user_by_username(username: str) -> Optional[dict]:
+    row = _connect().execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
+    return _join(row, USER_COLUMNS) if row else None
+
+
+def create_user_if_none(user: dict) -> bool:
+    with _transaction() as conn:
+        if conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            return False
+        values, extra = _split(user, USER_COLUMNS)
+        conn.execute(_insert_sql("users", USER_COLUMNS), values + [extra])
+    return True
+
+
+def update_user(user_id: str, fields: dict) -> None:
+    with _transaction() as conn:
+        row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+        if not row:
+            return
+        record = _join(row, USER_COLUMNS)
+        record.update(fields)
+        values, extra = _split(record, USER_COLUMNS)
+        conn.execute(_insert_sql("users", USER_COLUMNS, "INSERT OR REPLACE"), values + [extra])
+
+
+# ---------- conversations ----------
+
+# 单条语句中 IN (...) 的参数个数上限（旧版 SQLite 的 SQLITE_MAX_VARIABLE_NUMBER 为 999）
+_IN_BATCH = 500
+
+
+def _conversations_from_rows(conn: sqlite3.Connection, rows: List[sqlite3.Row]) -> List[dict]:
+    """还原会话记录；各会话的 message_ids 按批一次查出，而不是每个会话各查一次。"""
+    records = [_join(row, CONVERSATION_COLUMNS) for row in rows]
+    message_ids: Dict[str, List[str]] = {record["id"]: [] for record in records}
+    conversation_ids = list(message_ids)
+    for start in range(0, len(conversation_ids), _IN_BATCH):
+        batch = conversation_ids[start : start + _IN_BATCH]
+        placeholders = ", ".join("?" * len(batch))
+        for r in conn.execute(
+            f"SELECT conversation_id, id FROM messages WHERE conversation_id IN ({placeholders})"
+            " ORDER BY conversation_id, created_at, seq",
+            batch,
+        ):
+            message_ids[r["conversation_id"]].append(r["id"])
+    for record in records:
+        record["message_ids"] = message_ids[record["id"]]
+    return records
+
+
+def _conversation_values(conv: dict) -> list:
+    record = {k: v for k, v in conv.items() if k != "message_ids"}
+    values, extra = _split(record, CONVERSATION_COLUMNS)
+    return values + [extra]
+
+
+def load_conversations() -> List[dict]:
+    conn = _connect()
+    rows = conn.execute("SELECT * FROM conversations ORDER BY rowid").fetchall()
+    return _conversations_from_rows(conn, rows)
+
+
+def save_conversations(conversations: List[dict]) -> None:
+    """整体替换会话表。message_ids 由 messages 表推导，不单独存储。"""
+    with _transaction() as conn:
+        conn.execute("DELETE FROM conversations")
+        sql = _insert_sql("conversations", CONVERSATION_COLUMNS)
+        for c in conversations:
+            conn.execute(sql, _conversation_values(c))
+
+
+def get_conversation(conversation_id: str) -> Optional[dict]:
+    conn = _connect()
+    row = conn.execute("SELECT * FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+    return _conversations_from_rows(conn, [row])[0] if row else None
+
+
+def list_user_conversations(user_id: str) -> List[dict]:
+    conn = _connect()
+    rows = conn.execute(
+        "SELECT * FROM conversations WHERE user_id = ? ORDER BY updated_at DESC", (user_id,)
+    ).fetchall()
+    return _conversations_from_rows(conn, rows)
+
+
+def list_conversation_summaries(user_id: str) -> List[dict]:
+    rows = _connect().execute(
+        "SELECT c.id, c.title, c.updated_at,"
+        " (SELECT COUNT(*) FROM messages m WHERE m.conversation_id = c.id) AS message_count"
+        " FROM conversations c WHERE c.user_id = ? ORDER BY c.updated_at DESC",
+        (user_id,),
+    ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def add_conversation(conversation: dict) -> None:
+    with _transaction() as conn:
+        conn.execute(_insert_sql("conversations", CONVERSATION_COLUMNS), _conversation_values(conversation))
+
+
+def update_conversation(conversation_id: str, fields: dict) -> None:
+    with _transaction() as conn:
+        row = conn.execute("SELECT * FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+        if row is None:
+            return
+        record = _join(row, CONVERSATION_COLUMNS)
+        record.update(fields)
+        conn.execute(
+            _insert_sql("conversations", CONVERSATION_COLUMNS, "INSERT OR REPLACE"), _conversation_values(record)
+        )
+
+
+def touch_conversation(conversation_id: str, message_id: str, updated_at: str) -> None:
+    # message_ids 由 messages 表推导，此处只需刷新更新时间
+    with _transaction() as conn:
+        conn.execute("UPDATE conversations SET updated_at = ? WHERE id = ?", (updated_at, conversation_id))
+
+
+def delete_conversation(conversation_id: str, user_id: str) -> bool:
+    with _transaction() as conn:
+        cur = conn.execute(
+            "DELETE FROM conversations WHERE id = ? AND user_id = ?", (conversation_id, user_id)
+        )
+        if cur.rowcount == 0:
+            return False
+        conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+    return True
+
+
+# ---------- messages ----------
+
+def _message_values(message: dict) -> list:
+    values, extra = _split(message, MESSAGE_COLUMNS)
+    if values[4] is None:
+        values[4] = ""
+    return values + [extra]
+
+
+def load_messages() -> List[dict]:
+    rows = _connect().execute("SELECT * FROM messages ORDER BY seq").fetchall()
+    return [_join(r, MESSAGE_COLUMNS) for r in rows]
+
+
+def save_messages(messages: List[dict]) -> None:
+    with _transaction() as conn:
+        conn.execute("DELETE FROM messages")
+        sql = _insert_sql("messages", MESSAGE_COLUMNS)
+        for m in messages:
+            conn.execute(sql, _message_values(m))
+
+
+def append_message(message: dict) -> None:
+    with _transaction() as conn:
+        conn.execute(_insert_sql("messages", MESSAGE_COLUMNS), _message_values(message))
+
+
+def load_conversation_messages(
+    conversation_id: str, limit: Optional[int] = None, before: Optional[str] = None
+) -> List[dict]:
+    conn = _connect()
+    where = "conversation_id = ?"
+    params: list = [conversation_id]
+    if before is not None:
+        cursor = conn.execute(
+            "SELECT created_at, seq FROM messages WHERE id = ? AND conversation_id = ?", (before, conversation_id)
+        ).fetchone()
+        if cursor is None:
+            return []
+        where += " AND (created_at, seq) < (?, ?)"
+        params += [cursor["created_at"], cursor["seq"]]
+    if limit is None:
+        rows = conn.execute(f"SELECT * FROM messages WHERE {where} ORDER BY created_at, seq", params).fetchall()
+    else:
+        rows = conn.execute(
+            f"SELECT * FROM messages WHERE {where} ORDER BY created_at DESC, seq DESC LIMIT ?", params + [limit]
+        ).fetchall()
+        rows.reverse()
+    return [_join(r, MESSAGE_COLUMNS) for r in rows]
+
+
+def load_messages_by_ids(message_ids: Iterable[str]) -> List[dict]:
+    ids = list(message_ids)
+    conn = _connect()
+    records: List[dict] = []
+    for start in range(0, len(ids), _IN_BATCH):
+        batch = ids[start : start + _IN_BATCH]
+        placeholders = ", ".join("?" * len(batch))
+        rows = conn.execute(f"SELECT * FROM messages WHERE id IN ({placeholders})", batch).fetchall()
+        records.extend(_join(r, MESSAGE_COLUMNS) for r in rows)
+    return records
+
+
+def load_messages_after(seq: int) -> tuple[List[dict], int]:
+    """按写入顺序返回 seq 之后插入的消息，以及其中最大的 seq（无新消息时原样返回 seq）。"""
+    rows = _connect().execute("SELECT * FROM messages WHERE seq > ? ORDER BY seq", (seq,)).fetchall()
+    if rows:
+        seq = rows[-1]["seq"]
+    return [_join(r, MESSAGE_COLUMNS) for r in rows], seq
+
+
+def delete_conversation_messages(conversation_id: str) -> None:
+    with _transaction() as conn:
+        conn.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+
+
+# ---------- settings ----------
+
+def load_settings() -> List[dict]:
+    rows = _connect().execute("SELECT user_id, data FROM settings ORDER BY rowid").fetchall()
+    return [{"user_id": r["user_id"], **json.loads(r["data"] or "{}")} for r in rows]
+
+
+def _settings_data(item: dict) -> str:
+    return json.dumps({k: v for k, v in item.items() if k != "user_id"}, ensure_ascii=False)
+
+
+def save_settings(settings: List[dict]) -> None:
+    with _transaction() as conn:
+        conn.execute("DELETE FROM settings")
+        for item in settings:
+            conn.execute("INSERT INTO settings (user_id, data) VALUES (?, ?)", (item.get("user_id"), _settings_data(item)))
+
+
+def get_user_settings(user_id: str) -> Optional[dict]:
+    row = _connect().execute("SELECT user_id, data FROM settings WHERE user_id = ?", (user_id,)).fetchone()
+    if not row:
+        return None
+    return {"user_id": row["user_id"], **json.loads(row["data"] or "{}")}
+
+
+def update_user_settings(user_id: str, fields: dict) -> None:
+    with _transaction() as conn:
+        row = conn.execute("SELECT data FROM settings WHERE user_id = ?", (user_id,)).fetchone()
+        item = json.loads(row["data"]) if row else {}
+        item.update(fields)
+        conn.execute(
+            "INSERT OR REPLACE INTO settings (user_id, data) VALUES (?, ?)", (user_id, _settings_data(item))
+        )
+
+
+def is_empty() -> bool:
+    conn = _connect()
+    for table in ("users", "conversations", "messages", "settings"):
+        if conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+            return False
+    return True
@@ -0,0 +1,135 @@
+"""
+跨进程并发写入压力测试：多个进程同时向同一会话追加消息（含会话表的读-改-写），
+结束后校验消息与 message_ids 均无丢失。测试写入的会话、消息与摘要索引在退出前（含失败时）全部清理，
+不会与真实数据混在一起。
+
+用法（项目根目录下，使用当前 .env 中的存储配置）：
+    python -m app.storage.stress --processes 8 --messages 100
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import multiprocessing
+import sys
+import time
+import uuid
+from datetime import datetime
+from typing import List
+
+from app.storage import json_store
+from app.storage.filelock import lock_path_for
+
+logger = logging.getLogger(__name__)
+
+STRESS_USER_ID = "__stress__"
+
+
+def _writer(conversation_id: str, worker: int, count: int) -> None:
+    for i in range(count):
+        message_id = f"stress-{worker}-{i}"
+        created_at = datetime.utcnow().isoformat()
+        json_store.append_message(
+            {
+                "id": message_id,
+                "conversation_id": conversation_id,
+                "user_id": STRESS_USER_ID,
+                "role": "user",
+                "content": f"worker {worker} message {i}",
+                "files": [],
+                "created_at": created_at,
+            }
+        )
+        json_store.touch_conversation(conversation_id, STRESS_USER_ID, message_id, created_at)
+
+
+def run(processes: int, messages: int) -> List[str]:
+    """执行压力测试，返回发现的问题列表（为空表示通过）。"""
+    conversation_id = f"stress-{uuid.uuid4()}"
+    now = datetime.utcnow().isoformat()
+    json_store.add_conversation(
+        {
+            "id": conversation_id,
+            "user_id": STRESS_USER_ID,
+            "title": "stress",
+            "created_at": now,
+            "updated_at": now,
+            "message_ids": [],
+        }
+    )
+    log_existed = json_store._message_log.exists()
+    try:
+        return _check(conversation_id, processes, messages)
+    finally:
+        _cleanup(conversation_id, log_existed)
+
+
+def _check(conversation_id: str, processes: int, messages: int) -> List[str]:
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=_writer, args=(conversation_id, w, messages)) for w in range(processes)]
+    started = time.perf_counter()
+    try:
+        for p in workers:
+            p.start()
+    finally:
+        for p in workers:
+            if p.pid is not None:
+                p.join()
+    elapsed = time.perf_counter() - started
+
+    problems: List[str] = []
+    for p in workers:
+        if p.exitcode != 0:
+            problems.append(f"writer pid={p.pid} exited with code {p.exitcode}")
+    expected = {f"stress-{w}-{i}" for w in range(processes) for i in range(messages)}
+    stored = [m.get("id") for m in json_store.load_conversation_messages(conversation_id)]
+    if len(stored) != len(set(stored)):
+        problems.append(f"duplicate messages: {len(stored) - len(set(stored))}")
+    if set(stored) != expected:
+        problems.append(f"messages lost: {len(expected - set(stored))}, unexpected: {len(set(stored) - expected)}")
+    conversation = json_store.get_conversation(conversation_id) or {}
+    message_ids = set(conversation.get("message_ids") or [])
+    if message_ids != expected:
+        problems.append(f"conversation message_ids lost: {len(expected - message_ids)}")
+
+    total = processes * messages
+    logger.info(
+        "%d processes x %d messages: %.2fs (%.0f appends/s)", processes, messages, elapsed, total / elapsed
+    )
+    return problems
+
+
+def _cleanup(conversation_id: str, log_existed: bool) -> None:
+    """
+    删除测试会话及其消息，回收日志空间，并删除测试用户的会话摘要索引；
+    jsonl 消息日志若由本次测试创建且清理后为空，一并删除（日志存在与否决定迁移时的消息来源）。
+    """
+    json_store.delete_conversation(conversation_id, STRESS_USER_ID)
+    json_store.flush()
+    json_store.compact_messages()
+    summary = json_store._summary_path(STRESS_USER_ID)
+    paths = [summary, lock_path_for(summary)]
+    log = json_store._message_log
+    if not log_existed and log.log_path.exists() and log.log_path.stat().st_size == 0:
+        paths += [log.log_path, log.index_path, lock_path_for(log.log_path)]
+    for path in paths:
+        path.unlink(missing_ok=True)
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="json_store 跨进程并发写入压力测试")
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--messages", type=int, default=100, help="每个进程追加的消息数")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    problems = run(args.processes, args.messages)
+    for problem in problems:
+        logger.error("%s", problem)
+    if problems:
+        return 1
+    logger.info("OK: no lost or duplicated writes")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
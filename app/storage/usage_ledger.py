@@ -0,0 +1,127 @@
+"""
+用量账本：每次助手回复结束时追加一行到 data/usage.jsonl，记录 token 用量、模型轮数、工具调用数与耗时拆分。
+
+- 每行为按 FIELDS 顺序排列的 JSON 数组（不重复字段名，体积约为对象格式的一半），只追加、不修改；
+  新增字段只能加在 FIELDS 末尾，旧行缺少的列按 0 / 空串读取；
+- 追加在文件锁内进行，多 worker 写同一文件不会交错；
+- 聚合查询顺序扫描整个文件，按用户、会话或日期（UTC）汇总，结果按 total_tokens 降序。
+"""
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional
+
+from app.models.schemas import UsageRecord
+from app.storage import codecs
+from app.storage.filelock import file_lock
+from app.storage.json_store import DATA_DIR
+
+LEDGER_FILE = DATA_DIR / "usage.jsonl"
+
+FIELDS = (
+    "ts",
+    "user_id",
+    "conversation_id",
+    "provider",
+    "model",
+    "status",
+    "prompt_tokens",
+    "completion_tokens",
+    "total_tokens",
+    "rounds",
+    "tool_calls",
+    "total_ms",
+    "first_output_ms",
+    "model_ms",
+    "tool_ms",
+)
+_TEXT_FIELDS = frozenset({"user_id", "conversation_id", "provider", "model", "status"})
+# 聚合时累加的列
+_SUM_FIELDS = (
+    "prompt_tokens",
+    "completion_tokens",
+    "total_tokens",
+    "rounds",
+    "tool_calls",
+    "total_ms",
+    "model_ms",
+    "tool_ms",
+)
+GROUP_BY = ("user", "conversation", "day")
+
+
+def append(record: UsageRecord) -> None:
+    """追加一条回复的用量。"""
+    created = record.created_at
+    if created.tzinfo is None:
+        created = created.replace(tzinfo=timezone.utc)
+    values = record.model_dump()
+    values["ts"] = int(created.timestamp())
+    line = codecs.json_dumps_line([values[name] for name in FIELDS])
+    with file_lock(LEDGER_FILE):
+        with LEDGER_FILE.open("ab") as f:
+            f.write(line)
+
+
+def _iter_rows() -> Iterator[Dict[str, object]]:
+    if not LEDGER_FILE.exists():
+        return
+    with file_lock(LEDGER_FILE, shared=True):
+        with LEDGER_FILE.open("rb") as f:
+            for raw in f:
+                try:
+                    values = codecs.json_loads(raw)
+                except ValueError:
+                    # 进程在写入中途退出时最后一行可能不完整
+                    continue
+                row = {name: "" if name in _TEXT_FIELDS else 0 for name in FIELDS}
+                row.update(zip(FIELDS, values))
+                yield row
+
+
+def _day(ts: int) -> str:
+    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+def aggregate(
+    group_by: str = "conversation",
+    user_id: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    limit: int = 50,
+) -> List[dict]:
+    """
+    按 group_by（user / conversation / day）汇总用量，可按用户与日期范围（YYYY-MM-DD，含两端，UTC）过滤。
+    每组返回回复数、各 token 列与耗时之和、被打断 / 出错的回复数，按 total_tokens 降序取前 limit 组。
+    """
+    if group_by not in GROUP_BY:
+        raise ValueError(f"group_by must be one of {', '.join(GROUP_BY)}")
+    groups: Dict[str, dict] = {}
+    for row in _iter_rows():
+        if user_id is not None and row["user_id"] != user_id:
+            continue
+        day = _day(int(row["ts"]))
+        if (since and day < since) or (until and day > until):
+            continue
+        if group_by == "day":
+            key = day
+        elif group_by == "user":
+            key = str(row["user_id"])
+        else:
+            key = str(row["conversation_id"])
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {"key": key, "turns": 0, "interrupted": 0, "errors": 0, "first_day": day}
+            group.update((name, 0) for name in _SUM_FIELDS)
+            if group_by == "conversation":
+                group["user_id"] = row["user_id"]
+        group["turns"] += 1
+        group["last_day"] = day
+        for name in _SUM_FIELDS:
+            group[name] += int(row[name] or 0)
+        if row["status"] in ("interrupted", "disconnected"):
+            group["interrupted"] += 1
+        elif row["status"] == "error":
+            group["errors"] += 1
+    result = sorted(groups.values(), key=lambda g: g["total_tokens"], reverse=True)
+    return result[: max(0, limit)]
@@ -0,0 +1,222 @@
+"""
+进程内运行指标，由 GET /metrics 以 Prometheus 文本格式导出，用于区分慢在模型、Shell 还是存储。
+
+- Counter / Gauge / Histogram 为最小实现（不依赖 prometheus_client）：每次记录只是一次加锁的
+  字典更新与二分查找分桶，可放在请求热路径上；
+- 标签值须为有限集合（提供方、文件名、退出码等），不要使用用户 id、会话 id 之类的值；
+- 指标只在进程内累计，多 worker（WEB_WORKERS>1）时各 worker 分别统计，每次抓取只返回处理该请求的 worker 的数据。
+"""
+from __future__ import annotations
+
+import bisect
+import math
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, Tuple
+
+# 秒级耗时的默认分桶：覆盖毫秒级存储读写到分钟级的 Shell 命令
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_registry: List["_Metric"] = []
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    @abstractmethod
+    def _samples(self) -> List[str]:
+        ...
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        if not items and not self.labelnames:
+            items = [((), 0.0)]
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每组标签：[各桶计数（不累计，最后一格为 +Inf）, 总和, 总数]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                item = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            item[0][index] += 1
+            item[1] += value
+            item[2] += 1
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, (list(v[0]), v[1], v[2])) for key, v in self._values.items())
+        lines: List[str] = []
+        names = self.labelnames + ("le",)
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_format_labels(names, key + (_format_value(bound),))} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render() -> str:
+    """按 Prometheus 文本格式（version 0.0.4）输出全部指标。"""
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+# ---------- 对话 ----------
+
+CHAT_ACTIVE_STREAMS = Gauge("judgmentday_chat_active_streams", "Assistant replies currently streaming.")
+CHAT_TURNS = Counter("judgmentday_chat_turns_total", "Assistant replies started.")
+CHAT_INTERRUPTS = Counter(
+    "judgmentday_chat_interrupts_total",
+    "Replies that ended early: reason=user (interrupt button) or disconnect (client went away).",
+    ("reason",),
+)
+CHAT_FIRST_OUTPUT_SECONDS = Histogram(
+    "judgmentday_chat_first_output_seconds",
+    "Time from receiving a message to the first streamed output (model text or shell marker).",
+)
+
+# ---------- 模型 ----------
+
+MODEL_FIRST_TOKEN_SECONDS = Histogram(
+    "judgmentday_model_first_token_seconds",
+    "Time from starting a model round (including admission queueing) to its first streamed delta.",
+    ("provider",),
+)
+MODEL_ROUND_SECONDS = Histogram(
+    "judgmentday_model_round_seconds", "Wall-clock duration of one streamed model call.", ("provider",)
+)
+MODEL_ROUNDS_PER_TURN = Histogram(
+    "judgmentday_model_rounds_per_turn",
+    "Model calls needed to finish one reply (one per tool-call round trip).",
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16, 24, 32),
+)
+MODEL_OUTPUT_CHARS = Counter(
+    "judgmentday_model_output_chars_total", "Characters of model text streamed to clients.", ("provider",)
+)
+MODEL_OUTPUT_CHARS_PER_SECOND = Histogram(
+    "judgmentday_model_output_chars_per_second",
+    "Text streaming rate of a model round, measured from its first to its last text delta.",
+    ("provider",),
+    buckets=(5, 10, 20, 40, 80, 160, 320, 640, 1280),
+)
+MODEL_ERRORS = Counter(
+    "judgmentday_model_errors_total",
+    "Failed replies by cause: upstream HTTP status, circuit_open or exception.",
+    ("provider", "cause"),
+)
+
+# ---------- Shell ----------
+
+SHELL_EXEC_SECONDS = Histogram("judgmentday_shell_exec_seconds", "Wall-clock duration of shell_execute commands.")
+SHELL_EXITS = Counter(
+    "judgmentday_shell_exits_total",
+    "Finished shell commands by exit code (or timeout / cancelled / denied / error).",
+    ("code",),
+)
+SHELL_LIMIT_HITS = Counter(
+    "judgmentday_shell_limit_hits_total",
+    "Shell commands that failed on a resource limit: cpu, file_size, memory or processes.",
+    ("limit",),
+)
+
+# ---------- 存储 ----------
+
+STORE_READ_SECONDS = Histogram(
+    "judgmentday_store_read_seconds", "Time to read and decode a JSON store file.", ("file",)
+)
+STORE_WRITE_SECONDS = Histogram(
+    "judgmentday_store_write_seconds", "Time to encode and atomically replace a JSON store file.", ("file",)
+)
+STORE_READ_BYTES = Counter("judgmentday_store_read_bytes_total", "Bytes read from JSON store files.", ("file",))
+STORE_WRITE_BYTES = Counter("judgmentday_store_write_bytes_total", "Bytes written to JSON store files.", ("file",))
@@ -0,0 +1,224 @@
+"""
+请求级追踪：记录一次对话请求中各阶段的耗时（span），如模型调用轮次、工具执行、存储写入、SSE 发送。
+
+- TRACE_ENABLED=False（默认）时 span() 只做一次 ContextVar 读取，几乎没有开销；
+- 每个请求按 TRACE_SAMPLE_RATE 抽样，未抽中的请求同样不记录；
+- span 结束时追加到内存环形缓冲区（deque，满时丢弃最旧的），由后台线程每秒批量写入
+  TRACE_FILE（JSONL，一行一个 span），请求路径上没有文件 I/O；
+- 最近的 span 可通过 /api/console/traces 以 JSONL 或 Chrome trace 格式
+  （chrome://tracing、Perfetto 可直接打开）导出。
+
+span 通过 ContextVar 关联到所在请求：asyncio 任务与 asyncio.to_thread 会继承上下文，
+run_in_executor 提交的函数不会，因此工具执行的 span 记录在事件循环一侧。
+"""
+from __future__ import annotations
+
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+from app.config import PROJECT_ROOT, get_settings
+from app.storage import codecs
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 1.0
+
+
+class Trace:
+    """一次请求的追踪上下文。"""
+
+    __slots__ = ("trace_id", "name", "lane")
+
+    _lanes = itertools.count(1)
+
+    def __init__(self, name: str) -> None:
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        # Chrome trace 中每个请求占一行（tid），便于并发请求分开显示
+        self.lane = next(self._lanes)
+
+
+_current: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_recent: Deque[dict] = deque(maxlen=10_000)
+_pending: Deque[dict] = deque(maxlen=10_000)
+_flusher: Optional[threading.Thread] = None
+_configured = False
+
+
+def _configure() -> None:
+    global _recent, _pending, _configured
+    size = max(100, get_settings().trace_buffer_size)
+    _recent = deque(maxlen=size)
+    _pending = deque(maxlen=size)
+    _configured = True
+
+
+def start_trace(name: str) -> Optional[Trace]:
+    """按配置决定是否追踪当前请求；追踪时设置为当前上下文的 trace 并返回，否则返回 None。"""
+    settings = get_settings()
+    if not settings.trace_enabled or random.random() >= settings.trace_sample_rate:
+        return None
+    if not _configured:
+        _configure()
+    trace = Trace(name)
+    _current.set(trace)
+    return trace
+
+
+def end_trace(trace: Optional[Trace]) -> None:
+    if trace is not None and _current.get() is trace:
+        _current.set(None)
+
+
+def _record(trace: Trace, name: str, start_ns: int, duration_ns: int, attrs: Dict[str, Any]) -> None:
+    span = {
+        "trace_id": trace.trace_id,
+        "trace": trace.name,
+        "lane": trace.lane,
+        "name": name,
+        "ts_us": start_ns // 1000,
+        "dur_us": duration_ns // 1000,
+        "attrs": attrs,
+    }
+    _recent.append(span)
+    if _flusher is not None:
+        _pending.append(span)
+
+
+class _Span:
+    __slots__ = ("attrs",)
+
+    def __init__(self, attrs: Dict[str, Any]) -> None:
+        self.attrs = attrs
+
+    def set(self, **attrs: Any) -> None:
+        """补充属性（如结束时才知道的字节数、退出码）。"""
+        self.attrs.update(attrs)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attrs: Any) -> None:
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Any]:
+    """记录一段耗时；当前请求未被追踪时不做任何事。"""
+    trace = _current.get()
+    if trace is None:
+        yield _NOOP
+        return
+    item = _Span(attrs)
+    wall = time.time_ns()
+    started = time.perf_counter_ns()
+    try:
+        yield item
+    finally:
+        _record(trace, name, wall, time.perf_counter_ns() - started, item.attrs)
+
+
+def event(name: str, **attrs: Any) -> None:
+    """记录一个瞬时事件（耗时为 0），如首个 token 到达。"""
+    trace = _current.get()
+    if trace is not None:
+        _record(trace, name, time.time_ns(), 0, attrs)
+
+
+# ---------- 导出 ----------
+
+
+def recent_spans(limit: int = 1000, trace_id: Optional[str] = None) -> List[dict]:
+    spans = list(_recent)
+    if trace_id:
+        spans = [s for s in spans if s["trace_id"] == trace_id]
+    return spans[-limit:]
+
+
+def to_chrome_trace(spans: List[dict]) -> dict:
+    """转为 Chrome trace event 格式（完整事件 ph=X，瞬时事件 ph=i）。"""
+    pid = os.getpid()
+    events: List[dict] = []
+    for s in spans:
+        item = {
+            "name": s["name"],
+            "cat": s["trace"],
+            "ph": "X" if s["dur_us"] else "i",
+            "ts": s["ts_us"],
+            "pid": pid,
+            "tid": s["lane"],
+            "args": {"trace_id": s["trace_id"], **s["attrs"]},
+        }
+        if s["dur_us"]:
+            item["dur"] = s["dur_us"]
+        else:
+            item["s"] = "t"
+        events.append(item)
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def stats() -> dict:
+    settings = get_settings()
+    return {
+        "enabled": settings.trace_enabled,
+        "sample_rate": settings.trace_sample_rate,
+        "buffered": len(_recent),
+        "pending": len(_pending),
+    }
+
+
+# ---------- 后台写出 ----------
+
+
+def _flush(path: Path) -> None:
+    batch: List[bytes] = []
+    while _pending:
+        try:
+            batch.append(codecs.json_dumps_line(_pending.popleft()))
+        except IndexError:
+            break
+    if batch:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("ab") as f:
+            f.write(b"".join(batch))
+
+
+def _loop(path: Path) -> None:
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            _flush(path)
+        except Exception:  # noqa: BLE001
+            logger.exception("Writing traces to %s failed", path)
+
+
+def start_background_flusher() -> None:
+    """TRACE_ENABLED 且配置了 TRACE_FILE 时启动后台写出线程（每个进程一个）。"""
+    global _flusher
+    settings = get_settings()
+    if not settings.trace_enabled or _flusher is not None:
+        return
+    if not _configured:
+        _configure()
+    if not settings.trace_file:
+        return
+    path = PROJECT_ROOT / settings.trace_file
+    if settings.web_workers > 1:
+        # 多 worker 时各写各的文件，避免交错写入
+        path = path.with_name(f"{path.stem}.{os.getpid()}{path.suffix}")
+    _flusher = threading.Thread(target=_loop, args=(path,), name="trace-flusher", daemon=True)
+    _flusher.start()
@@ -19,6 +19,19 @@ def main() -> None:
     cert_path, key_path = settings.cert_paths
     ensure_self_signed_cert(cert_path, key_path)
 
+    if settings.web_workers > 1:
+        # 多 worker 需以导入路径启动，由 uvicorn 在每个子进程中调用工厂函数创建应用
+        uvicorn.run(
+            "app:create_app",
+            factory=True,
+            workers=settings.web_workers,
+            host="0.0.0.0",
+            port=settings.web_port,
+            ssl_certfile=str(cert_path),
+            ssl_keyfile=str(key_path),
+        )
+        return
+
     app = create_app()
 
     uvicorn.run(
@@ -275,11 +275,53 @@
     return md.replace(/&/g, "&amp;").replace(/</g, "&lt;").replace(/>/g, "&gt;").replace(/"/g, "&quot;");
   }
 
-  /** 将内容中的 "[执行 Shell] 命令" 行渲染为两个并排气泡；"[Shell 输出]" 后内容用 pre 渲染；正文用 .content-body 包裹，按 Markdown 渲染 */
+  /** 排队提示：[QUEUE]n 表示当前请求在模型调用队列中的位置；收到下一段正文重新渲染时自动清除 */
+  function showQueueNotice(container, position) {
+    if (!container) return;
+    var notice = container.querySelector(".queue-notice");
+    if (!notice) {
+      notice = document.createElement("div");
+      notice.className = "queue-notice";
+      container.appendChild(notice);
+    }
+    notice.textContent = position > 1 ? "排队中，前面还有 " + (position - 1) + " 个请求…" : "排队中，即将开始…";
+  }
+
+  /** 命令运行中的实时输出：[SHELL_LIVE]{标注}\n{输出片段}，按标注累积（只保留末尾部分），
+   *  以 "[Shell 输出{标注}（执行中）]" 块附加在正文之后渲染；收到该命令完整的 [Shell 输出] 块后移除 */
+  var LIVE_OUTPUT_MAX_CHARS = 64 * 1024;
+
+  function appendLiveOutput(liveOutputs, chunk) {
+    var newline = chunk.indexOf("\n");
+    var label = newline >= 0 ? chunk.slice(0, newline) : chunk;
+    var text = (liveOutputs[label] || "") + (newline >= 0 ? chunk.slice(newline + 1) : "");
+    if (text.length > LIVE_OUTPUT_MAX_CHARS) {
+      text = text.slice(text.length - LIVE_OUTPUT_MAX_CHARS);
+    }
+    liveOutputs[label] = text;
+  }
+
+  function finishLiveOutput(liveOutputs, text) {
+    var m = /^\[Shell 输出(?: ([^\]（]+))?\]/.exec(text);
+    if (m) delete liveOutputs[m[1] ? " " + m[1] : ""];
+  }
+
+  function withLiveOutputs(content, liveOutputs) {
+    var suffix = "";
+    for (var label in liveOutputs) {
+      if (Object.prototype.hasOwnProperty.call(liveOutputs, label)) {
+        suffix += "\n[Shell 输出" + label + "（执行中）]\n" + liveOutputs[label];
+      }
+    }
+    return suffix ? content.replace(/\n*$/, "") + suffix : content;
+  }
+
+  /** 将内容中的 "[执行 Shell] 命令" 行渲染为两个并排气泡；"[Shell 输出]" 后内容用 pre 渲染；正文用 .content-body 包裹，按 Markdown 渲染。
+   *  并发执行多个命令时标记带调用 id，如 "[执行 Shell call_1] 命令" / "[Shell 输出 call_1]"，气泡与输出块上显示该 id */
   function renderContentWithShellBubbles(container, content) {
     if (!container || content == null) return;
-    var prefix = "[执行 Shell] ";
-    var shellOutputPrefix = "[Shell 输出]";
+    var shellCmdPattern = /^\[执行 Shell(?: ([^\]]+))?\] (.*)$/;
+    var shellOutputPattern = /^\[Shell 输出(?: ([^\]（]+))?(?:（缓存 (\d+) 秒前）)?(（执行中）)?\]/;
     var shellOutputEndMarker = "[Shell 输出结束]";
     container.textContent = "";
     var lines = (content === "" ? [] : content.split("\n"));
@@ -295,14 +337,17 @@
     }
     for (var i = 0; i < lines.length; i++) {
       var line = lines[i];
-      if (line.indexOf(prefix) === 0) {
+      var cmdMatch = shellCmdPattern.exec(line);
+      var outputMatch = cmdMatch ? null : shellOutputPattern.exec(line);
+      if (cmdMatch) {
         flushBody();
-        var cmd = line.slice(prefix.length);
+        var label = cmdMatch[1] || "";
+        var cmd = cmdMatch[2];
         var row = document.createElement("span");
         row.className = "shell-bubble-row";
         var tagBubble = document.createElement("span");
         tagBubble.className = "shell-tag-bubble";
-        tagBubble.textContent = "[执行 Shell]";
+        tagBubble.textContent = label ? "[执行 Shell · " + label + "]" : "[执行 Shell]";
         var cmdBubble = document.createElement("span");
         cmdBubble.className = "shell-cmd-bubble";
         cmdBubble.textContent = cmd;
@@ -310,11 +355,14 @@
         row.appendChild(tagBubble);
         row.appendChild(cmdBubble);
         container.appendChild(row);
-      } else if (line === shellOutputPrefix || line.indexOf(shellOutputPrefix) === 0) {
+      } else if (outputMatch) {
         flushBody();
+        var outputLabel = outputMatch[1] || "";
+        var cachedAge = outputMatch[2];
+        var running = !!outputMatch[3];
         var outputLines = [];
-        if (line.length > shellOutputPrefix.length) {
-          outputLines.push(line.slice(shellOutputPrefix.length));
+        if (line.length > outputMatch[0].length) {
+          outputLines.push(line.slice(outputMatch[0].length));
         }
         i++;
         while (i < lines.length) {
@@ -322,7 +370,7 @@
           if (nextLine === shellOutputEndMarker || nextLine.indexOf(shellOutputEndMarker) === 0) {
             break;
           }
-          if (nextLine.indexOf(prefix) === 0 || nextLine === shellOutputPrefix || nextLine.indexOf(shellOutputPrefix) === 0) {
+          if (shellCmdPattern.test(nextLine) || shellOutputPattern.test(nextLine)) {
             i--;
             break;
           }
@@ -331,6 +379,17 @@
         }
         var pre = document.createElement("pre");
         pre.className = "content-body content-body-shell-output";
+        if (outputLabel) {
+          pre.setAttribute("data-call-id", outputLabel);
+          pre.title = "输出 · " + outputLabel;
+        }
+        if (cachedAge !== undefined) {
+          pre.classList.add("content-body-shell-output-cached");
+          pre.setAttribute("data-cache-note", "缓存结果 · " + cachedAge + " 秒前");
+        }
+        if (running) {
+          pre.classList.add("content-body-shell-output-live");
+        }
         pre.textContent = outputLines.join("\n");
         container.appendChild(pre);
       } else {
@@ -340,8 +399,9 @@
     flushBody();
   }
 
-  function appendMessage(role, content, files) {
-    if (welcomeBlock) welcomeBlock.style.display = "none";
+  /** 构建一条消息行（不插入页面）；createdAt 缺省为当前时间 */
+  function buildMessageRow(role, content, files, createdAt) {
+    var when = createdAt || new Date();
     var row = document.createElement("div");
     row.className = "message-row " + role;
     var bubble = document.createElement("div");
@@ -354,7 +414,7 @@
       title.textContent = "JudgmentDay";
       var timeSpan = document.createElement("span");
       timeSpan.className = "message-time";
-      timeSpan.textContent = formatMessageTime(new Date());
+      timeSpan.textContent = formatMessageTime(when);
       header.appendChild(title);
       header.appendChild(timeSpan);
       bubble.appendChild(header);
@@ -368,7 +428,7 @@
       title.textContent = (usernameEl && usernameEl.value) ? usernameEl.value : "";
       var timeSpan = document.createElement("span");
       timeSpan.className = "message-time";
-      timeSpan.textContent = formatMessageTime(new Date());
+      timeSpan.textContent = formatMessageTime(when);
       header.appendChild(title);
       header.appendChild(timeSpan);
       bubble.appendChild(header);
@@ -410,9 +470,68 @@
     }
     bubble.appendChild(text);
     row.appendChild(bubble);
+    return row;
+  }
+
+  function appendMessage(role, content, files) {
+    if (welcomeBlock) welcomeBlock.style.display = "none";
+    var row = buildMessageRow(role, content, files);
     chatMessages.appendChild(row);
     chatMessages.scrollTop = chatMessages.scrollHeight;
-    return text;
+    return row.querySelector(".content");
+  }
+
+  // ---------- 历史消息分页：首屏只渲染最近若干条，滚动到顶部时加载更早的消息 ----------
+  var historyLoading = false;
+
+  function parseServerTime(iso) {
+    // 服务端时间为无时区的 ISO 字符串，与模板渲染保持一致按字面值显示
+    if (!iso) return null;
+    var d = new Date(String(iso).slice(0, 19));
+    return isNaN(d.getTime()) ? null : d;
+  }
+
+  function loadOlderMessages() {
+    if (!chatMessages || historyLoading || !currentConversationId) return;
+    if (chatMessages.getAttribute("data-has-more") !== "1") return;
+    var before = chatMessages.getAttribute("data-oldest-id") || "";
+    historyLoading = true;
+    var url = "/api/chat/conversations/" + encodeURIComponent(currentConversationId) + "/messages?before=" + encodeURIComponent(before);
+    fetch(url)
+      .then(function (r) {
+        if (!r.ok) return Promise.reject(new Error("加载历史消息失败"));
+        return r.json();
+      })
+      .then(function (data) {
+        var msgs = data.messages || [];
+        var anchor = welcomeBlock ? welcomeBlock.nextSibling : chatMessages.firstChild;
+        var prevHeight = chatMessages.scrollHeight;
+        var frag = document.createDocumentFragment();
+        for (var i = 0; i < msgs.length; i++) {
+          var m = msgs[i];
+          var role = m.role === "user" ? "user" : "assistant";
+          var row = buildMessageRow(role, m.content || "", m.files || [], parseServerTime(m.created_at));
+          row.setAttribute("data-message-id", m.id);
+          frag.appendChild(row);
+        }
+        chatMessages.insertBefore(frag, anchor);
+        // 保持当前可视位置不跳动
+        chatMessages.scrollTop += chatMessages.scrollHeight - prevHeight;
+        chatMessages.setAttribute("data-has-more", data.has_more ? "1" : "0");
+        if (data.next_before) chatMessages.setAttribute("data-oldest-id", data.next_before);
+      })
+      .catch(function (err) {
+        console.error(err);
+      })
+      .then(function () {
+        historyLoading = false;
+      });
+  }
+
+  if (chatMessages) {
+    chatMessages.addEventListener("scroll", function () {
+      if (chatMessages.scrollTop < 80) loadOlderMessages();
+    });
   }
 
   function uploadDroppedFiles() {
@@ -501,6 +620,7 @@
       var requestId = typeof crypto !== "undefined" && crypto.randomUUID ? crypto.randomUUID() : ("r" + Date.now());
       var assistantNode = appendMessage("assistant", "");
       var streamedContent = "";
+      var liveOutputs = {};
       setButtonStop(requestId);
 
       var fd = new FormData(chatForm);
@@ -560,9 +680,21 @@
               if (convInput) convInput.value = newConversationId;
               continue;
             }
+            if (text.indexOf("[QUEUE]") === 0) {
+              showQueueNotice(assistantNode, parseInt(text.slice(7), 10) || 0);
+              chatMessages.scrollTop = chatMessages.scrollHeight;
+              continue;
+            }
+            if (text.indexOf("[SHELL_LIVE]") === 0) {
+              appendLiveOutput(liveOutputs, text.slice(12));
+              renderContentWithShellBubbles(assistantNode, withLiveOutputs(streamedContent, liveOutputs));
+              chatMessages.scrollTop = chatMessages.scrollHeight;
+              continue;
+            }
             text = text.replace(/\\n/g, "\n").replace(/\\r/g, "\r");
+            finishLiveOutput(liveOutputs, text);
             streamedContent += text;
-            renderContentWithShellBubbles(assistantNode, streamedContent);
+            renderContentWithShellBubbles(assistantNode, withLiveOutputs(streamedContent, liveOutputs));
             chatMessages.scrollTop = chatMessages.scrollHeight;
           }
         }
@@ -623,6 +755,9 @@
   var settingsStatus = document.getElementById("settings-status");
   var enableUtcpCheckbox = document.getElementById("enable-utcp");
   var enableWebSearchCheckbox = document.getElementById("enable-web-search");
+  var enableToolCacheCheckbox = document.getElementById("enable-tool-cache");
+  var enableShellSessionCheckbox = document.getElementById("enable-shell-session");
+  var modelProviderSelect = document.getElementById("model-provider");
 
   if (toggleApiKeyBtn && apiKeyInput) {
     toggleApiKeyBtn.addEventListener("click", function () {
@@ -642,6 +777,15 @@
         }
         if (enableUtcpCheckbox) enableUtcpCheckbox.checked = data.enable_utcp !== false;
         if (enableWebSearchCheckbox) enableWebSearchCheckbox.checked = data.enable_web_search !== false;
+        if (enableToolCacheCheckbox) enableToolCacheCheckbox.checked = data.enable_tool_cache === true;
+        if (enableShellSessionCheckbox) enableShellSessionCheckbox.checked = data.enable_shell_session === true;
+        if (modelProviderSelect) {
+          var available = data.available_providers || [];
+          Array.prototype.forEach.call(modelProviderSelect.options, function (opt) {
+            opt.disabled = available.length > 0 && available.indexOf(opt.value) === -1;
+          });
+          if (data.model_provider) modelProviderSelect.value = data.model_provider;
+        }
       })
       .catch(function (err) { console.error("加载设置失败", err); });
   }
@@ -653,6 +797,9 @@
       var payload = { api_key: apiKeyInput.value };
       if (enableUtcpCheckbox) payload.enable_utcp = enableUtcpCheckbox.checked;
       if (enableWebSearchCheckbox) payload.enable_web_search = enableWebSearchCheckbox.checked;
+      if (enableToolCacheCheckbox) payload.enable_tool_cache = enableToolCacheCheckbox.checked;
+      if (enableShellSessionCheckbox) payload.enable_shell_session = enableShellSessionCheckbox.checked;
+      if (modelProviderSelect) payload.model_provider = modelProviderSelect.value;
       var body = JSON.stringify(payload);
       try {
         var resp = await fetch("/api/settings/me", {
@@ -677,6 +824,8 @@
     var raw = el.textContent || "";
     if (raw) renderContentWithShellBubbles(el, raw);
   });
+  // 首屏只包含最近的消息，定位到底部；向上滚动时再分页加载更早的消息
+  if (chatMessages) chatMessages.scrollTop = chatMessages.scrollHeight;
 
   // #region agent log — 输入行垂直居中调试：记录行/输入框/按钮及下方 upload-list 的布局
   (function logChatInputLayout() {